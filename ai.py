@@ -0,0 +1,336 @@
+""" Bots that play on the server, in a player slot of a room.
+
+Bots fill up rooms where a human has waited too long for company
+(--fill-bots in server.py) and play whole rooms on their own for capacity
+tests (--bot-rooms). They queue their moves like any client, so the tick,
+the broadcasts and the recordings treat them like human players.
+
+Routes come from distance fields: for every kind of target (the chest,
+the keys, the gates) the number of steps from every cell to the nearest
+target, found with a breadth-first search over the board. A room has one
+Navigator whose fields all its bots share. A field is built the first
+time a bot needs it and after that only updated from the changed cells
+of every tick:
+
+    - a cell that became passable, like an opened gate or a picked up
+      key, can only shorten routes, the new distances spread out from it
+    - a target that is gone, or a cell that got blocked, can only make
+      routes longer, the cells whose shortest route went through it are
+      searched again, starting from the cells around them, or the
+      whole field when that would be a big part of the board
+
+Players are not obstacles in the fields. A bot whose next step is taken
+by another player tries another step and otherwise waits. A bot then
+only looks at the four cells around it per move, so planning stays
+cheap however big the board is.
+
+    python ai.py --width 1000 --height 1000 --bots 30
+
+plays a game with bots only and reports what the fields and the moves cost.
+"""
+import argparse
+import heapq
+import random
+import time
+
+import game
+import metrics
+import rules
+
+BOT_RATE = 5        # moves per second of a bot
+FAR = 1 << 30       # the distance of cells no target can be reached from
+REBUILD_SHARE = 8   # build a field again when 1/8 of its cells need new distances
+
+# cell kinds of the navigation map
+OPEN = 0            # empty, the chest or a player
+BLOCKED = 1
+KEY = 2
+GATE = 3
+CHEST = 4
+
+# board byte -> cell kind, for bytes.translate
+KINDS = bytes(KEY if b == rules.KEY else GATE if b == rules.GATE
+              else CHEST if b == rules.CHEST else BLOCKED if b == rules.WALL
+              else OPEN for b in range(256))
+
+plan_time = metrics.histogram("ai.plan")
+build_time = metrics.histogram("ai.field_build")
+update_time = metrics.histogram("ai.field_update")
+bot_moves = metrics.counter("ai.moves")
+
+class Navigator():
+    """ The distance fields of one board, kept up to date with the
+        cells that change
+    """
+    def __init__(self, g):
+        """
+        Args:
+            g : The game, its current board is the starting point
+        """
+        self.width = w = g.width
+        self.height = h = g.height
+        self.kinds = bytearray(bytes(g.board).translate(KINDS))
+        # the edge is never walked on, so the neighbours of a passable
+        # cell are always on the board
+        for x in range(w):
+            self.kinds[x] = self.kinds[(h - 1) * w + x] = BLOCKED
+        for y in range(h):
+            self.kinds[y * w] = self.kinds[y * w + w - 1] = BLOCKED
+        self.passable = bytearray(1 if k in (OPEN, CHEST) else 0 for k in self.kinds)
+        # target kind -> list of distances by cell index
+        self.fields = {}
+        self.offsets = (1, -1, w, -w)
+        # (direction, index offset) of the four moves
+        self.steps = tuple((d, dx + dy * w) for d, (dx, dy) in rules.DIRECTION_STEPS.items())
+
+    def field(self, target):
+        """ The distances to the nearest cell of a kind, built on first use
+
+        Args:
+            target : KEY, GATE or CHEST
+        """
+        dist = self.fields.get(target)
+        if dist is None:
+            dist = self.fields[target] = [FAR] * len(self.kinds)
+            self.build(dist, target)
+        return dist
+
+    def build(self, dist, target):
+        """ Fill a field with a breadth-first search from all its targets
+        """
+        with build_time.time():
+            kinds = self.kinds
+            dist[:] = [FAR] * len(kinds)
+            sources = []
+            i = kinds.find(target)
+            while i != -1:
+                dist[i] = 0
+                sources.append(i)
+                i = kinds.find(target, i + 1)
+            self.spread(dist, sources)
+
+    def spread(self, dist, frontier):
+        """ Breadth-first search lowering the distances around frontier,
+            cells that all have the same distance
+        """
+        passable = self.passable
+        offsets = self.offsets
+        while frontier:
+            d = dist[frontier[0]] + 1
+            next_frontier = []
+            for i in frontier:
+                for o in offsets:
+                    n = i + o
+                    if d < dist[n] and passable[n]:
+                        dist[n] = d
+                        next_frontier.append(n)
+            frontier = next_frontier
+
+    def lower(self, dist, i):
+        """ Cell i became passable, routes through it may be shorter
+        """
+        d = min(dist[i + o] for o in self.offsets) + 1
+        if d < dist[i]:
+            dist[i] = d
+            self.spread(dist, [i])
+
+    def raiseFrom(self, dist, i, target):
+        """ Cell i is no longer a target or got blocked. The cells whose
+            distance came through it are searched again from the cells
+            around them, the rest of the field stays as it is. When that
+            is a big part of the board the field is built again instead,
+            which is cheaper.
+        """
+        offsets = self.offsets
+        limit = len(dist) // REBUILD_SHARE
+        # the cells below i in the shortest routes, by their old distances
+        region = [i]
+        seen = {i}
+        for c in region:
+            d = dist[c] + 1
+            for o in offsets:
+                n = c + o
+                if dist[n] == d and n not in seen:
+                    seen.add(n)
+                    region.append(n)
+            if len(region) > limit:
+                self.build(dist, target)
+                return
+        for c in region:
+            dist[c] = FAR
+        kinds = self.kinds
+        passable = self.passable
+        heap = []
+        for c in region:
+            if kinds[c] == target:
+                d = 0
+            elif passable[c]:
+                d = min(dist[c + o] for o in offsets) + 1
+            else:
+                continue
+            if d < FAR:
+                dist[c] = d
+                heap.append((d, c))
+        heapq.heapify(heap)
+        while heap:
+            (d, c) = heapq.heappop(heap)
+            if d > dist[c]:
+                continue
+            d += 1
+            for o in offsets:
+                n = c + o
+                if d < dist[n] and passable[n]:
+                    dist[n] = d
+                    heapq.heappush(heap, (d, n))
+
+    def update(self, cells):
+        """ Bring the fields up to date with changed cells
+
+        Args:
+            cells : (x, y, byte value) of the cells, like in Game.takeDelta
+        """
+        with update_time.time():
+            w = self.width
+            h = self.height
+            kinds = self.kinds
+            passable = self.passable
+            for (x, y, sym) in cells:
+                if not (0 < x < w - 1 and 0 < y < h - 1):
+                    continue
+                i = y * w + x
+                kind = KINDS[sym]
+                old = kinds[i]
+                if kind == old:
+                    continue
+                kinds[i] = kind
+                was_passable = passable[i]
+                passable[i] = kind in (OPEN, CHEST)
+                for target, dist in self.fields.items():
+                    if old == target or (was_passable and not passable[i]):
+                        self.raiseFrom(dist, i, target)
+                    elif kind == target:
+                        dist[i] = 0
+                        self.spread(dist, [i])
+                    elif passable[i] and not was_passable:
+                        self.lower(dist, i)
+
+class Bot():
+    """ A player played by the server. Rooms keep it in the player's
+        connection slot, so it has the methods of a connection and
+        ignores what is sent to it.
+    """
+    def __init__(self, player, navigator, interval=1, seed=None):
+        """
+        Args:
+            player : The player number
+            navigator : The room's Navigator
+            interval : Ticks between two moves
+            seed : Seed for the moves made when no target can be reached
+        """
+        self.player = player
+        self.navigator = navigator
+        self.interval = interval
+        self.random = random.Random(seed)
+        # bots of one room do not all move on the same tick
+        self.phase = self.random.randrange(interval)
+
+    def __repr__(self):
+        return f"Bot({self.player})"
+
+    def send(self, frame, full_state=False):
+        pass
+
+    def close(self):
+        pass
+
+    def goals(self, p):
+        """ The targets worth going for, best first
+        """
+        yield CHEST
+        if p.key:
+            yield GATE
+        elif not p.has_used_key:
+            yield KEY
+
+    def decide(self, g, tick):
+        """ The bot's move on this tick
+
+        Args:
+            g : The game
+            tick : The room's tick counter
+
+        Returns:
+            str: The direction, or None to wait
+        """
+        if (tick + self.phase) % self.interval:
+            return None
+        with plan_time.time():
+            direction = self.plan(g)
+        if direction is not None:
+            bot_moves.inc()
+        return direction
+
+    def plan(self, g):
+        p = g.players[self.player]
+        nav = self.navigator
+        w = g.width
+        board = g.board
+        occupants = g.occupants
+        (x, y) = p.pos
+        i = y * w + x
+        possible = [(direction, i + o) for (direction, o) in nav.steps
+                    if rules.canEnter(board[i + o], p.key, p.has_used_key,
+                                      ((i + o) % w, (i + o) // w) in occupants)]
+        for target in self.goals(p):
+            dist = nav.field(target)
+            here = dist[i]
+            if here >= FAR:
+                continue
+            closer = [(dist[n], direction) for (direction, n) in possible if dist[n] < here]
+            if closer:
+                return min(closer)[1]
+            # another player is in the way, step aside now and then
+            break
+        if possible and self.random.random() < 0.5:
+            return self.random.choice(possible)[0]
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a game with bots only and time it")
+    parser.add_argument("--width", type=int, default=80)
+    parser.add_argument("--height", type=int, default=30)
+    parser.add_argument("--bots", type=int, default=2)
+    parser.add_argument("--ticks", type=int, default=20000,
+                        help="stop after this many rounds of moves")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    g = game.Game(args.width, args.height, args.bots)
+    g.initBoard()
+    nav = Navigator(g)
+    bots = [Bot(n, nav, seed=args.seed + n) for n in g.players]
+    start = time.perf_counter()
+    moves = 0
+    tick = 0
+    while tick < args.ticks and not g.winner:
+        for b in bots:
+            direction = b.decide(g, tick)
+            if direction is not None:
+                g.makeMove(direction, b.player)
+                moves += 1
+        delta = g.takeDelta()
+        if delta is not None:
+            nav.update(delta[1])
+        tick += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.width}x{args.height} board, {args.bots} bots: "
+          f"{'won' if g.winner else 'no winner'} after {tick} rounds, {moves} moves")
+    for name, h in (("field build", build_time), ("field update", update_time),
+                    ("plan", plan_time)):
+        print(f"{name:13} {h.count:7} times, {h.total / max(1, h.count) * 1e6:9.1f} us each")
+    print(f"{moves / elapsed:.0f} moves/s including the game, "
+          f"{plan_time.total / max(1, moves) * 1e6:.1f} us planning per move")
+
+if __name__ == "__main__":
+    main()
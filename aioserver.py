@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import time
+
+import compression
+import metrics
+import protocol
+import ratelimit
+import rooms
+import udp
+from sendqueue import SendQueue, SlowConsumerError
+
+TICK_RATE = 20              # simulation steps per second
+SEND_TIMEOUT = 10           # seconds a client may take to accept our data
+JOIN_TIMEOUT = 2            # seconds to wait for JOIN before matchmaking
+SPECTATOR_RATE = 5          # frames per second sent to spectators
+
+log = logging.getLogger("aioserver")
+
+tick_time = metrics.histogram("tick")
+tick_lag = metrics.histogram("tick.lag")
+invalid_inputs = metrics.counter("inputs.invalid")
+frames_sent = metrics.counter("frames.sent")
+bytes_sent = metrics.counter("bytes.sent")
+slow_consumers = metrics.counter("clients.slow_dropped")
+
+class Connection():
+    """ One connected client: its stream writer, the queue of frames
+        waiting to be sent and the event that wakes up its writer task.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = SendQueue(self.keyframe)
+        self.wakeup = asyncio.Event()
+        # the room the client plays in, set once it has joined
+        self.room = None
+        # set by close(), the writer stops after sending what is queued
+        self.closing = False
+        # replaced by a per-player histogram once we know the player
+        self.send_time = metrics.histogram("send")
+        # set from the JOIN, state frames are compressed when written
+        self.compressor = compression.Compressor()
+        # what the client may send, limited once it has joined, see ratelimit.py
+        self.limiter = ratelimit.InputLimiter(0)
+
+    def keyframe(self):
+        return self.room.keyframe(self)
+
+    def send(self, frame, full_state=False):
+        """ Queue a frame without waiting for it to be written.
+            A client that keeps falling behind is closed.
+        """
+        if self.writer.is_closing():
+            return
+        try:
+            self.queue.push(frame, full_state)
+        except SlowConsumerError as e:
+            log.warning("%s", e)
+            slow_consumers.inc()
+            self.writer.close()
+            return
+        self.wakeup.set()
+
+    def close(self):
+        """ Disconnect once the queued frames are sent
+        """
+        self.closing = True
+        self.wakeup.set()
+
+    async def writerLoop(self):
+        """ Drain the queue to the socket on this client's own schedule,
+            while it is waiting for a slow socket new frames collapse
+            in the queue instead of piling up in the transport.
+        """
+        writer = self.writer
+        while not writer.is_closing():
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            frames = self.queue.take()
+            if frames:
+                # compress here and not when queued, a zlib stream has
+                # to see exactly the frames that are sent
+                frames = [self.compressor.encode(f) for f in frames]
+                start = time.perf_counter()
+                writer.writelines(frames)
+                try:
+                    await asyncio.wait_for(writer.drain(), SEND_TIMEOUT)
+                except (asyncio.TimeoutError, ConnectionError) as e:
+                    log.warning("Dropping slow client: %r", e)
+                    slow_consumers.inc()
+                    writer.close()
+                    return
+                self.send_time.observe(time.perf_counter() - start)
+                frames_sent.inc(len(frames))
+                bytes_sent.inc(sum(len(f) for f in frames))
+                self.queue.drained()
+            if self.closing:
+                writer.close()
+                return
+
+class AsyncServer():
+    """ Asyncio server engine. One event loop owns every room and its
+        game object, so moves are applied one after another without any
+        locking, and every client is a pair of stream reader/writer objects
+        instead of a thread.
+
+        A fixed-rate tick applies the queued inputs of every room and
+        broadcasts one message per room with everything that changed.
+    """
+    def __init__(self, manager, tick_rate=TICK_RATE, udp_server=None):
+        """
+        Args:
+            manager : The RoomManager owning the rooms
+            tick_rate : Simulation steps per second
+            udp_server : A udp.UdpServer serving the same rooms, or None
+        """
+        self.manager = manager
+        self.tick_interval = 1 / tick_rate
+        self.udp_server = udp_server
+
+    async def tickLoop(self):
+        """ Tick every room at a fixed rate. A tick that runs late does not
+            cause a burst of catch-up ticks, the schedule just moves on.
+        """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            tick_lag.observe(max(0, loop.time() - next_tick))
+            with tick_time.time():
+                self.manager.tick()
+                if self.udp_server is not None:
+                    self.udp_server.flush()
+            next_tick += self.tick_interval
+            delay = next_tick - loop.time()
+            if delay < 0:
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    async def readJoin(self, reader, frame_reader, initial=b""):
+        """ Wait for the JOIN frame a client sends first. Clients that
+            do not send one are matched into any room.
+
+        Args:
+            reader : asyncio StreamReader of the client
+            frame_reader : The client's FrameReader
+            initial : Bytes already read from the client by someone else
+
+        Returns:
+            tuple: (role, room code, view size or None, compression method,
+                    resume or None, frames received after the JOIN),
+                   see protocol.decodeJoin
+        """
+        frames = frame_reader.feed(initial)
+        if not frames:
+            try:
+                data = await asyncio.wait_for(reader.read(4096), JOIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                return (protocol.ROLE_PLAYER, "", None, protocol.COMPRESS_NONE, None, [])
+            if not data:
+                raise ConnectionError("Client disconnected")
+            frames = frame_reader.feed(data)
+        if frames and frames[0][0] == protocol.JOIN:
+            return (*protocol.decodeJoin(frames[0][1]), frames[1:])
+        return (protocol.ROLE_PLAYER, "", None, protocol.COMPRESS_NONE, None, frames)
+
+    def handleFrames(self, conn, room, player, frames):
+        """ Queue the moves and keyframe requests of a client, as far
+            as its limiter lets them through
+
+        Args:
+            player : The player number, 0 for a spectator
+
+        Raises:
+            ratelimit.FloodError: if the client has to be disconnected
+        """
+        limiter = conn.limiter
+        for (kind, payload) in frames:
+            if kind == protocol.SYNC:
+                if limiter.allow(ratelimit.SYNC_COST):
+                    room.requestSync(conn)
+                continue
+            # every other frame takes an input, also the ones ignored
+            allowed = limiter.allow()
+            if kind == protocol.JOIN or not player:
+                continue    # already in a room, or only watching
+            move = protocol.decodeInput(payload) if kind == protocol.INPUT else None
+            if move is None:
+                invalid_inputs.inc()
+                limiter.strike()
+            elif allowed:
+                room.queueInput(player, move[1], move[0])
+            else:
+                room.dropInput(player, move[0])
+
+    async def handleClient(self, reader, writer, initial=b""):
+        """ Coroutine run by asyncio.start_server for every new connection.
+            Puts the client in a room, then receives frames and queues the
+            moves for the tick loop.
+
+        Args:
+            reader : asyncio StreamReader of the client
+            writer : asyncio StreamWriter of the client
+            initial : Bytes the acceptor process already read, see workers.py
+        """
+        addr = writer.get_extra_info("peername")
+        conn = Connection(writer)
+        # nothing a client sends is bigger than a JOIN
+        frame_reader = protocol.FrameReader(ratelimit.MAX_CLIENT_FRAME)
+        try:
+            (role, code, view, method, resume, frames) = await self.readJoin(
+                reader, frame_reader, initial)
+        except (ConnectionError, protocol.ProtocolError) as e:
+            if isinstance(e, protocol.ProtocolError):
+                ratelimit.protocol_errors.inc()
+            log.info("Client %s left before joining: %r", addr, e)
+            writer.close()
+            return
+        conn.compressor = compression.Compressor(compression.choose(method))
+        conn.limiter = self.manager.newLimiter()
+        if role == protocol.ROLE_SPECTATOR:
+            (room, player) = self.manager.spectate(conn, code)
+        elif resume is not None:
+            (room, player) = self.manager.resume(conn, code, *resume, view)
+        else:
+            (room, player) = self.manager.join(conn, code, view)
+        if room is None:
+            log.warning("Refused %s: %s", addr, player)
+            writer.write(protocol.encodeError(player))
+            writer.close()
+            return
+        conn.room = room
+        if player:
+            conn.send_time = metrics.histogram(f"send.player{player}")
+            log.info("Connected by %s as player %d in room %s", addr, player, room.code)
+        else:
+            conn.send_time = metrics.histogram("send.spectator")
+            log.debug("Spectator %s watching room %s", addr, room.code)
+        sender = asyncio.create_task(conn.writerLoop())
+        # a client dropped for what it sent does not get its slot kept
+        reserve = True
+        try:
+            self.handleFrames(conn, room, player, frames)
+            while True:
+                data = await asyncio.wait_for(reader.read(4096), 300) # 5min
+                if not data:    # connection is closed
+                    break
+                self.handleFrames(conn, room, player, frame_reader.feed(data))
+        except (ratelimit.FloodError, protocol.ProtocolError) as e:
+            if isinstance(e, protocol.ProtocolError):
+                ratelimit.protocol_errors.inc()
+            log.warning("Disconnecting %s: %s", addr, e)
+            reserve = False
+        except Exception as e:
+            log.info("Player %d: %r", player, e)
+        finally:
+            if player:
+                # the player can resume with its token for a while
+                self.manager.leave(room, player, conn, reserve=reserve)
+                log.info("Player %d disconnected from room %s", player, room.code)
+            else:
+                self.manager.stopSpectating(room, conn)
+            sender.cancel()
+            writer.close()
+
+    async def serve(self, host, port):
+        """ Accept clients until cancelled
+
+        Args:
+            host : Address to bind to
+            port : Port to bind to
+        """
+        server = await asyncio.start_server(self.handleClient, host, port,
+                                            reuse_address=True, backlog=1024)
+        if self.udp_server is not None:
+            await self.udp_server.start(host, port)
+        ticker = asyncio.create_task(self.tickLoop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            ticker.cancel()
+
+def ticksPer(tick_rate, rate):
+    """ Ticks between two events that happen rate times per second,
+        like the spectator frames or the moves of a bot
+    """
+    return max(1, round(tick_rate / rate))
+
+def main(host, port, tick_rate=TICK_RATE, room_options=None, udp_options=None):
+    """
+    Args:
+        host, port : The address to serve on
+        tick_rate : Simulation steps per second
+        room_options : Keyword arguments for the RoomManager
+        udp_options : Keyword arguments for a udp.UdpServer on the same
+                      port, None to serve TCP only
+    """
+    manager = rooms.RoomManager(**(room_options or {}))
+    udp_server = None
+    if udp_options is not None:
+        udp_server = udp.UdpServer(manager, **udp_options)
+    server = AsyncServer(manager, tick_rate, udp_server)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+import bot
+import compression
+
+HOST = "127.0.0.1"
+PORT = 65100    # not the default port, so a running game is left alone
+
+def percentile(values, p):
+    """ The p-th percentile of the values, None if there are none
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    i = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[i]
+
+def startServer(engine, host, port, extra_args=()):
+    """ Start server.py in a child process and wait until it accepts
+
+    Returns:
+        subprocess.Popen: The server process
+    """
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    proc = subprocess.Popen([sys.executable, server_py, "--engine", engine,
+                             "--host", host, "--port", str(port), *extra_args],
+                            stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("Server exited during startup")
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Server did not start listening")
+
+def stopServer(proc):
+    """ Stop the server process
+
+    Returns:
+        float: CPU seconds (user + system) the server used
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+def report(bots, duration, cpu=None):
+    """ Print the benchmark results
+
+    Args:
+        bots : The Bot objects after the run
+        duration : How long they played
+        cpu : Server CPU seconds or None if unknown
+    """
+    watching = [b for b in bots if b.spectate]
+    playing = [b for b in bots if b.frames and not b.spectate]
+    latencies = [l for b in playing for l in b.latencies]
+    frames = sum(b.frames for b in playing)
+    received = sum(b.bytes_received for b in playing)
+    inputs = sum(b.inputs_sent for b in playing)
+
+    print(f"bots playing:     {len(playing)}/{len(bots) - len(watching)}")
+    print(f"inputs sent:      {inputs}")
+    if latencies:
+        p50, p90, p99 = (percentile(latencies, p) * 1000 for p in (50, 90, 99))
+        print(f"input->broadcast: p50 {p50:.2f} ms  p90 {p90:.2f} ms  "
+              f"p99 {p99:.2f} ms  max {max(latencies) * 1000:.2f} ms")
+    if playing:
+        print(f"frames/s:         {frames / duration / len(playing):.1f} per bot")
+    if frames:
+        print(f"bytes/frame:      {received / frames:.1f}")
+    if inputs:
+        corrections = sum(b.state.corrections for b in playing)
+        print(f"mispredictions:   {corrections} ({corrections / inputs * 100:.1f}% of inputs)")
+    if watching:
+        seen = sum(b.frames for b in watching)
+        print(f"spectators:       {sum(1 for b in watching if b.frames)}/{len(watching)} "
+              f"watching, {seen / duration / len(watching):.1f} frames/s each")
+    if cpu is not None and playing:
+        print(f"server cpu:       {cpu:.3f} s total, "
+              f"{cpu / len(playing) * 1000:.2f} ms per connection")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run bots against a local server and report latency and cost")
+    parser.add_argument("-n", "--bots", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=10,
+                        help="inputs per second and bot")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--script", default=None,
+                        help="comma separated directions to repeat, e.g. up,up,left")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="asyncio")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--spectators", type=int, default=0,
+                        help="also run this many spectators, the players then all "
+                             "join the room BENCH")
+    parser.add_argument("--udp", action="store_true",
+                        help="connect the bots over UDP")
+    parser.add_argument("--udp-loss", type=float, default=0,
+                        help="with --udp: drop this fraction of the datagrams "
+                             "in both directions")
+    parser.add_argument("--udp-reorder", type=float, default=0,
+                        help="with --udp: delay this fraction of the datagrams "
+                             "in both directions")
+    parser.add_argument("--compression", choices=compression.METHODS, default="none",
+                        help="compression the bots ask for, compare the "
+                             "bytes/frame and server cpu of the methods")
+    parser.add_argument("--no-server", action="store_true",
+                        help="use a server that is already running, "
+                             "server CPU is not measured")
+    args, server_args = parser.parse_known_args()
+    script = args.script.split(",") if args.script else None
+    if args.udp:
+        server_args += ["--udp", "--udp-loss", str(args.udp_loss),
+                        "--udp-reorder", str(args.udp_reorder)]
+
+    proc = None if args.no_server else startServer(args.engine, args.host,
+                                                   args.port, server_args)
+    cpu = None
+    try:
+        room_code = "BENCH" if args.spectators else ""
+        bots = asyncio.run(bot.runBots(args.bots, args.duration, args.host,
+                                       args.port, args.rate, script, args.seed,
+                                       room_code, args.spectators, args.udp,
+                                       args.udp_loss, args.udp_reorder,
+                                       compression.METHODS[args.compression]))
+    finally:
+        if proc is not None:
+            cpu = stopServer(proc)
+    report(bots, args.duration, cpu)
+
+if __name__ == "__main__":
+    main()
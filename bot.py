@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import random
+import time
+
+import client
+import compression
+import protocol
+import udp
+
+HOST = "127.0.0.1"
+PORT = 65000
+SPECTATOR_DELAY = 0.5   # seconds spectators wait for the room to exist
+
+class Bot():
+    """ Headless client that speaks the server protocol without curses.
+        It sends moves at a fixed rate and keeps statistics about what
+        it receives, used by bench.py to load the server.
+
+        Latency is measured from sending an input to receiving the next
+        state frame, so it covers queueing, the tick and the broadcast.
+    """
+    def __init__(self, host=HOST, port=PORT, rate=10, script=None, seed=None,
+                 room_code="", spectate=False, use_udp=False, loss=0.0, reorder=0.0,
+                 method=protocol.COMPRESS_NONE):
+        """
+        Args:
+            host, port : The server address
+            rate : Inputs sent per second
+            script : Directions to send in a loop, random moves if None
+            seed : Seed for the random moves
+            room_code : The room to join, "" for matchmaking
+            spectate : Watch room_code without sending any inputs
+            use_udp : Use the UDP transport instead of TCP
+            loss, reorder : Fractions of our datagrams to drop or delay
+            method : The compression to ask for, see compression.py
+        """
+        self.host = host
+        self.port = port
+        self.room_code = room_code
+        self.spectate = spectate
+        self.use_udp = use_udp
+        self.loss = loss
+        self.reorder = reorder
+        self.method = method
+        self.seed = seed
+        self.rate = rate
+        self.script = script
+        self.random = random.Random(seed)
+        self.state = client.BoardState()
+        # send times of the inputs that no frame has answered yet
+        self.pending = []
+        self.latencies = []
+        self.frames = 0
+        self.bytes_received = 0
+        self.inputs_sent = 0
+        self.connected = False
+        # the datagram send function, set by runUdp
+        self.send = None
+
+    def nextDirection(self):
+        if self.script:
+            return self.script[self.inputs_sent % len(self.script)]
+        return self.random.choice(protocol.DIRECTIONS)
+
+    def handleFrame(self, kind, payload):
+        """ Apply a state frame and account for it
+
+        Returns:
+            bytes: A SYNC frame to send back if we lost track of the state
+        """
+        if kind in (protocol.WELCOME, protocol.ERROR, protocol.ACK):
+            self.state.applyFrame(kind, payload)
+            return None
+        now = time.perf_counter()
+        self.frames += 1
+        for sent in self.pending:
+            self.latencies.append(now - sent)
+        self.pending.clear()
+        if not self.state.applyFrame(kind, payload):
+            return protocol.encodeSync()
+        return None
+
+    async def receive(self, reader, writer):
+        frame_reader = protocol.FrameReader()
+        decompressor = compression.Decompressor()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            self.bytes_received += len(data)
+            for (kind, payload) in decompressor.expand(frame_reader.feed(data)):
+                reply = self.handleFrame(kind, payload)
+                if reply:
+                    writer.write(reply)
+
+    async def run(self, duration):
+        """ Connect, play for duration seconds and disconnect
+
+        Args:
+            duration : Seconds to play
+        """
+        if self.use_udp:
+            await self.runUdp(duration)
+            return
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        role = protocol.ROLE_SPECTATOR if self.spectate else protocol.ROLE_PLAYER
+        writer.write(protocol.encodeJoin(self.room_code, role, None, self.method))
+        self.connected = True
+        receiver = asyncio.create_task(self.receive(reader, writer))
+        loop = asyncio.get_running_loop()
+        end = loop.time() + duration
+        interval = 1 / self.rate if self.rate else duration
+        try:
+            # moves sent before the WELCOME could not be predicted
+            while self.state.player is None and loop.time() < end and not receiver.done():
+                await asyncio.sleep(0.01)
+            if self.spectate:
+                await asyncio.wait([receiver], timeout=end - loop.time())
+            while not self.spectate and loop.time() < end and not receiver.done():
+                direction = self.nextDirection()
+                # numbers the input and predicts it like the real client
+                seq = self.state.predictMove(direction)
+                writer.write(protocol.encodeInput(direction, seq))
+                self.pending.append(time.perf_counter())
+                self.inputs_sent += 1
+                await asyncio.sleep(interval)
+        finally:
+            receiver.cancel()
+            writer.close()
+
+    async def runUdp(self, duration):
+        """ run() over the UDP transport
+        """
+        loop = asyncio.get_running_loop()
+        role = protocol.ROLE_SPECTATOR if self.spectate else protocol.ROLE_PLAYER
+        session = udp.UdpSession(self.room_code, role, None, self.method)
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: BotDatagrams(self, session), remote_addr=(self.host, self.port))
+        send = transport.sendto
+        if self.loss or self.reorder:
+            send = udp.LossyLink(transport.sendto, loop.call_later,
+                                 self.loss, self.reorder, self.seed)
+        self.send = send
+        self.connected = True
+        end = loop.time() + duration
+        interval = 1 / self.rate if self.rate and not self.spectate else udp.KEEPALIVE_INTERVAL
+        try:
+            while self.state.player is None and loop.time() < end and not session.closed:
+                send(session.hello())
+                await asyncio.sleep(udp.HELLO_INTERVAL)
+            while loop.time() < end and not session.closed:
+                if not self.spectate:
+                    direction = self.nextDirection()
+                    self.state.predictMove(direction)
+                    self.pending.append(time.perf_counter())
+                    self.inputs_sent += 1
+                # also the keepalive of spectators
+                send(session.inputs(self.state))
+                await asyncio.sleep(min(interval, end - loop.time()))
+        finally:
+            transport.sendto(session.bye())
+            transport.close()
+
+class BotDatagrams(asyncio.DatagramProtocol):
+    """ Receives the datagrams of a Bot using UDP
+    """
+    def __init__(self, bot, session):
+        self.bot = bot
+        self.session = session
+
+    def datagram_received(self, data, addr):
+        b = self.bot
+        b.bytes_received += len(data)
+        for (kind, payload) in self.session.receive(data):
+            b.handleFrame(kind, payload)
+        if self.session.session is None:
+            # a challenge, the HELLO with its cookie joins
+            b.send(self.session.hello())
+        elif not self.session.closed:
+            # acknowledge the state, the next datagram is a delta from it
+            b.send(self.session.inputs(b.state))
+
+async def runBots(count, duration, host=HOST, port=PORT, rate=10,
+                  script=None, seed=None, room_code="", spectators=0,
+                  use_udp=False, loss=0.0, reorder=0.0, method=protocol.COMPRESS_NONE):
+    """ Run count bots at the same time, by default matchmaking
+        puts them in as many rooms as they need
+
+    Args:
+        spectators : Number of extra bots watching room_code, they
+                     connect once the players are in
+        use_udp, loss, reorder, method : See Bot
+
+    Returns:
+        list: The Bot objects with their statistics, spectators last
+    """
+    bots = [Bot(host, port, rate, script,
+                None if seed is None else seed + i, room_code,
+                use_udp=use_udp, loss=loss, reorder=reorder, method=method)
+            for i in range(count)]
+    watchers = [Bot(host, port, room_code=room_code, spectate=True,
+                    use_udp=use_udp, loss=loss, reorder=reorder, method=method)
+                for i in range(spectators)]
+
+    async def watch(b):
+        await asyncio.sleep(SPECTATOR_DELAY)
+        await b.run(duration - SPECTATOR_DELAY)
+
+    results = await asyncio.gather(*(b.run(duration) for b in bots),
+                                   *(watch(b) for b in watchers),
+                                   return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            print(f"Bot failed: {r!r}")
+    return bots + watchers
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load generator")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("-n", "--bots", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=10,
+                        help="inputs per second and bot")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--script", default=None,
+                        help="comma separated directions to repeat, e.g. up,up,left")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--room", default="", help="room code, all bots join it")
+    parser.add_argument("--spectators", type=int, default=0,
+                        help="extra bots that watch the --room")
+    parser.add_argument("--udp", action="store_true",
+                        help="use the UDP transport, the server needs --udp too")
+    parser.add_argument("--udp-loss", type=float, default=0,
+                        help="drop this fraction of the datagrams we send")
+    parser.add_argument("--udp-reorder", type=float, default=0,
+                        help="delay this fraction of the datagrams we send")
+    parser.add_argument("--compression", choices=compression.METHODS, default="none",
+                        help="how the server should compress the board updates")
+    args = parser.parse_args()
+    try:
+        protocol.checkRoomCode(args.room)
+    except ValueError as e:
+        parser.error(str(e))
+    script = args.script.split(",") if args.script else None
+    bots = asyncio.run(runBots(args.bots, args.duration, args.host, args.port,
+                               args.rate, script, args.seed, args.room,
+                               args.spectators, args.udp, args.udp_loss,
+                               args.udp_reorder, compression.METHODS[args.compression]))
+    for i, b in enumerate(bots, 1):
+        role = "spectator" if b.spectate else f"player {b.state.player}"
+        print(f"bot {i} (room {b.state.room_code}, {role}): sent {b.inputs_sent} inputs, "
+              f"received {b.frames} frames ({b.bytes_received} bytes)")
+
+if __name__ == "__main__":
+    main()
@@ -1,95 +1,530 @@
+import argparse
 import socket
 import curses
+import threading
+from collections import deque
 
 from _thread import *
 import time
 
+import compression
+import protocol
+import rules
+import udp
+
 HOST = "127.0.0.1"  # The server's hostname or IP address
 PORT = 65000  # The port used by the server
-#board dimensions
+#viewport dimensions until the first keyframe
 WIDTH = 80
 HEIGHT = 30
-#max size of board + message string
-TOTAL_SIZE = WIDTH * HEIGHT + WIDTH
+# seconds an input may wait for its ACK before we stop predicting it
+PREDICTION_TIMEOUT = 1.0
+# how long and how often we try to get back in after losing the connection
+RECONNECT_TIMEOUT = 10
+RECONNECT_INTERVAL = 0.5
 
-def stringToBoard(gameString, screen):
-    """ Convert the string received from the server to 
-        curses graphic and display on the terminal
+class BoardState():
+    """ The client copy of the game state, kept up to date by applying
+        the keyframes and deltas received from the server. It covers our
+        viewport: width x height cells of the game board starting at
+        origin, positions are in board coordinates.
 
-    Args:
-        gameString : The 2400 chars that make up the game board.
-        screen : The ncurses window
+        Our own moves are predicted: an input is applied to our player
+        right away with the same rules the server uses, and kept until
+        the server's ACK says it was handled. Every ACK carries the
+        authoritative position, the inputs that are still pending are
+        then replayed on top of it, which corrects any wrong guess.
     """
-    for i in range(31):
-        rowStr = gameString[0:80]
-        gameString = gameString[80:]
-        screen.addstr(i, 0, rowStr)
+    def __init__(self):
+        self.version = -1   # no keyframe received yet
+        self.width = WIDTH
+        self.height = HEIGHT
+        self.origin = (0, 0)
+        self.board = bytearray(b" " * (WIDTH * HEIGHT))
+        self.message = "@" * WIDTH
+        # set by the server's WELCOME, the token gets our player back
+        # after a lost connection
+        self.player = None
+        self.room_code = None
+        self.token = None
+        # inputs sent but not acknowledged,
+        # [seq, direction, time sent, position first shown for it]
+        self.pending = deque()
+        self.next_seq = 1
+        # our player's state from the last ACK, (pos, has_key, has_used_key)
+        self.acked = None
+        # where our pending inputs put us, None while nothing is pending
+        self.predicted = None
+        # ACKs that put us somewhere else than we first showed
+        self.corrections = 0
+        # the input and the receiving thread of the client both use the state
+        self.lock = threading.Lock()
+
+    def applyKeyframe(self, version, width, height, origin, body):
+        """ Replace the whole state with a keyframe
+
+        Args:
+            version : The version of the keyframe
+            width, height : The viewport dimensions
+            origin : (x, y) of the top left viewport cell on the board
+            body : The row-major board followed by the message line
+        """
+        self.version = version
+        self.width = width
+        self.height = height
+        self.origin = origin
+        self.board = bytearray(body[:width * height])
+        self.message = body[width * height:].decode("utf-8")
+
+    def applyDelta(self, base, version, cells, message):
+        """ Apply changed cells on top of the current state
+
+        Args:
+            base : The oldest version the delta applies to
+            version : The version the delta leads to
+            cells : The packed (x, y, symbol) records
+            message : The new message line or None if unchanged
+
+        Returns:
+            Boolean: False if the delta does not follow our version
+                     and a new keyframe is needed
+        """
+        if version <= self.version:
+            # already part of the keyframe we have
+            return True
+        if base > self.version:
+            return False
+        (ox, oy) = self.origin
+        (w, h) = (self.width, self.height)
+        for (x, y, sym) in protocol.CELL.iter_unpack(cells):
+            (x, y) = (x - ox, y - oy)
+            if 0 <= x < w and 0 <= y < h:
+                self.board[y * w + x] = sym
+        if message is not None:
+            self.message = message.decode("utf-8")
+        self.version = version
+        return True
+
+    def applyFrame(self, kind, payload):
+        """ Apply a KEYFRAME, DELTA or ACK frame from the server
+
+        Returns:
+            Boolean: False if the state is out of date and a SYNC is needed
+        """
+        if kind == protocol.WELCOME:
+            (self.player, self.room_code, self.token) = protocol.decodeWelcome(payload)
+        elif kind == protocol.KEYFRAME:
+            header_size = protocol.KEYFRAME_HEADER.size
+            (version, width, height, x, y) = protocol.KEYFRAME_HEADER.unpack_from(payload)
+            self.applyKeyframe(version, width, height, (x, y), payload[header_size:])
+            self.predict()
+        elif kind == protocol.DELTA:
+            header_size = protocol.DELTA_HEADER.size
+            (base, version, count, has_message) = protocol.DELTA_HEADER.unpack_from(payload)
+            cells_end = header_size + count * protocol.CELL.size
+            cells = payload[header_size:cells_end]
+            message = payload[cells_end:] if has_message else None
+            applied = self.applyDelta(base, version, cells, message)
+            if self.pending:
+                self.predict()
+            return applied
+        elif kind == protocol.ACK:
+            self.applyAck(*protocol.decodeAck(payload))
+        return True
+
+    def ownSymbol(self):
+        return ord(rules.PLAYER_SYMBOLS[self.player - 1])
+
+    def viewIndex(self, pos):
+        """ Index of a board position in our board, None outside the viewport
+        """
+        x = pos[0] - self.origin[0]
+        y = pos[1] - self.origin[1]
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return None
+
+    def predictMove(self, direction):
+        """ Number an input and apply it to our player right away
+
+        Args:
+            direction : up/down/left/right
+
+        Returns:
+            int: The sequence number to send with the input
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        if self.player:     # spectators do not move
+            self.pending.append([seq, direction, time.monotonic(), None])
+            self.predict()
+        return seq
+
+    def applyAck(self, seq, pos, has_key, has_used_key):
+        """ The server handled our inputs up to seq and we are at pos
+        """
+        predicted = None
+        while self.pending and self.pending[0][0] <= seq:
+            predicted = self.pending.popleft()[3]
+        if predicted is not None and predicted != pos:
+            self.corrections += 1
+        self.acked = (pos, has_key, has_used_key)
+        self.predict()
+
+    def predict(self):
+        """ Replay the pending inputs from the last acknowledged state
+            with the server's movement rules
+        """
+        now = time.monotonic()
+        # an input whose ACK got lost should not hold the prediction forever
+        while self.pending and now - self.pending[0][2] > PREDICTION_TIMEOUT:
+            self.pending.popleft()
+        if not self.pending or not self.player:
+            self.predicted = None
+            return
+        own = self.ownSymbol()
+        if self.acked is not None:
+            (pos, has_key, has_used_key) = self.acked
+        else:
+            # nothing handled yet, we are where the board has us
+            i = self.board.find(own)
+            if i < 0:
+                self.predicted = None
+                return
+            (ox, oy) = self.origin
+            pos = (i % self.width + ox, i // self.width + oy)
+            (has_key, has_used_key) = (False, False)
+        for entry in self.pending:
+            new_pos = rules.step(pos, entry[1])
+            # we cannot tell what is outside the viewport, so no move there
+            i = self.viewIndex(new_pos)
+            if i is not None:
+                sym = self.board[i]
+                occupied = sym in rules.PLAYER_BYTES and sym != own
+                if rules.canEnter(sym, has_key, has_used_key, occupied):
+                    (has_key, has_used_key) = rules.inventoryAfter(sym, has_key, has_used_key)
+                    pos = new_pos
+            if entry[3] is None:
+                entry[3] = pos
+        self.predicted = pos
+
+    def displayBoard(self):
+        """ The board to draw: the server's board with our player moved
+            to where our pending inputs put it
+        """
+        if self.predicted is None:
+            return self.board
+        own = self.ownSymbol()
+        board = bytearray(self.board)
+        i = board.find(own)
+        if i >= 0:
+            board[i] = rules.EMPTY
+        i = self.viewIndex(self.predicted)
+        if i is not None:
+            board[i] = own
+        return board
+
+class Renderer():
+    """ Draws the board incrementally. It remembers what is on the
+        terminal and only writes the parts of rows that changed, staging
+        them with noutrefresh and pushing them with a single doupdate.
+        The win animation runs on its own thread so drawing it never
+        holds up receiving from the server.
+    """
+    def __init__(self, screen):
+        self.screen = screen
+        # curses is not thread safe, everything that draws holds this
+        self.lock = threading.Lock()
+        # what the terminal currently shows, None forces a full redraw
+        self.drawn = None
+        self.drawn_width = WIDTH
+        self.drawn_height = HEIGHT
+        self.drawn_message = None
+        self.animating = False
+
+    def drawSpan(self, y, x, data):
+        try:
+            self.screen.addstr(y, x, data)
+        except curses.error:
+            # off the edge of a small terminal, or the bottom-right cell
+            pass
+
+    def drawBoard(self, board, width, message):
+        """ Bring the terminal up to date with the board
+
+        Args:
+            board : The row-major board bytes
+            width : The width of a board row
+            message : The message line from the server
+        """
+        with self.lock:
+            if self.animating:
+                return
+            drawn = self.drawn
+            if drawn is None or self.drawn_width != width or len(drawn) != len(board):
+                self.screen.erase()
+                drawn = self.drawn = bytearray(b" " * len(board))
+                self.drawn_width = width
+                self.drawn_height = len(board) // width
+                self.drawn_message = None
+            for y in range(self.drawn_height):
+                start = y * width
+                end = start + width
+                if board[start:end] == drawn[start:end]:
+                    continue
+                # redraw from the first to the last changed cell of the row
+                first = start
+                while board[first] == drawn[first]:
+                    first += 1
+                last = end - 1
+                while board[last] == drawn[last]:
+                    last -= 1
+                self.drawSpan(y, first - start, bytes(board[first:last + 1]))
+                drawn[first:last + 1] = board[first:last + 1]
+            if message != self.drawn_message:
+                self.drawMessage(message)
+            self.screen.noutrefresh()
+            curses.doupdate()
+
+    def drawMessage(self, message):
+        """ Replace the info line under the board, "@" means no message.
+            Call with the lock held.
+        """
+        self.drawn_message = message
+        text = "" if message[0] == "@" else message.strip()
+        self.drawSpan(self.drawn_height, 0, text.ljust(self.drawn_width)[:self.drawn_width])
+
+    def showMessage(self, message):
+        """ Show a message from the client itself, like connection errors
+        """
+        with self.lock:
+            self.drawMessage(message)
+            self.screen.noutrefresh()
+            curses.doupdate()
+
+    def startWinAnimation(self):
+        """ Start the win animation without blocking the caller
+        """
+        with self.lock:
+            if self.animating:
+                return
+            self.animating = True
+            self.screen.erase()
+            # the board has to be drawn from scratch after the animation
+            self.drawn = None
+        start_new_thread(winScreen, (self,))
+
+class TcpLink():
+    """ The TCP connection to the server, replaced by a new one when
+        the connection drops and we get back in
+    """
+    def __init__(self, host, port, room_code, role, view, method):
+        """
+        Args:
+            host, port : The server address
+            room_code, role, view, method : What to send in the JOIN,
+                                            see protocol.encodeJoin
+        """
+        self.address = (host, port)
+        self.room_code = room_code
+        self.role = role
+        self.view = view
+        self.method = method
+        self.sock = None
+
+    def connect(self, state=None):
+        """ Open a new connection and send the JOIN. With the state of
+            a player that had joined, the JOIN resumes its session and
+            the inputs the server has not acknowledged are sent again.
+        """
+        sock = socket.create_connection(self.address)
+        # without Nagle's delay our inputs leave right away
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        old = self.sock
+        if state is None or state.room_code is None:
+            sock.sendall(protocol.encodeJoin(self.room_code, self.role, self.view,
+                                             self.method))
+            self.sock = sock
+        else:
+            # under the lock, so no input goes to the old connection
+            # after we collected the pending ones
+            with state.lock:
+                resume = None
+                if state.token is not None:
+                    resume = (state.token, state.version, state.origin)
+                sock.sendall(b"".join([
+                    protocol.encodeJoin(state.room_code, self.role, self.view,
+                                        self.method, resume),
+                    *(protocol.encodeInput(entry[1], entry[0]) for entry in state.pending)]))
+                self.sock = sock
+        if old is not None:
+            old.close()
+
+    def sendall(self, data):
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            pass    # the listener notices and reconnects
 
-def listenerDrawer(screen, sock):
+    def close(self):
+        self.sock.close()
+
+def reconnect(link, state, renderer):
+    """ Try to get back into our room after the connection dropped
+
+    Returns:
+        Boolean: True if we are connected again
+    """
+    if state.room_code is None:
+        return False
+    renderer.showMessage("Lost connection to server, reconnecting...")
+    deadline = time.monotonic() + RECONNECT_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            link.connect(state)
+            return True
+        except OSError:
+            time.sleep(RECONNECT_INTERVAL)
+    return False
+
+def listenerDrawer(link, state, renderer):
     """ Listen for server messages and draw a new screen
-        when we receive a new string from the server
+        when the board changes
 
     Args:
-        screen : The ncurses window
-        sock : Socket that has settings etc when passed to this function
+        link : The TcpLink to the server
+        state : The BoardState, shared with the input loop
+        renderer : The Renderer of the ncurses window
     """
+    reader = protocol.FrameReader()
+    decompressor = compression.Decompressor()
+    # reused for every recv, the frame reader copies what it keeps
+    recv_buffer = bytearray(65536)
     while True:
         try:
-            received = ""
             #receive message from server
-            while(len(received) < TOTAL_SIZE):
-                received += sock.recv(TOTAL_SIZE - len(received)).decode("utf-8")
-
-            screen.clear()
-            if(received[0] == "W"):
-                winScreen(screen)
-            else:
-                #board graphics
-                gameString = received[0:(WIDTH * HEIGHT)]
-                #info message
-                message = received[(WIDTH * HEIGHT):]
-                #display new board and message
-                stringToBoard(gameString, screen)
-                addServerMessageToBoard(message, screen)
-                screen.refresh()
+            nbytes = link.sock.recv_into(recv_buffer)
+            if not nbytes:
+                raise ConnectionError("Server closed the connection")
+            frames = decompressor.expand(reader.feed(memoryview(recv_buffer)[:nbytes]))
+            if not applyFrames(frames, state, renderer):
+                # we missed something, ask for the full state
+                link.sendall(protocol.encodeSync())
+        except ConnectionRefusedError as e:
+            renderer.showMessage(f"Server refused us: {e}")
+            return
+        except (ConnectionError, OSError):
+            if not reconnect(link, state, renderer):
+                renderer.showMessage("Lost connection to server")
+                return
+            # a new connection starts a new frame and zlib stream
+            reader = protocol.FrameReader()
+            decompressor = compression.Decompressor()
         except:
-            error_message = "Error while receiving data from server"
-            filler = " " * (WIDTH - len(error_message))
-            error_message = error_message + filler
-            addServerMessageToBoard(error_message, screen)
+            renderer.showMessage("Error while receiving data from server")
             continue
 
-def winScreen(screen):
-    """ When game is over, this function display the winner message
-        on the ncurses screen.
+def udpListenerDrawer(sock, session, state, renderer):
+    """ listenerDrawer for the UDP transport: every datagram is applied
+        on its own and acknowledged with our pending inputs, a lost one
+        needs no SYNC since the next one covers it
 
     Args:
-        screen : The ncurses window
+        sock : The connected UDP socket
+        session : The udp.UdpSession
+        state : The BoardState, shared with the input loop
+        renderer : The Renderer of the ncurses window
     """
-    for i in range(HEIGHT):
-        screen.addstr(i, 35, "WINNER!", curses.A_BLINK)
-        time.sleep(0.5)
-        screen.refresh()
+    while True:
+        try:
+            data = sock.recv(65536)
+            frames = session.receive(data)
+            if frames:
+                applyFrames(frames, state, renderer)
+                with state.lock:
+                    sock.send(session.inputs(state))
+            elif session.session is None:
+                # a challenge, the HELLO with its cookie joins
+                sock.send(session.hello())
+        except ConnectionRefusedError as e:
+            renderer.showMessage(f"Server refused us: {e}")
+            return
+        except ConnectionError:
+            # a refused datagram, the server may not be up yet
+            continue
+        except:
+            renderer.showMessage("Error while receiving data from server")
+            continue
 
-def addServerMessageToBoard(message, screen):
-    """ Add the info message from server to the terminal with curses
+def udpKeepalive(sock, session, state):
+    """ Send HELLO until the server answers, then keep the session
+        alive with an INPUTS datagram every KEEPALIVE_INTERVAL seconds
+    """
+    while not session.closed:
+        try:
+            with state.lock:
+                joined = state.player is not None
+                datagram = session.inputs(state) if joined else session.hello()
+            sock.send(datagram)
+        except OSError:
+            pass
+        time.sleep(udp.KEEPALIVE_INTERVAL if joined else udp.HELLO_INTERVAL)
+
+def applyFrames(frames, state, renderer):
+    """ Apply the received frames and draw what changed
+
+    Returns:
+        Boolean: False if we missed something and need a new keyframe
+
+    Raises:
+        ConnectionRefusedError: if the server sent an ERROR
+    """
+    redraw = False
+    in_sync = True
+    with state.lock:
+        for (kind, payload) in frames:
+            if kind == protocol.WIN:
+                renderer.startWinAnimation()
+            elif kind == protocol.ERROR:
+                raise ConnectionRefusedError(payload.decode("utf-8", "replace"))
+            elif state.applyFrame(kind, payload):
+                redraw = True
+            else:
+                in_sync = False
+        board = state.displayBoard()
+    #display new board and message, only what changed is drawn
+    if redraw:
+        renderer.drawBoard(board, state.width, state.message)
+    return in_sync
+
+def winScreen(renderer):
+    """ When game is over, this function display the winner message
+        on the ncurses screen. Runs on its own thread.
 
     Args:
-        message : At most 80 chars in a string from server
-        screen : The ncurses window
+        renderer : The Renderer of the ncurses window
     """
-    if(message[0] == "@"):
-        pass
-    else:
-        message = message.strip()
-        screen.addstr(HEIGHT, 0, message)
+    for i in range(renderer.drawn_height):
+        with renderer.lock:
+            renderer.drawSpan(i, 35, "WINNER!")
+            renderer.screen.noutrefresh()
+            curses.doupdate()
+        time.sleep(0.5)
+    with renderer.lock:
+        renderer.animating = False
 
-def main(screen):
+def main(screen, host=HOST, port=PORT, room_code="", spectate=False, use_udp=False,
+         method=protocol.COMPRESS_RLE):
     """ Contains the main loop for the client, which accepts user
         input as keyboard presses on the "wasd" keys.
 
     Args:
         screen : The ncurses window
+        host, port : The server address
+        room_code : The room to join, "" to join any room
+        spectate : Watch the room instead of playing, keys are ignored
+        use_udp : Talk to the server over UDP, see udp.py
+        method : The compression to ask for, see compression.py
 
     Raises:
         e:  Raises any error another level so it can be caught
@@ -97,32 +532,71 @@ def main(screen):
 
     """
     screen.clear()
-    if(curses.LINES < HEIGHT or curses.COLS < WIDTH):
-        screen.addstr(0,0, "Your terminal window is too small to display the board")
-        screen.addstr(2,0, "Please resize it and restart this program")
+    # the server sends the part of the board that fits the terminal,
+    # the last line is for messages
+    view = (curses.COLS, curses.LINES - 1)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        sock.connect((HOST, PORT))
+    role = protocol.ROLE_SPECTATOR if spectate else protocol.ROLE_PLAYER
+    state = BoardState()
+    renderer = Renderer(screen)
+    if use_udp:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+        session = udp.UdpSession(room_code, role, view, method)
+        start_new_thread(udpListenerDrawer, (sock, session, state, renderer))
+        start_new_thread(udpKeepalive, (sock, session, state))
+    else:
+        sock = TcpLink(host, port, room_code, role, view, method)
+        sock.connect()
         #start a thread that listens and draws
-        start_new_thread(listenerDrawer, (screen, sock))
-        try:
-            #send correct direction to server base on use input
-            while True:
-                userInput = screen.getkey() # this does a refresh
-                if userInput == "w":
-                    userInput = "up"
-                elif userInput == "a":
-                    userInput = "left"
-                elif userInput == "s":
-                    userInput = "down"
-                elif userInput == "d":
-                    userInput = "right"
-                else:   #nothing happens if you didn't press "wasd"
-                    continue
-                byte_message = bytes(userInput, 'utf-8')
-                sock.sendall(byte_message)
-        except Exception as e:
-            raise e
+        start_new_thread(listenerDrawer, (sock, state, renderer))
+    try:
+        #send correct direction to server base on use input
+        while True:
+            userInput = screen.getkey() # this does a refresh
+            if userInput == "w":
+                userInput = "up"
+            elif userInput == "a":
+                userInput = "left"
+            elif userInput == "s":
+                userInput = "down"
+            elif userInput == "d":
+                userInput = "right"
+            else:   #nothing happens if you didn't press "wasd"
+                continue
+            if spectate:
+                continue
+            # move our player now, the server corrects us if we were wrong
+            with state.lock:
+                seq = state.predictMove(userInput)
+                board = state.displayBoard()
+                if use_udp:
+                    # repeats the inputs that are not acknowledged yet
+                    sock.send(session.inputs(state))
+                else:
+                    sock.sendall(protocol.encodeInput(userInput, seq))
+            renderer.drawBoard(board, state.width, state.message)
+    except Exception as e:
+        raise e
+    finally:
+        sock.close()
 
 if __name__ == "__main__":
-    curses.wrapper(main)
+    parser = argparse.ArgumentParser(description="Game client")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--room", default="",
+                        help="room code to play in, leave out to join any game")
+    parser.add_argument("--spectate", action="store_true",
+                        help="watch the room given with --room instead of playing")
+    parser.add_argument("--udp", action="store_true",
+                        help="use the UDP transport, the server needs --udp too")
+    parser.add_argument("--compression", choices=compression.METHODS, default="rle",
+                        help="how the server should compress the board updates")
+    args = parser.parse_args()
+    try:
+        protocol.checkRoomCode(args.room)
+    except ValueError as e:
+        parser.error(str(e))
+    curses.wrapper(main, args.host, args.port, args.room, args.spectate, args.udp,
+                   compression.METHODS[args.compression])
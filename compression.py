@@ -0,0 +1,230 @@
+""" Compression of state frames, asked for by the client in its JOIN.
+
+Boards are mostly spaces and runs of walls, so KEYFRAME and DELTA frames
+can be sent wrapped in one of two frame types, see protocol.py:
+
+    RLE  'R': a whole frame, header included, run-length encoded.
+              Stateless, so a frame broadcast to many clients is
+              encoded once and the same bytes are sent to all of them.
+    ZLIB 'Z': a piece of a zlib stream that lasts as long as the
+              connection, flushed after every frame. It compresses
+              better since it remembers what was sent before, but every
+              client needs its own stream, so it costs CPU per client.
+
+The run-length encoding works on bytes, like PackBits: a control byte
+c < 128 is followed by c + 1 literal bytes, a control byte c >= 128 by
+one byte to repeat c - 125 times (3 to 130).
+
+The compressed frames say what they are, the client only needs a
+Decompressor in front of its frame handling. UDP datagrams may be lost,
+so the UDP transport uses RLE when a client asks for zlib.
+
+    python compression.py --width 1000 --height 1000
+
+compares the size and encoding time of the methods on generated boards.
+"""
+import argparse
+import random
+import re
+import time
+import zlib
+
+import game
+import metrics
+import protocol
+import viewport
+
+ZLIB_LEVEL = 6
+RLE_CACHE_SIZE = 256    # encoded frames kept for other clients
+MIN_SIZE = 32           # smaller frames are not worth compressing
+
+# --compression choices of the client, bot and bench
+METHODS = {"none": protocol.COMPRESS_NONE,
+           "rle": protocol.COMPRESS_RLE,
+           "zlib": protocol.COMPRESS_ZLIB}
+
+# a byte repeated at least 3 times
+RUN = re.compile(rb"(.)\1{2,}", re.S)
+
+compress_time = metrics.histogram("serialize.compress")
+bytes_saved = metrics.counter("compression.saved")
+
+def rleEncode(data):
+    """ Run-length encode bytes, see the module docstring for the format
+    """
+    out = bytearray()
+    def literal(chunk):
+        for i in range(0, len(chunk), 128):
+            piece = chunk[i:i + 128]
+            out.append(len(piece) - 1)
+            out.extend(piece)
+
+    pos = 0
+    for m in RUN.finditer(data):
+        (start, end) = m.span()
+        literal(data[pos:start])
+        byte = data[start]
+        n = end - start
+        while n >= 3:
+            k = min(n, 130)
+            out.append(k + 125)
+            out.append(byte)
+            n -= k
+        # 1 or 2 bytes left over from a long run
+        literal(data[end - n:end])
+        pos = end
+    literal(data[pos:])
+    return bytes(out)
+
+def rleDecode(data):
+    """ Undo rleEncode
+
+    Raises:
+        protocol.ProtocolError: if the data ends in the middle of a token
+    """
+    out = bytearray()
+    i = 0
+    end = len(data)
+    while i < end:
+        c = data[i]
+        if c < 128:
+            if i + 2 + c > end:
+                raise protocol.ProtocolError("Truncated RLE literal")
+            out += data[i + 1:i + 2 + c]
+            i += 2 + c
+        else:
+            if i + 2 > end:
+                raise protocol.ProtocolError("Truncated RLE run")
+            out += bytes((data[i + 1],)) * (c - 125)
+            i += 2
+    return bytes(out)
+
+# frame -> its RLE frame, frames shared by many clients are the same
+# bytes object, so after the first lookup the hash is cached
+rle_frames = {}
+
+def rleFrame(frame):
+    """ The RLE frame of a frame, or the frame itself if that is not smaller
+    """
+    encoded = rle_frames.get(frame)
+    if encoded is None:
+        with compress_time.time():
+            packed = protocol.encodeFrame(protocol.RLE, rleEncode(frame))
+        encoded = packed if len(packed) < len(frame) else frame
+        if len(rle_frames) >= RLE_CACHE_SIZE:
+            rle_frames.clear()
+        rle_frames[frame] = encoded
+    return encoded
+
+def choose(requested, stateless=False):
+    """ The method the server uses for a client
+
+    Args:
+        requested : The method from the JOIN
+        stateless : The transport may lose frames, like UDP
+
+    Returns:
+        int: protocol.COMPRESS_NONE, COMPRESS_RLE or COMPRESS_ZLIB
+    """
+    if requested == protocol.COMPRESS_ZLIB and stateless:
+        return protocol.COMPRESS_RLE
+    if requested in (protocol.COMPRESS_RLE, protocol.COMPRESS_ZLIB):
+        return requested
+    return protocol.COMPRESS_NONE
+
+class Compressor():
+    """ Compresses the state frames sent to one client. With zlib the
+        frames have to go through it in the order they are sent.
+    """
+    def __init__(self, method=protocol.COMPRESS_NONE):
+        self.method = method
+        self.stream = None
+        if method == protocol.COMPRESS_ZLIB:
+            self.stream = zlib.compressobj(ZLIB_LEVEL)
+
+    def encode(self, frame):
+        """
+        Returns:
+            bytes: The frame to send in place of frame
+        """
+        method = self.method
+        if (method == protocol.COMPRESS_NONE or len(frame) < MIN_SIZE or
+                frame[0] not in (protocol.KEYFRAME, protocol.DELTA)):
+            return frame
+        if method == protocol.COMPRESS_RLE:
+            encoded = rleFrame(frame)
+        else:
+            with compress_time.time():
+                data = self.stream.compress(frame) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+            encoded = protocol.encodeFrame(protocol.ZLIB, data)
+        bytes_saved.inc(len(frame) - len(encoded))
+        return encoded
+
+class Decompressor():
+    """ The client side: unwraps RLE and ZLIB frames
+    """
+    def __init__(self):
+        self.stream = None
+
+    def expand(self, frames):
+        """
+        Args:
+            frames : (type, payload) tuples from a FrameReader
+
+        Returns:
+            list: The frames with the compressed ones replaced by what they hold
+        """
+        out = []
+        for (kind, payload) in frames:
+            if kind == protocol.RLE:
+                data = rleDecode(payload)
+            elif kind == protocol.ZLIB:
+                if self.stream is None:
+                    self.stream = zlib.decompressobj()
+                data = self.stream.decompress(payload)
+            else:
+                out.append((kind, payload))
+                continue
+            out.extend(protocol.FrameReader().feed(data))
+        return out
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare frame sizes and encoding time of the compression methods")
+    parser.add_argument("--width", type=int, default=80)
+    parser.add_argument("--height", type=int, default=30)
+    parser.add_argument("--moves", type=int, default=2000,
+                        help="random moves to collect deltas from")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    g = game.Game(args.width, args.height)
+    g.initBoard()
+    view = viewport.Viewport(g.width, g.height)
+    view.centerOn(g.players[1].pos)
+    keyframes = {"keyframe (whole board)": [protocol.encodeKeyframe(g.snapshot)],
+                 "keyframe (80x30 view)": [protocol.encodeKeyframe(g.snapshot, view.rect())]}
+    deltas = []
+    for i in range(args.moves):
+        g.makeMove(rng.choice(protocol.DIRECTIONS), rng.randint(1, 2))
+        delta = g.takeDelta()
+        if delta is not None:
+            deltas.append(protocol.encodeDelta(delta))
+    keyframes["deltas"] = deltas
+
+    print(f"{args.width}x{args.height} board")
+    for name, frames in keyframes.items():
+        raw = sum(len(f) for f in frames)
+        print(f"{name}: {len(frames)} frames, raw {raw} bytes")
+        for method, label in ((protocol.COMPRESS_RLE, "rle"), (protocol.COMPRESS_ZLIB, "zlib")):
+            rle_frames.clear()
+            c = Compressor(method)
+            start = time.perf_counter()
+            size = sum(len(c.encode(f)) for f in frames)
+            elapsed = time.perf_counter() - start
+            print(f"    {label:5} {size:9} bytes ({size / raw * 100:5.1f}%)  "
+                  f"{elapsed / len(frames) * 1e6:8.1f} us per frame")
+
+if __name__ == "__main__":
+    main()
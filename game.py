@@ -1,29 +1,103 @@
-import math
-import random
+import logging
 import time
 
+import mapgen
+import rules
+import timers
+# the cell symbols and movement rules are shared with the client
+from rules import EMPTY, WALL, KEY, GATE, CHEST, PLAYER_SYMBOLS
+
+# the message line is as wide as the board, up to this many characters
+MESSAGE_WIDTH = 80
+MESSAGE_TIME = 5    # seconds a message stays on the message line
+
+log = logging.getLogger("game")
+
+class Player():
+    """ State of one player. Games with many players keep many of these,
+        __slots__ keeps them small and attribute access fast.
+    """
+    __slots__ = ("number", "symbol", "pos", "key", "has_used_key")
+
+    def __init__(self, number, symbol, pos=(1, 1)):
+        self.number = number
+        self.symbol = symbol
+        self.pos = pos
+        self.key = None
+        self.has_used_key = False
+
+    def __repr__(self):
+        return (f"Player({self.number}, pos={self.pos}, key={self.key}, "
+                f"has_used_key={self.has_used_key})")
+
+class Snapshot():
+    """ A published version of the game state that never changes, so
+        any thread can read and serialize it without holding a lock.
+
+        The board is a tuple of row bytes objects. Publishing the next
+        snapshot copies only the rows that changed and shares the others
+        with the previous one, so it costs O(height) and not a copy of
+        the whole board.
+    """
+    __slots__ = ("version", "width", "height", "rows", "message", "winner",
+                 "players", "board_cache")
+
+    def __init__(self, version, width, height, rows, message, winner, players):
+        """
+        Args:
+            version : The state version, see Game.takeDelta
+            width, height : The board dimensions
+            rows : Tuple of height bytes objects of width cells each
+            message : The message line
+            winner : True if someone has won
+            players : Tuple of (pos, has_key, has_used_key) by player number - 1
+        """
+        self.version = version
+        self.width = width
+        self.height = height
+        self.rows = rows
+        self.message = message
+        self.winner = winner
+        self.players = players
+        self.board_cache = None
+
+    def __repr__(self):
+        return f"Snapshot(version={self.version}, {self.width}x{self.height})"
+
+    def boardBytes(self):
+        """ The row-major board as bytes, joined once and then shared by
+            every keyframe of this snapshot
+        """
+        if self.board_cache is None:
+            self.board_cache = b"".join(self.rows)
+        return self.board_cache
+
+    def region(self, x, y, width, height):
+        """ The row-major bytes of the width x height cells at (x, y)
+        """
+        if (x, width) == (0, self.width):
+            return b"".join(self.rows[y:y + height])
+        return b"".join(row[x:x + width] for row in self.rows[y:y + height])
+
 class Game():
     """ The main game object which contains current state like player positions,
         whether they have used any keys etc.
     """
-    def __init__(self, width, height, p1_symbol='1', p2_symbol='2'):
-        # dict with player info
-        self.players = {
-            '1': {
-                'pos': (1, 1),
-                'symbol' : p1_symbol,
-                'key': None,
-                'power-up': None,
-                'has_used_key': False
-            },
-            '2': {
-                'pos': (1, 1),
-                'symbol' : p2_symbol,
-                'key': None,
-                'power-up': None,
-                'has_used_key': False
-            }
-        }
+    def __init__(self, width, height, num_players=2, clock=time.time):
+        """
+        Args:
+            width, height : The board dimensions
+            num_players : Number of players
+            clock : Function returning the current time in seconds,
+                    a replay passes one returning the recorded times
+        """
+        if not 0 < num_players <= len(PLAYER_SYMBOLS):
+            raise ValueError(f"A game has 1 to {len(PLAYER_SYMBOLS)} players")
+        # player number -> Player, positions are set by initBoard
+        self.players = {n: Player(n, PLAYER_SYMBOLS[n - 1])
+                        for n in range(1, num_players + 1)}
+        # (x, y) -> the Player standing there
+        self.occupants = {}
 
         # board dimensions
         self.width = width
@@ -31,60 +105,89 @@ class Game():
         
         self.chest_x = 0
         self.chest_y = 0
+        # seed of the map, the same seed gives the same board
+        self.seed = None
 
         self.winner = False
 
-        # message that may be displayed at the bottom 
-        self.message = "@" * self.width
-        self.messageTimer = 0
+        self.clock = clock
+        # gets every move made, see replay.Recorder
+        self.recorder = None
 
-        self.board = [[" " for y in range(height)] 
-                               for x in range(width)] 
+        # timed events, in the time of self.clock, see advance()
+        self.timers = timers.TimerWheel()
 
-        # x and y delta for each direction key
-        self.direction_dict = {
-            'up': (0, -1),
-            'down': (0, 1),
-            'left': (-1, 0),
-            'right': (1, 0)
-        }
+        # message that may be displayed at the bottom 
+        self.message_width = min(width, MESSAGE_WIDTH)
+        self.message = "@" * self.message_width
+        # the Timer resetting the message
+        self.messageReset = None
+
+        # state version, bumped every time a delta is taken
+        self.version = 0
+        # cells changed since the last delta, (x, y) -> symbol before the change
+        self.dirty = {}
+        self.messageDirty = False
+
+        # row-major, the cell (x, y) is at index y * width + x
+        self.board = bytearray(b" " * (width * height))
+        # rows changed since the last snapshot
+        self.changed_rows = set()
+        # the latest published state, replaced by publish() and never
+        # modified, readers only need to read the attribute once
+        self.snapshot = Snapshot(0, width, height,
+                                 tuple(bytes(self.board[y * width:(y + 1) * width])
+                                       for y in range(height)),
+                                 self.message, False, ())
 
     def set_player_position(self, player, pos):
-        #set current player position 
-        self.players[player]['pos'] = pos
+        #set current player position and move its symbol on the board
+        p = self.players[int(player)]
+        if self.occupants.get(p.pos) is p:
+            del self.occupants[p.pos]
+            self.insertInBoard(p.pos, ' ')
+        p.pos = pos
+        self.occupants[pos] = p
+        self.insertInBoard(pos, p.symbol)
     
     def get_player_position(self, player):
         #get current player position
-        return self.players[player]['pos']
-
-    def initBoard(self):
-        """ Initiates the board by drawing its edges with blocking "#"s.
-            Then adds the objects to it, which are:
-            1. The chest
-            2. The players
-            3. Some random obstacles
-            4. The keys
+        return self.players[int(player)].pos
+
+    def initBoard(self, board_map=None):
+        """ Loads a generated map, see mapgen.py, and adds the players to it.
+            The map has the walls around the edges, the chest,
+            some random obstacles and the keys.
+
+        Args:
+            board_map : A mapgen.Map of the same size as the game,
+                        a new one is generated if None
         """
-        for i in range(self.height):
-            self.board[0][i] = "#"
-            self.board[self.width - 1][i] = "#"
-        for i in range(self.width):
-            self.board[i][0] = "#"
-            self.board[i][self.height - 1] = "#"
-
-        (self.chest_x, self.chest_y) = self.addChestToBoard()
-        self.addPlayersToBoard()
-        self.addRandomObstacles(30)
-        self.addKeys()
+        if board_map is None:
+            board_map = mapgen.generateMap(self.width, self.height,
+                                           players=len(self.players))
+        if (board_map.width, board_map.height) != (self.width, self.height):
+            raise ValueError(f"A {board_map.width}x{board_map.height} map does not "
+                             f"fit a {self.width}x{self.height} game")
+        self.board[:] = board_map.board
+        self.seed = board_map.seed
+        (self.chest_x, self.chest_y) = board_map.chest
+        self.addPlayersToBoard(board_map.spawns)
+        # the initial board goes out as a keyframe, not as a delta
+        self.dirty.clear()
+        self.messageDirty = False
+        self.changed_rows = set(range(self.height))
+        self.publish()
 
     def printBoard(self):
-        """ Prints the board on the server console for logging
-            and debugging purposes.
+        """ Logs the published board at debug level for debugging purposes.
+            Safe to call without holding the lock of the game.
         """
-        for i in range(self.height):
-            for j in range(self.width):
-                print(self.board[j][i], end='')
-            print('')
+        if not log.isEnabledFor(logging.DEBUG):
+            return
+        snapshot = self.snapshot
+        log.debug("Board at version %d:\n%s", snapshot.version,
+                  "\n".join(row.decode() for row in snapshot.rows))
         
     def insertInBoard(self, pos, symbol):
         """ Insert symbol at position (x, y) on the board
@@ -94,261 +197,173 @@ class Game():
             symbol: The character to be inserted
         """
         (x, y) = pos
-        if(x >= 0 and x <= self.width and
-           y >= 0 and y <= self.height):
-            self.board[x][y] = symbol
-    
-    def addTuples(self, a, b):
-        """ Add first arg to first arg and 
-            second arg to second arg of two tuples
-        """
-        return (a[0] + b[0], a[1] + b[1])
-    
-    def isPlayerSym(self, c):
-        """ Check if c is a player symbol
-
-        Args:
-            c : A character
-
-        Returns:
-            Boolean: true or false
-        """
-        for key in self.players:
-            if c == self.players[key]['symbol']:
-                return True
-        return False
+        if(x >= 0 and x < self.width and
+           y >= 0 and y < self.height):
+            i = y * self.width + x
+            old = self.board[i]
+            value = ord(symbol)
+            if old != value:
+                # remember the first symbol so a cell that is changed
+                # and then changed back does not end up in the delta
+                self.dirty.setdefault(pos, old)
+                self.board[i] = value
+                self.changed_rows.add(y)
     
-    def setMessage(self, message):
-        """ Set a message(< 80 chars) to be displayed under the board in client
+    def setMessage(self, message, now=None):
+        """ Set a message(< message_width chars) to be displayed under the board in client
 
         Args:
             message : The string to be displayed
+            now : The current time, read from the clock if None
         """
-        if len(message) < self.width:
-            self.messageTimer = time.time()
-            filler = " " * (self.width - len(message))
+        if len(message) < self.message_width:
+            now = self.clock() if now is None else now
+            filler = " " * (self.message_width - len(message))
             self.message = message + filler
+            self.messageDirty = True
+            if self.messageReset is not None:
+                self.messageReset.cancel()
+            self.messageReset = self.timers.schedule(now, MESSAGE_TIME, self.resetMessage)
         else:
-            print("That message is too big!")
+            log.warning("That message is too big!")
     
     def resetMessage(self):
         """ Reset the message so nothing appears under board in client
         """
-        self.message = "@" * self.width
+        self.messageReset = None
+        if self.message[0] != "@":
+            self.message = "@" * self.message_width
+            self.messageDirty = True
 
-    def validMove(self, player, pos):
-        """ Checks to see if a player is trying to make a valid move,
-            for example the player cannot move to a position marked with "#"
+    def advance(self, now=None):
+        """ Fire the timers that are due, like the reset of an old
+            message. Every move advances them to its time, the asyncio
+            engine also calls this every tick so they fire on time when
+            nobody moves.
 
         Args:
-            player : The player moving (1 or 2)
-            pos : Tuple with (x,y) coords the player is moving to
+            now : The current time, read from the clock if None
+        """
+        self.timers.advance(self.clock() if now is None else now)
+
+    def takeDelta(self):
+        """ Collect the cells that changed since the last call and
+            start a new version of the state.
 
         Returns:
-            Boolean: True if move possible, false otherwise
-        """        
-        (x, y) = pos
-        current_sym = self.board[x][y]
-
-        on_key_has_key = (current_sym == 'K' and self.players[player]['key'])
-        on_key_has_used_key = (current_sym == 'K' and self.players[player]['has_used_key'])
-        on_gate_no_key = (current_sym == '=' and (not self.players[player]['key']))
-
-        #we can't go to the next position if it is:
-        #1, a '#' symbol (wall)
-        #2, a 'K' (key) and the player already picked up a key
-        #3, a 'K' (key) and the player has already used a key
-        #4, another player
-        #5, a gate and the player has no key
-        if (current_sym == '#' 
-            or on_key_has_key
-            or on_key_has_used_key
-            or self.isPlayerSym(current_sym) 
-            or on_gate_no_key):
-            return False
-
-        return True
-
-    def addChestToBoard(self):
-        """ Add the chest container to the board.
-            Taking the chest is the goal of the game
+            tuple: (version, [(x, y, byte value), ...], message or None)
+                   or None if nothing changed
+        """
+        board = self.board
+        w = self.width
+        cells = [(x, y, board[y * w + x])
+                 for (x, y), old in self.dirty.items()
+                 if board[y * w + x] != old]
+        self.dirty.clear()
+        message = self.message if self.messageDirty else None
+        self.messageDirty = False
+        if not cells and message is None:
+            return None
+        self.version += 1
+        self.publish()
+        return (self.version, cells, message)
+
+    def publish(self):
+        """ Replace the snapshot with one of the current state. The new
+            snapshot is built completely before it is assigned, so a reader
+            on another thread sees either the old or the new one.
 
         Returns:
-            tuple: Coords to where the chest was randomly inserted
-        
-        The chest container has an outer rim and an inner rim,
-        and there are gates that require a key to open, marked with "="
-        like the figure below:
-        ###############
-        #             #   
-        #  #########  #
-        #  #       #  #
-        =  #   *   =  #
-        #  #       #  #
-        #  #########  #
-        #             #
-        ###############
+            Snapshot: The new snapshot
         """
-        chestWidth = 15
-        chestHeight = 9
-        innerChestWidth = 9
-        innerChestHeight = 5
-
-        (random_x, random_y) = self.getRandomChestPos(chestWidth, chestHeight)
-
-        #add borders to chest container
-        for x in range(chestWidth):
-            #upper row
-            self.board[random_x + x][random_y] = "#"
-            #lower row
-            self.board[random_x + x][random_y + chestHeight -1] = "#"
-        for x in range(innerChestWidth):
-            #inner upper row
-            self.board[random_x + 3 + x][random_y + 2] = "#"
-            #inner lower row
-            self.board[random_x + 3 + x][random_y + innerChestHeight + 1] = "#"
-        for y in range(chestHeight):
-            #left column
-            self.board[random_x][random_y + y] = "#"
-            #right column
-            self.board[random_x + chestWidth -1][random_y + y] = "#"
-        for y in range(innerChestHeight):
-            #inner left column
-            self.board[random_x + 3][random_y + 2 + y] = "#"
-            #inner right column
-            self.board[random_x + 2 + innerChestWidth][random_y + 2 + y] = "#"
-        
-        outer_gate_y = random_y + 4
-        inner_gate_x = random_x + chestWidth - 4 
-        #add gates to chest container
-        self.board[random_x][random_y + 4] = "="
-        self.board[inner_gate_x][random_y + 4] = "="
-        # self.board[random_x + 7][random_y + 4] = "*"
-        return (random_x, random_y)
-
-    def getRandomChestPos(self, width, height):
-        """ Helper function to get a random starting position 
-            for the chest container in a specific range 
+        previous = self.snapshot
+        rows = previous.rows
+        if self.changed_rows:
+            w = self.width
+            board = self.board
+            rows = list(rows)
+            for y in self.changed_rows:
+                rows[y] = bytes(board[y * w:(y + 1) * w])
+            rows = tuple(rows)
+            self.changed_rows.clear()
+        players = tuple((p.pos, bool(p.key), p.has_used_key)
+                        for p in self.players.values())
+        self.snapshot = Snapshot(self.version, self.width, self.height, rows,
+                                 self.message, self.winner, players)
+        return self.snapshot
+
+    def validMove(self, player, pos, sym):
+        """ Checks to see if a player is trying to make a valid move,
+            for example the player cannot move to a position marked with "#"
 
         Args:
-            width  : The total width of the chest
-            height : The total height of the chest
+            player : The player number
+            pos : Tuple with (x,y) coords the player is moving to
+            sym : The symbol on pos as a byte value
 
         Returns:
-            tuple: Coords to where the chest should be inserted
-        """
-        min_pos = (10, 10)
-        max_pos = (self.width - width - 1,
-                   self.height - height - 1)
-        random_x = random.randint(min_pos[0], max_pos[0])
-        random_y = random.randint(min_pos[1], max_pos[1])
+            Boolean: True if move possible, false otherwise
+        """        
+        p = self.players[int(player)]
+        return rules.canEnter(sym, p.key, p.has_used_key,
+                              pos in self.occupants)
 
-        return (random_x, random_y)
+    def addPlayersToBoard(self, spawns):
+        """ Puts every player on its spawn point
 
-    def addPlayersToBoard(self):
-        """ Adds the player symbols to the board (1 and 2)
+        Args:
+            spawns : (x, y) positions, at least one per player
         """
-        for key in self.players:
-            self.insertInBoard(self.players[key]['pos'], self.players[key]['symbol'])
+        if len(spawns) < len(self.players):
+            raise ValueError(f"{len(self.players)} players need as many spawn points, "
+                             f"the map has {len(spawns)}")
+        self.occupants.clear()
+        for p, pos in zip(self.players.values(), spawns):
+            p.pos = pos
+            self.occupants[pos] = p
+            self.insertInBoard(pos, p.symbol)
     
-    def updateKeysAndMessage(self, player, sym):
+    def updateKeysAndMessage(self, player, sym, now=None):
         """ If a player picks up a key, or a player uses a key,
             we update their inventory and send a message to client
 
         Args:
-            player : The player moving (1 or 2)
-            sym: The character to be inserted
+            player : The player number
+            sym: The byte value on the cell the player moved to
+            now : The time of the move
         """        
-        if sym == 'K':
-            self.players[player]['key'] = True
-            self.setMessage(f"Player {player} picked up a new key!")
-        elif sym == '=':
-            self.players[player]['key'] = False
-            self.players[player]['has_used_key'] = True
-            self.setMessage(f"Player {player} used their key to open a gate!")
-        elif sym == '*':
+        p = self.players[int(player)]
+        (p.key, p.has_used_key) = rules.inventoryAfter(sym, p.key, p.has_used_key)
+        if sym == KEY:
+            self.setMessage(f"Player {player} picked up a new key!", now)
+        elif sym == GATE:
+            self.setMessage(f"Player {player} used their key to open a gate!", now)
+        elif sym == CHEST:
             self.winner = True
 
     def makeMove(self, direction, player):
         """ Update player position based on direction input and
-            add new position to the board. Also decide if message
-            has been displayed long enough.
+            add new position to the board. Timers that are due,
+            like the reset of an old message, fire first.
 
         Args:
             direction : up/down/left/right
-            player : The player moving (1 or 2)
+            player : The player number
         """
-        player = str(player)
-        increment = self.direction_dict[direction]
-        current_pos = self.get_player_position(player)
-    
-        # clear previous position
-        self.insertInBoard(current_pos, ' ')
-
-        new_pos = self.addTuples(increment, current_pos)
-
-        if self.validMove(player, new_pos):
-            (x, y) = new_pos
-            sym_on_new_pos = self.board[x][y]
-            self.updateKeysAndMessage(player, sym_on_new_pos)
+        player = int(player)
+        # one clock read per move, so a replay sees the same times
+        now = self.clock()
+        if self.recorder is not None:
+            self.recorder.record(now, player, direction)
+        # timers that were due before this move
+        self.timers.advance(now)
+        new_pos = rules.step(self.get_player_position(player), direction)
+        sym_on_new_pos = self.board[new_pos[1] * self.width + new_pos[0]]
+
+        if self.validMove(player, new_pos, sym_on_new_pos):
+            self.updateKeysAndMessage(player, sym_on_new_pos, now)
+            # only the two cells of the mover change
             self.set_player_position(player, new_pos)
         
-        # log player inventory and position etc on every move
-        print(self.players)
-        if time.time() - self.messageTimer > 5:
-            self.resetMessage()
-        # update the board according to new player positions etc. 
-        self.addPlayersToBoard()
-
-    def addRandomObstacles(self, amount):
-        """ Add obstacles '#' at random positions on the board
-
-        Args:
-            amount : The amount of obstacles to add
-        """
-        for i in range(amount):
-            xpos = random.randint(2, self.width - 1)
-            ypos = random.randint(2, self.height - 1)
-            has_obstacle = self.board[xpos][ypos] == "#"
-            within_chest = ((xpos > self.chest_x and xpos < self.chest_x + 15) and 
-                            (ypos > self.chest_y and ypos < self.chest_y + 9))
-            is_blocking_gate = self.board[xpos + 1][ypos] == "="
-
-            while (has_obstacle or within_chest or is_blocking_gate):
-                #random anew
-                xpos = random.randint(2, self.width - 1)
-                ypos = random.randint(2, self.height - 1)
-            self.insertInBoard((xpos, ypos), "#")
-
-    def addKeys(self):
-        """ Add two keys to the board,
-            they are used to open gates in the chest to win.
-        """
-        for i in range(2):
-            xpos = random.randint(2, self.width - 1)
-            ypos = random.randint(2, self.height - 1)
-            # position already has key or
-            while(self.board[xpos][ypos] == "K" or (
-            # position is within the chest
-            (xpos > self.chest_x and xpos < self.chest_x + 15) and
-            (ypos > self.chest_y and ypos < self.chest_y + 9))):
-                # random anew
-                xpos = random.randint(2, self.width - 1)
-                ypos = random.randint(2, self.height - 1)
-            self.insertInBoard((xpos, ypos), "K")
-
-    def boardToString(self):
-        """ Convert the 2D array that is the board to a string
-            which can then be sent to client.
-
-        Returns:
-            string: The string which represents the current game state
-        """
-        if self.winner:
-            gameString = "W" * 2400
-        else:
-            gameString = ""
-            for i in range(0, self.height):
-                for j in range(0, self.width):
-                    gameString += self.board[j][i]
-        return gameString + self.message
\ No newline at end of file
+        # player inventory and position etc, formatted only when enabled
+        log.debug("Players: %s", self.players)
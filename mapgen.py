@@ -0,0 +1,343 @@
+""" Map generation.
+
+A map is the starting board of a game: the outer walls, the chest
+container, the random obstacles and the keys. Instead of drawing random
+positions until one happens to be free, the generator builds the list of
+free cells once and samples obstacles and keys from it, so every attempt
+takes the same bounded time. A breadth-first search then checks that the
+keys and the chest gate can be reached from every spawn point, and a map
+that fails the check is thrown away and drawn again.
+
+Generation is deterministic for a given seed, a map can be rebuilt from
+(width, height, seed). MapPool keeps a few maps ready on a background
+thread so creating a room never waits for one.
+"""
+import bisect
+import logging
+import queue
+import random
+import threading
+
+import metrics
+import rules
+
+OBSTACLES = 30      # on an 80x30 board, bigger boards get as many per cell
+KEYS = 2
+PLAYERS = 2
+MAX_ATTEMPTS = 20   # the last attempt has no obstacles and always passes
+POOL_SIZE = 8
+
+# chest container, see drawChest
+CHEST_WIDTH = 15
+CHEST_HEIGHT = 9
+INNER_CHEST_WIDTH = 9
+INNER_CHEST_HEIGHT = 5
+CHEST_CELL = (7, 4)   # the chest, from the top left corner of the container
+CHEST_MARGIN = 10   # preferred distance from the top left corner
+
+log = logging.getLogger("mapgen")
+
+generate_time = metrics.histogram("mapgen.generate")
+rejected = metrics.counter("mapgen.rejected")
+pool_misses = metrics.counter("mapgen.pool_miss")
+
+class Map():
+    """ A generated starting board, loaded into a game with Game.initBoard
+    """
+    def __init__(self, width, height, seed, board, chest, spawns, keys,
+                 obstacles=OBSTACLES):
+        """
+        Args:
+            width, height : The board dimensions
+            seed : The seed the map was generated from
+            board : Row-major board as bytes, without players
+            chest : (x, y) of the top left corner of the chest container
+            spawns : The (x, y) positions players start on
+            keys : The (x, y) positions of the keys
+            obstacles : The number of obstacles asked for, with the
+                        seed it is enough to generate the map again
+        """
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.board = board
+        self.chest = chest
+        self.spawns = spawns
+        self.keys = keys
+        self.obstacles = obstacles
+
+def drawChest(board, width, pos):
+    """ Draw the chest container with its top left corner at pos.
+        The container has an outer rim and an inner rim, and there
+        are gates that require a key to open, marked with "=".
+        The chest, "*", is in the middle of the inner rim:
+        ###############
+        #             #
+        #  #########  #
+        #  #       #  #
+        =  #   *   =  #
+        #  #       #  #
+        #  #########  #
+        #             #
+        ###############
+
+    Returns:
+        tuple: The (x, y) positions of the outer gate, the inner gate
+               and the chest
+    """
+    (cx, cy) = pos
+    def put(x, y, value):
+        board[(cy + y) * width + cx + x] = value
+
+    for x in range(CHEST_WIDTH):
+        put(x, 0, rules.WALL)
+        put(x, CHEST_HEIGHT - 1, rules.WALL)
+    for x in range(INNER_CHEST_WIDTH):
+        put(3 + x, 2, rules.WALL)
+        put(3 + x, INNER_CHEST_HEIGHT + 1, rules.WALL)
+    for y in range(CHEST_HEIGHT):
+        put(0, y, rules.WALL)
+        put(CHEST_WIDTH - 1, y, rules.WALL)
+    for y in range(INNER_CHEST_HEIGHT):
+        put(3, 2 + y, rules.WALL)
+        put(2 + INNER_CHEST_WIDTH, 2 + y, rules.WALL)
+    put(0, 4, rules.GATE)
+    put(CHEST_WIDTH - 4, 4, rules.GATE)
+    put(CHEST_CELL[0], CHEST_CELL[1], rules.CHEST)
+    return ((cx, cy + 4), (cx + CHEST_WIDTH - 4, cy + 4),
+            (cx + CHEST_CELL[0], cy + CHEST_CELL[1]))
+
+def chestPosition(width, height, rng):
+    """ Random top left corner for the chest container. It keeps
+        CHEST_MARGIN cells away from the top left corner when the board
+        is big enough, and always leaves a free column left of the
+        outer gate and a free row above, so the container never cuts
+        the board in two.
+    """
+    max_x = width - CHEST_WIDTH - 1
+    max_y = height - CHEST_HEIGHT - 1
+    if max_x < 2 or max_y < 2:
+        raise ValueError(f"A {width}x{height} board is too small for the chest")
+    return (rng.randint(min(CHEST_MARGIN, max_x), max_x),
+            rng.randint(min(CHEST_MARGIN, max_y), max_y))
+
+def reachable(board, width, height, starts, passable):
+    """ Flood fill over the board. It works on runs of passable cells
+        in a row instead of single cells: a run is marked with one slice
+        assignment and the runs above and below it are found with
+        bytes.find, so big boards are searched at C speed.
+
+    Args:
+        board : Row-major board
+        starts : The (x, y) positions to search from
+        passable : Function telling whether a byte value can be entered
+
+    Returns:
+        bytearray: 1 for every cell index that can be reached
+    """
+    size = width * height
+    # 1 for the cells that can be entered, one call per byte value
+    can_pass = bytes(1 if passable(c) else 0 for c in range(256))
+    open_cells = bytes(board).translate(can_pass)
+    seen = bytearray(size)
+    ones = b"\x01" * width
+    # cells to fill the run of, a run is always filled completely
+    todo = []
+    for (x, y) in starts:
+        i = y * width + x
+        if open_cells[i]:
+            todo.append(i)
+        elif not seen[i]:
+            # a start may stand on a cell that cannot be entered
+            seen[i] = 1
+            todo.extend(n for n in (i - width, i + width, i - 1, i + 1)
+                        if 0 <= n < size and open_cells[n])
+    while todo:
+        i = todo.pop()
+        if seen[i]:
+            continue
+        row = i - i % width
+        left = max(row, open_cells.rfind(0, row, i) + 1)
+        right = open_cells.find(0, i, row + width)
+        if right < 0:
+            right = row + width
+        seen[left:right] = ones[:right - left]
+        for start in (left - width, left + width):
+            if start < 0 or start >= size:
+                continue
+            end = start + right - left
+            # the first cell of every run touching this one
+            j = open_cells.find(1, start, end)
+            while j >= 0:
+                if not seen[j]:
+                    todo.append(j)
+                j = open_cells.find(0, j, end)
+                if j < 0:
+                    break
+                j = open_cells.find(1, j, end)
+    return seen
+
+def spawnPoints(width, height, chest, count):
+    """ Spawn points for count players: the four corners first, then
+        every other cell along the top and bottom rows, skipping the
+        chest container.
+
+    Returns:
+        list: count (x, y) positions
+    """
+    (cx, cy) = chest
+    (right, bottom) = (width - 2, height - 2)
+    candidates = [(1, 1), (right, bottom), (right, 1), (1, bottom)]
+    for x in range(3, right - 1, 2):
+        candidates += [(x, 1), (right + 1 - x, bottom)]
+    spawns = []
+    for pos in candidates:
+        inside_chest = (cx <= pos[0] < cx + CHEST_WIDTH and
+                        cy <= pos[1] < cy + CHEST_HEIGHT)
+        if not inside_chest and pos not in spawns:
+            spawns.append(pos)
+            if len(spawns) == count:
+                return spawns
+    raise ValueError(f"A {width}x{height} board has no room for {count} players")
+
+def isPlayable(board, width, height, spawns, keys, gates, chest):
+    """ True if every spawn point can reach every key and the outer gate
+        without going through a gate, which needs a key to open, and
+        the chest can be reached through the gates.
+        Moves go both ways, so it is enough to search from one spawn
+        point and find everything else.
+    """
+    outside = lambda c: c != rules.WALL and c != rules.GATE
+    seen = reachable(board, width, height, spawns[:1], outside)
+    ((gx, gy), (ix, iy)) = gates
+    targets = list(spawns) + list(keys) + [(gx - 1, gy)]
+    if not all(seen[y * width + x] for (x, y) in targets):
+        return False
+    # behind the outer gate the ring between the rims leads to the
+    # inner gate, and behind that one is the chest, the gates keep
+    # both searches inside the container
+    ring = reachable(board, width, height, [(gx + 1, gy)], outside)
+    inner = reachable(board, width, height, [chest], outside)
+    return bool(ring[iy * width + ix + 1] and inner[iy * width + ix - 1])
+
+def obstacleCount(width, height):
+    """ Obstacles for a board, OBSTACLES per 80x30 cells and at most
+        what the u16 of a recording header holds
+    """
+    return min(0xFFFF, max(OBSTACLES, OBSTACLES * width * height // (80 * 30)))
+
+def generateMap(width, height, seed=None, obstacles=None, keys=KEYS,
+                players=PLAYERS):
+    """ Generate a playable map
+
+    Args:
+        width, height : The board dimensions
+        seed : Seed for the random choices, a random one if None
+        obstacles : Number of random walls, see obstacleCount if None
+        keys : Number of keys
+        players : Number of spawn points to make
+
+    Returns:
+        Map: The new map
+    """
+    if seed is None:
+        seed = random.getrandbits(32)
+    if obstacles is None:
+        obstacles = obstacleCount(width, height)
+    rng = random.Random(seed)
+    with generate_time.time():
+        (chest, board, spawns, key_cells) = drawMap(width, height, rng, obstacles,
+                                                     keys, players)
+    return Map(width, height, seed, bytes(board), chest, spawns, key_cells,
+               obstacles)
+
+def drawMap(width, height, rng, obstacles, keys, players):
+    """ Draw boards until one passes isPlayable, at most MAX_ATTEMPTS
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        board = bytearray(b" " * (width * height))
+        board[0:width] = b"#" * width
+        board[(height - 1) * width:height * width] = b"#" * width
+        board[0::width] = b"#" * height
+        board[width - 1::width] = b"#" * height
+
+        chest = chestPosition(width, height, rng)
+        (outer_gate, inner_gate, chest_cell) = drawChest(board, width, chest)
+        spawns = tuple(spawnPoints(width, height, chest, players))
+
+        # cells an obstacle or key may take: empty, outside the chest
+        # container, not a spawn point and not right in front of a gate
+        # the cells are kept as board indexes in row-major order,
+        # tuples for a big board would take longer than the search
+        (cx, cy) = chest
+        blocked = {y * width + x for (x, y) in spawns}
+        blocked.add(outer_gate[1] * width + outer_gate[0] - 1)
+        free = []
+        for y in range(1, height - 1):
+            row = y * width
+            if cy <= y < cy + CHEST_HEIGHT:
+                free.extend(range(row + 1, row + cx))
+                free.extend(range(row + cx + CHEST_WIDTH, row + width - 1))
+            else:
+                free.extend(range(row + 1, row + width - 1))
+        # free is sorted, the few blocked cells are found by bisection
+        for i in blocked:
+            k = bisect.bisect_left(free, i)
+            if k < len(free) and free[k] == i:
+                del free[k]
+
+        # the last attempt keeps only the keys, so generation always ends
+        walls = obstacles if attempt < MAX_ATTEMPTS - 1 else 0
+        cells = rng.sample(free, min(len(free), walls + keys))
+        for i in cells[:walls]:
+            board[i] = rules.WALL
+        key_cells = tuple((i % width, i // width) for i in cells[walls:])
+        for i in cells[walls:]:
+            board[i] = rules.KEY
+
+        if isPlayable(board, width, height, spawns, key_cells,
+                      (outer_gate, inner_gate), chest_cell):
+            return (chest, board, spawns, key_cells)
+        rejected.inc()
+    raise RuntimeError("No playable map found")  # not reached
+
+class MapPool():
+    """ Maps generated ahead of time on a background thread.
+        take() returns a ready map right away and the thread makes a
+        new one, so room creation only pays for generation when the
+        pool has run dry.
+
+        The thread is started on the first take(), in the process that
+        uses the pool, since threads do not survive a fork.
+    """
+    def __init__(self, width, height, players=PLAYERS, size=POOL_SIZE):
+        self.width = width
+        self.height = height
+        self.players = players
+        self.maps = queue.Queue(maxsize=size)
+        self.thread = None
+        metrics.gauge("mapgen.pool_size", self.maps.qsize)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.fill, name="mapgen", daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        while True:
+            # blocks while the pool is full
+            self.maps.put(generateMap(self.width, self.height,
+                                      players=self.players))
+
+    def take(self):
+        """ A fresh map, every map is handed out once
+
+        Returns:
+            Map: The map
+        """
+        if self.thread is None:
+            self.start()
+        try:
+            return self.maps.get_nowait()
+        except queue.Empty:
+            pool_misses.inc()
+            return generateMap(self.width, self.height, players=self.players)
@@ -0,0 +1,171 @@
+import json
+import logging
+import socket
+import time
+from _thread import start_new_thread
+
+# histogram bucket upper bounds in seconds, 1us doubling up to ~17s
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(25))
+
+log = logging.getLogger("metrics")
+
+class Counter():
+    """ A number that only goes up
+    """
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Histogram():
+    """ Timing histogram with fixed exponential buckets. Recording is a
+        couple of comparisons and additions, cheap enough for the hot path.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def time(self):
+        """ Context manager that observes how long its block took
+        """
+        return Timer(self)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": (self.total / self.count * 1000) if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+class Timer():
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class Sampler():
+    """ Lets through one in every n events, used to keep debug
+        logging on the hot path to a fraction of the calls.
+    """
+    __slots__ = ("every", "seen")
+
+    def __init__(self, every):
+        self.every = every
+        self.seen = 0
+
+    def __call__(self):
+        self.seen += 1
+        return (self.seen - 1) % self.every == 0
+
+counters = {}
+histograms = {}
+# name -> callable returning the current value
+gauges = {}
+
+def counter(name):
+    """ Get the counter with this name, creating it on first use
+    """
+    c = counters.get(name)
+    if c is None:
+        c = counters[name] = Counter()
+    return c
+
+def histogram(name):
+    """ Get the histogram with this name, creating it on first use
+    """
+    h = histograms.get(name)
+    if h is None:
+        h = histograms[name] = Histogram()
+    return h
+
+def gauge(name, fn):
+    """ Register a callable that is read every time stats are collected
+    """
+    gauges[name] = fn
+
+def removeGauge(name):
+    gauges.pop(name, None)
+
+def snapshot():
+    """ All metrics as a JSON-friendly dict
+    """
+    values = {}
+    for name, fn in list(gauges.items()):
+        try:
+            values[name] = fn()
+        except Exception as e:
+            values[name] = repr(e)
+    return {
+        "time": time.time(),
+        "counters": {name: c.value for name, c in list(counters.items())},
+        "histograms": {name: h.summary() for name, h in list(histograms.items())},
+        "gauges": values,
+    }
+
+def startPeriodicDump(interval):
+    """ Log a snapshot every interval seconds from a background thread
+    """
+    def dumper():
+        while True:
+            time.sleep(interval)
+            log.info(json.dumps(snapshot()))
+    start_new_thread(dumper, ())
+
+def startStatsServer(host, port):
+    """ Serve a JSON snapshot to anyone connecting to host:port,
+        for example with `nc 127.0.0.1 port`. Runs in its own thread
+        so it works the same with both server engines.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(5)
+
+    def server():
+        while True:
+            conn, addr = sock.accept()
+            with conn:
+                try:
+                    conn.sendall(bytes(json.dumps(snapshot(), indent=1) + "\n", 'utf-8'))
+                except OSError as e:
+                    log.warning("Stats request failed: %s", e)
+    start_new_thread(server, ())
+    return sock
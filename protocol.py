@@ -0,0 +1,341 @@
+""" Framed binary protocol shared by the server and the client.
+
+Every message in both directions is a frame:
+
+    type:u8 length:u32 payload[length]
+
+so several frames can arrive in one read (or one frame over several reads)
+and the receiver still splits them correctly.
+
+Server -> client:
+    KEYFRAME 'F': version:u32 width:u16 height:u16 x:u16 y:u16
+                  board[width*height] message
+    DELTA    'D': base:u32 version:u32 count:u16 has_message:u8
+                  count*(x:u16 y:u16 symbol:u8) [message[width]]
+    WIN      'W': empty
+    WELCOME  'H': player:u8 code_len:u8 room_code[code_len] [token[16]]
+                  player 0 is a spectator, players get a session token
+                  to resume with if the connection drops
+    ERROR    'E': utf-8 reason, the server closes the connection after it
+    ACK      'A': seq:u32 x:u16 y:u16 flags:u8
+                  every input up to seq has been handled, (x, y) and the
+                  key flags are the player's state after them
+    RLE      'R': a run-length encoded frame, see compression.py
+    ZLIB     'Z': the next piece of the connection's zlib stream,
+                  holding a frame
+
+Client -> server:
+    JOIN  'J': role:u8 code_len:u8 room_code[code_len]
+               [view_width:u16 view_height:u16 [compression:u8
+               [token[16] have:u32 x:u16 y:u16]]]
+               room codes are ASCII, at most MAX_ROOM_CODE characters,
+               an empty room code joins any room with a free slot,
+               spectators must name the room they want to watch,
+               the view size is how many cells the client can show,
+               0x0 for the default, and compression the method it
+               wants state frames in. With a token from an earlier
+               WELCOME the client takes its player in room_code back,
+               have is the version of the state it still holds plus
+               one, 0 for none, and (x, y) the origin of its viewport,
+               the server only sends what changed since then
+    INPUT 'I': seq:u32 direction opcode:u8
+               seq counts up from 1, the server echoes it in ACK
+    SYNC  'S': empty, asks for a new keyframe
+
+The board in a keyframe is row-major and covers the client's viewport:
+width x height cells with the top left one at (x, y) of the game board,
+the message fills the rest of the frame. Cells in a delta are in board
+coordinates and only the ones inside the viewport are sent, a moved
+viewport comes as a new keyframe, see viewport.py. A delta holds the
+latest symbol of every cell that changed after version base, so it
+applies to any state with base <= version < the delta's version. Players get one delta per
+tick with base = version - 1, spectators get fewer deltas that each cover
+several ticks. A client that sees a gap sends SYNC.
+
+The same frames travel over UDP inside datagrams, see udp.py.
+"""
+import struct
+
+import metrics
+
+KEYFRAME = ord('F')
+DELTA = ord('D')
+WIN = ord('W')
+WELCOME = ord('H')
+ERROR = ord('E')
+JOIN = ord('J')
+INPUT = ord('I')
+SYNC = ord('S')
+ACK = ord('A')
+RLE = ord('R')
+ZLIB = ord('Z')
+
+# JOIN roles
+ROLE_PLAYER = 0
+ROLE_SPECTATOR = 1
+
+MAX_ROOM_CODE = 16  # characters, room codes are ASCII
+TOKEN_SIZE = 16
+
+# JOIN compression methods
+COMPRESS_NONE = 0
+COMPRESS_RLE = 1
+COMPRESS_ZLIB = 2
+
+# ACK flags
+ACK_HAS_KEY = 1
+ACK_USED_KEY = 2
+
+FRAME_HEADER = struct.Struct('!BI')
+KEYFRAME_HEADER = struct.Struct('!IHHHH')
+VIEW_SIZE = struct.Struct('!HH')
+RESUME_BODY = struct.Struct('!16sIHH')
+DELTA_HEADER = struct.Struct('!IIHB')
+CELL = struct.Struct('!HHB')
+INPUT_BODY = struct.Struct('!IB')
+ACK_BODY = struct.Struct('!IHHB')
+
+# the opcode of a direction is its index in this tuple
+DIRECTIONS = ("up", "down", "left", "right")
+
+# nothing we send comes close, anything bigger is a broken peer
+MAX_PAYLOAD = 1 << 24
+
+keyframe_time = metrics.histogram("serialize.keyframe")
+delta_time = metrics.histogram("serialize.delta")
+
+class ProtocolError(Exception):
+    """ Raised when the peer sends something that is not a valid frame
+    """
+
+def encodeFrame(kind, payload=b""):
+    """ Put the frame header in front of a payload
+
+    Args:
+        kind : The frame type byte
+        payload : bytes-like payload
+
+    Returns:
+        bytes: The complete frame
+    """
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+class FrameReader():
+    """ Incremental frame parser. Bytes are fed in as they are received
+        and complete frames are taken out, partial frames stay in the
+        buffer until the rest arrives.
+    """
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.buffer = bytearray()
+        self.max_payload = max_payload
+
+    def feed(self, data):
+        """ Append received bytes and return the frames completed by them
+
+        Args:
+            data : bytes-like object that was received
+
+        Returns:
+            list: (type, payload) tuples in the order they were sent
+
+        Raises:
+            ProtocolError: if a frame header announces an oversized payload
+        """
+        buf = self.buffer
+        buf += data
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(buf) - offset >= header_size:
+            (kind, length) = FRAME_HEADER.unpack_from(buf, offset)
+            if length > self.max_payload:
+                raise ProtocolError(f"Frame of {length} bytes is too big")
+            end = offset + header_size + length
+            if end > len(buf):
+                break
+            frames.append((kind, bytes(buf[offset + header_size:end])))
+            offset = end
+        # drop the consumed bytes, the buffer object itself is reused
+        del buf[:offset]
+        return frames
+
+def encodeInput(direction, seq=0):
+    return encodeFrame(INPUT, INPUT_BODY.pack(seq, DIRECTIONS.index(direction)))
+
+def decodeInput(payload):
+    """ Turn an INPUT payload back into a direction
+
+    Returns:
+        tuple: (seq, direction) or None if the input is invalid
+    """
+    if len(payload) != INPUT_BODY.size:
+        return None
+    (seq, opcode) = INPUT_BODY.unpack(payload)
+    if opcode >= len(DIRECTIONS):
+        return None
+    return (seq, DIRECTIONS[opcode])
+
+def encodeAck(seq, pos, has_key, has_used_key):
+    flags = (ACK_HAS_KEY if has_key else 0) | (ACK_USED_KEY if has_used_key else 0)
+    return encodeFrame(ACK, ACK_BODY.pack(seq, pos[0], pos[1], flags))
+
+def decodeAck(payload):
+    """ Read an ACK payload
+
+    Returns:
+        tuple: (seq, (x, y), has_key, has_used_key)
+    """
+    (seq, x, y, flags) = ACK_BODY.unpack(payload)
+    return (seq, (x, y), bool(flags & ACK_HAS_KEY), bool(flags & ACK_USED_KEY))
+
+def encodeSync():
+    return encodeFrame(SYNC)
+
+def checkRoomCode(room_code):
+    """ Check a room code before it is sent, the clients call this on
+        the code from the command line
+
+    Raises:
+        ValueError: if the code is not ASCII or longer than MAX_ROOM_CODE
+    """
+    if not room_code.isascii():
+        raise ValueError(f"Room code {room_code!r} is not ASCII")
+    if len(room_code) > MAX_ROOM_CODE:
+        raise ValueError(f"Room code {room_code!r} is longer than "
+                         f"{MAX_ROOM_CODE} characters")
+
+def encodeJoin(room_code="", role=ROLE_PLAYER, view=None, compression=COMPRESS_NONE,
+               resume=None):
+    """
+    Args:
+        room_code : The room to join, "" for matchmaking
+        role : ROLE_PLAYER or ROLE_SPECTATOR
+        view : (width, height) the client can show, None for the default
+        compression : The COMPRESS_ method for state frames
+        resume : (token, version, (x, y)) to take back the player of an
+                 earlier connection, version -1 if we have no state
+
+    Raises:
+        ValueError: if the room code is not valid, see checkRoomCode
+    """
+    checkRoomCode(room_code)
+    code = bytes(room_code, 'ascii')
+    payload = bytes([role, len(code)]) + code
+    if view is not None or compression or resume:
+        payload += VIEW_SIZE.pack(*(view or (0, 0)))
+    if compression or resume:
+        payload += bytes([compression])
+    if resume:
+        (token, version, origin) = resume
+        payload += RESUME_BODY.pack(token, version + 1, *origin)
+    return encodeFrame(JOIN, payload)
+
+def decodeJoin(payload):
+    """ Read a JOIN payload
+
+    Returns:
+        tuple: (role, room code, (view width, view height) or None,
+                compression method, resume), the code is "" for
+                matchmaking and resume is (token, version or None, (x, y))
+                or None
+
+    Raises:
+        ProtocolError: if the payload is malformed
+    """
+    if len(payload) < 2 or len(payload) < 2 + payload[1] or payload[1] > MAX_ROOM_CODE:
+        raise ProtocolError("Malformed JOIN")
+    end = 2 + payload[1]
+    try:
+        code = payload[2:end].decode('utf-8')
+    except UnicodeDecodeError:
+        raise ProtocolError("Room code is not utf-8")
+    view = None
+    compression = COMPRESS_NONE
+    if len(payload) >= end + VIEW_SIZE.size:
+        view = VIEW_SIZE.unpack_from(payload, end)
+        if view == (0, 0):
+            view = None
+        if len(payload) > end + VIEW_SIZE.size:
+            compression = payload[end + VIEW_SIZE.size]
+    resume = None
+    start = end + VIEW_SIZE.size + 1
+    if len(payload) >= start + RESUME_BODY.size:
+        (token, have, x, y) = RESUME_BODY.unpack_from(payload, start)
+        resume = (token, have - 1 if have else None, (x, y))
+    return (payload[0], code, view, compression, resume)
+
+def encodeWelcome(player, room_code, token=b""):
+    """
+    Args:
+        player : The player number, 0 for a spectator
+        room_code : The room the client is in
+        token : The session token to resume with, TOKEN_SIZE bytes or none
+    """
+    code = bytes(room_code, 'utf-8')
+    return encodeFrame(WELCOME, bytes([player, len(code)]) + code + token)
+
+def decodeWelcome(payload):
+    """ Read a WELCOME payload
+
+    Returns:
+        tuple: (player number, room code, session token or None)
+    """
+    end = 2 + payload[1]
+    token = bytes(payload[end:end + TOKEN_SIZE]) if len(payload) >= end + TOKEN_SIZE else None
+    return (payload[0], payload[2:end].decode('utf-8'), token)
+
+def encodeError(reason):
+    return encodeFrame(ERROR, bytes(reason, 'utf-8'))
+
+def encodeKeyframe(snapshot, rect=None):
+    """ Encode a published game state. Snapshots do not change, so
+        this needs no lock even while the game goes on.
+
+    Args:
+        snapshot : A game.Snapshot, like Game.snapshot
+        rect : (x, y, width, height) of the viewport, the whole board if None
+
+    Returns:
+        bytes: The keyframe
+    """
+    with keyframe_time.time():
+        if rect is None or rect == (0, 0, snapshot.width, snapshot.height):
+            (x, y, width, height) = (0, 0, snapshot.width, snapshot.height)
+            board = snapshot.boardBytes()
+        else:
+            (x, y, width, height) = rect
+            board = snapshot.region(x, y, width, height)
+        return encodeFrame(KEYFRAME, b"".join([
+            KEYFRAME_HEADER.pack(snapshot.version, width, height, x, y),
+            board,
+            bytes(snapshot.message, 'utf-8')]))
+
+def encodeDelta(delta, base=None, rect=None):
+    """ Encode the changes returned by Game.takeDelta
+
+    Args:
+        delta : tuple of (version, cells, message or None)
+        base : The version the changes were collected since,
+               version - 1 if None
+        rect : (x, y, width, height) of the viewport, only the cells
+               inside it are sent, all of them if None
+
+    Returns:
+        bytes: The delta frame
+    """
+    with delta_time.time():
+        (version, cells, message) = delta
+        if base is None:
+            base = version - 1
+        if rect is not None:
+            (x0, y0, width, height) = rect
+            (x1, y1) = (x0 + width, y0 + height)
+            cells = [c for c in cells if x0 <= c[0] < x1 and y0 <= c[1] < y1]
+        parts = [DELTA_HEADER.pack(base, version, len(cells), message is not None)]
+        parts.extend(CELL.pack(x, y, sym) for (x, y, sym) in cells)
+        if message is not None:
+            parts.append(bytes(message, 'utf-8'))
+        return encodeFrame(DELTA, b"".join(parts))
+
+def encodeWin():
+    return encodeFrame(WIN)
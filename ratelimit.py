@@ -0,0 +1,104 @@
+""" Flood protection for what clients send.
+
+Every player connection gets an InputLimiter with two token buckets:
+
+    inputs  : refills at the input rate, every frame takes a token, also
+              the ones a spectator sends or that are ignored, and a SYNC,
+              which makes the server encode a keyframe, SYNC_COST tokens.
+              Without tokens the frame is dropped, the client's next ACK
+              tells it the input was handled.
+    strikes : every dropped or malformed frame takes a token, they come
+              back at STRIKE_RATE per second. A client that runs out is
+              disconnected and its slot is not kept for it.
+
+So a client holding a key down a bit faster than the rate only loses the
+extra moves, while a client flooding the server is gone within a fraction
+of a second. Frames bigger than MAX_CLIENT_FRAME cannot be any frame a
+client sends and close the connection right away, see
+protocol.FrameReader.
+"""
+import time
+
+import metrics
+
+INPUT_RATE = 40         # inputs per second a client can keep up
+INPUT_BURST = 40        # inputs a client can send at once
+SYNC_COST = 10          # a keyframe request counts as this many inputs
+STRIKE_RATE = 10        # dropped or malformed frames forgiven per second
+MAX_STRIKES = 100       # strikes that can add up before a disconnect
+MAX_CLIENT_FRAME = 64   # bytes of the biggest frame payload a client sends, a JOIN
+
+inputs_throttled = metrics.counter("inputs.throttled")
+clients_flooding = metrics.counter("clients.flood_dropped")
+protocol_errors = metrics.counter("clients.protocol_errors")
+
+class FloodError(Exception):
+    """ A client kept sending more than it may, or junk
+    """
+    pass
+
+class TokenBucket():
+    """ Holds up to burst tokens and gets rate new ones per second
+    """
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now, cost=1):
+        """
+        Returns:
+            Boolean: True if there were cost tokens, they are taken then
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+class InputLimiter():
+    """ The limits of one client connection, see the module docstring
+    """
+    def __init__(self, rate=INPUT_RATE, burst=INPUT_BURST, clock=time.monotonic):
+        """
+        Args:
+            rate : Inputs per second, 0 to not limit the inputs
+            burst : Inputs the client can send at once
+            clock : Function returning the current time in seconds
+        """
+        self.clock = clock
+        now = clock()
+        self.inputs = TokenBucket(rate, max(burst, 1), now) if rate > 0 else None
+        self.strikes = TokenBucket(STRIKE_RATE, MAX_STRIKES, now)
+
+    def allow(self, cost=1):
+        """ Whether the client may send one more input now
+
+        Args:
+            cost : Tokens the frame takes, SYNC_COST for a SYNC
+
+        Raises:
+            FloodError: if a dropped input was one strike too many
+        """
+        if self.inputs is None:
+            return True
+        now = self.clock()
+        if self.inputs.take(now, cost):
+            return True
+        inputs_throttled.inc()
+        self.strike(now)
+        return False
+
+    def strike(self, now=None):
+        """ Count a dropped or malformed frame against the client
+
+        Raises:
+            FloodError: if the client has run out of strikes
+        """
+        if not self.strikes.take(self.clock() if now is None else now):
+            clients_flooding.inc()
+            raise FloodError("Client is flooding the server")
@@ -0,0 +1,238 @@
+""" Recording and replaying matches.
+
+A recording is everything needed to play a match again: the map
+parameters and seed, then every move in the order makeMove applied it,
+with the time it was applied. The file is binary, all numbers big-endian:
+
+    header  "GRPL" version:u8 width:u16 height:u16 players:u8
+            seed:u32 obstacles:u16 keys:u8
+    move    time:f64 player:u8 direction:u8   (10 bytes, player >= 1)
+    end     time:f64 0:u8 0:u8 checksum:u32
+
+The end record holds a CRC-32 of the final board and message, written
+when the room closes. The game's timers, like the reset of the message
+line, are run up to the time of the end record before the checksum.
+Version 1 recordings were made before the game had timers, so they are
+checked without running them. Versions 1 and 2 were made on maps without
+the chest cell, it is taken off the map before they are replayed. A replay that ends in a different state
+was not deterministic, which is a bug. Recordings cut off without an end
+record, for example by a crash, still replay, they just cannot be
+checked.
+
+The replay engine runs the moves through game.Game without a network,
+as fast as possible or at the recorded pace:
+
+    python replay.py recordings/*.rpl --repeat 10
+"""
+import argparse
+import logging
+import struct
+import sys
+import time
+import zlib
+
+import game
+import mapgen
+import protocol
+import rules
+
+MAGIC = b"GRPL"
+VERSION = 3
+VERSIONS = (1, 2, 3)   # versions we can replay
+HEADER = struct.Struct("!4sBHHBIHB")
+MOVE = struct.Struct("!dBB")
+CHECKSUM = struct.Struct("!I")
+EXTENSION = ".rpl"
+
+log = logging.getLogger("replay")
+
+class ReplayError(Exception):
+    """ The recording is broken, or replaying it ended in another state
+    """
+    pass
+
+def stateChecksum(g):
+    """ CRC-32 of the board and the message of the published snapshot.
+        Changes that are not published yet are published first.
+    """
+    g.takeDelta()
+    snapshot = g.snapshot
+    return zlib.crc32(bytes(snapshot.message, "utf-8"),
+                      zlib.crc32(snapshot.boardBytes()))
+
+class Recorder():
+    """ Writes the moves of one game to a file, set it as g.recorder.
+        Moves go through a buffered file, so recording costs a struct
+        pack and a memory copy per move.
+    """
+    def __init__(self, path, g, board_map):
+        """
+        Args:
+            path : The file to write
+            g : The game being recorded
+            board_map : The mapgen.Map the game was started with
+        """
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, g.width, g.height,
+                                    len(g.players), board_map.seed,
+                                    board_map.obstacles, len(board_map.keys)))
+        self.moves = 0
+
+    def record(self, now, player, direction):
+        self.file.write(MOVE.pack(now, player, protocol.DIRECTIONS.index(direction)))
+        self.moves += 1
+
+    def close(self, g):
+        """ Write the end record with the final state and close the file
+        """
+        now = g.clock()
+        g.advance(now)
+        self.file.write(MOVE.pack(now, 0, 0))
+        self.file.write(CHECKSUM.pack(stateChecksum(g)))
+        self.file.close()
+        log.info("Recorded %d moves to %s", self.moves, self.path)
+
+class Recording():
+    """ A recording read back from a file
+    """
+    def __init__(self, width, height, players, seed, obstacles, keys,
+                 moves, checksum, end=None, chest=True):
+        """
+        Args:
+            moves : [(time, player, direction), ...]
+            checksum : Checksum of the final state, None if the
+                       recording has no end record
+            end : The time to run the timers to before checking the
+                  final state, None to not run them
+            chest : The map of the match had the chest cell
+        """
+        self.width = width
+        self.height = height
+        self.players = players
+        self.seed = seed
+        self.obstacles = obstacles
+        self.keys = keys
+        self.moves = moves
+        self.checksum = checksum
+        self.end = end
+        self.chest = chest
+
+def readRecording(path):
+    """ Read a recording file
+
+    Returns:
+        Recording: The parsed recording
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ReplayError(f"{path}: too short for a recording")
+    (magic, version, width, height, players, seed, obstacles,
+     keys) = HEADER.unpack_from(data)
+    if magic != MAGIC or version not in VERSIONS:
+        supported = ", ".join(str(v) for v in VERSIONS[:-1]) + f" or {VERSIONS[-1]}"
+        raise ReplayError(f"{path}: not a version {supported} recording")
+
+    moves = []
+    checksum = None
+    end = None
+    offset = HEADER.size
+    while offset + MOVE.size <= len(data):
+        (now, player, opcode) = MOVE.unpack_from(data, offset)
+        offset += MOVE.size
+        if player == 0:
+            if offset + CHECKSUM.size <= len(data):
+                (checksum,) = CHECKSUM.unpack_from(data, offset)
+                if version >= 2:
+                    end = now
+            break
+        if player > players or opcode >= len(protocol.DIRECTIONS):
+            raise ReplayError(f"{path}: bad move at byte {offset - MOVE.size}")
+        moves.append((now, player, protocol.DIRECTIONS[opcode]))
+    return Recording(width, height, players, seed, obstacles, keys, moves,
+                     checksum, end, chest=version >= 3)
+
+class ReplayClock():
+    """ Clock for a replayed game, returns the time of the move being replayed
+    """
+    __slots__ = ("now",)
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def replay(recording, realtime=False, speed=1.0):
+    """ Play a recording again and check the final state
+
+    Args:
+        recording : A Recording from readRecording
+        realtime : Wait between the moves as long as the players did
+        speed : Playback speed factor when realtime is set
+
+    Returns:
+        game.Game: The game after the last move
+    """
+    r = recording
+    board_map = mapgen.generateMap(r.width, r.height, r.seed, r.obstacles,
+                                   r.keys, r.players)
+    if not r.chest:
+        board = bytearray(board_map.board)
+        (x, y) = board_map.chest
+        board[(y + mapgen.CHEST_CELL[1]) * r.width + x + mapgen.CHEST_CELL[0]] = rules.EMPTY
+        board_map.board = bytes(board)
+    clock = ReplayClock()
+    g = game.Game(r.width, r.height, r.players, clock)
+    g.initBoard(board_map)
+
+    if realtime and r.moves:
+        first = r.moves[0][0]
+        start = time.monotonic()
+    for (now, player, direction) in r.moves:
+        if realtime:
+            delay = start + (now - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        clock.now = now
+        g.makeMove(direction, player)
+    if r.end is not None:
+        clock.now = r.end
+        g.advance(r.end)
+
+    if r.checksum is not None and stateChecksum(g) != r.checksum:
+        raise ReplayError("The replay ended in a different state than the match")
+    return g
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded matches")
+    parser.add_argument("files", nargs="+", help="recordings to replay")
+    parser.add_argument("--realtime", action="store_true",
+                        help="replay at the recorded pace instead of as fast as possible")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="playback speed factor with --realtime")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="replay every file this many times, for benchmarking")
+    args = parser.parse_args()
+
+    failed = 0
+    for path in args.files:
+        try:
+            recording = readRecording(path)
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                replay(recording, args.realtime, args.speed)
+            elapsed = time.perf_counter() - start
+        except (OSError, ReplayError) as e:
+            print(f"{path}: FAILED: {e}")
+            failed += 1
+            continue
+        moves = len(recording.moves) * args.repeat
+        checked = "ok" if recording.checksum is not None else "not checked, no end record"
+        rate = moves / elapsed if elapsed else 0
+        print(f"{path}: {len(recording.moves)} moves, {checked}, {rate:,.0f} moves/s")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
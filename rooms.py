@@ -0,0 +1,825 @@
+import hmac
+import logging
+import os
+import random
+import secrets
+import string
+import time
+from collections import deque
+
+import ai
+import game
+import mapgen
+import metrics
+import protocol
+import ratelimit
+import replay
+import viewport
+
+MAX_PLAYERS = 2             # players per room
+MAX_INPUTS_PER_TICK = 2     # moves applied per player and tick
+MAX_QUEUED_INPUTS = 16      # inputs a player can have waiting
+BOARD_LOG_EVERY = 100       # log the board on one in this many broadcasts at debug level
+CODE_LENGTH = 5
+SPECTATOR_INTERVAL = 4      # ticks per spectator frame
+MAX_SPECTATORS = 1000       # spectators per room
+HISTORY = 64                # deltas kept for clients that lag behind, see deltaSince
+RESUME_GRACE = 15           # seconds the slot of a dropped player is kept for it
+BOT_INTERVAL = 4            # ticks between two moves of a bot
+
+log = logging.getLogger("rooms")
+
+move_time = metrics.histogram("move")
+moves = metrics.counter("moves")
+inputs_dropped = metrics.counter("inputs.dropped")
+rooms_created = metrics.counter("rooms.created")
+rooms_closed = metrics.counter("rooms.closed")
+spectator_frames = metrics.counter("spectator.frames")
+sessions_resumed = metrics.counter("sessions.resumed")
+sessions_expired = metrics.counter("sessions.expired")
+bots_added = metrics.counter("bots.added")
+
+class Room():
+    """ One match: a game object and the clients playing it.
+        All rooms live on the same event loop, so a room needs no lock,
+        nothing else can run while one of its methods does.
+
+        Received inputs are only queued, tick() applies them and
+        broadcasts one message with everything that changed.
+
+        Spectators watch without a player slot. Their frames are sent
+        every spectator_interval ticks and merge the changes of those
+        ticks, each one encoded once and the same bytes object queued
+        for every spectator.
+
+        Every client only gets the cells inside its viewport. A player's
+        viewport follows the player, the spectators share one that
+        follows the first player in the room.
+
+        Every player gets a session token in its WELCOME. When its
+        connection drops the slot is reserved for resume_grace seconds,
+        and only a client sending the token can take the player back.
+
+        Bots from ai.py can take free player slots. They sit in the
+        connection list like clients and queue their moves at the start
+        of every tick, and the room keeps their distance fields up to
+        date with each tick's delta.
+    """
+    def __init__(self, code, g, private=False, max_players=MAX_PLAYERS,
+                 max_inputs_per_tick=MAX_INPUTS_PER_TICK,
+                 max_queued_inputs=MAX_QUEUED_INPUTS,
+                 spectator_interval=SPECTATOR_INTERVAL,
+                 max_spectators=MAX_SPECTATORS, resume_grace=RESUME_GRACE,
+                 bot_interval=BOT_INTERVAL):
+        """
+        Args:
+            code : The room code clients use to join this room
+            g : The game object, already initialized
+            private : Private rooms were asked for by code and are
+                      never used for matchmaking
+            spectator_interval : Ticks between two spectator frames
+            resume_grace : Seconds a dropped player can resume, 0 to
+                           free its slot right away
+            bot_interval : Ticks between two moves of a bot
+        """
+        self.code = code
+        self.game = g
+        self.private = private
+        # player slots with connection objects, index + 1 is the player number
+        self.connections = [None] * max_players
+        # connection -> the Viewport of that player
+        self.views = {}
+        # (seq, direction) waiting for the next tick, one queue per slot
+        self.inputs = [deque() for i in range(max_players)]
+        # last input sequence number applied and dropped, per slot
+        self.applied_seq = [0] * max_players
+        self.dropped_seq = [0] * max_players
+        # session tokens of the player slots, see resumePlayer
+        self.tokens = [None] * max_players
+        # player number -> time.monotonic() its reserved slot is kept until
+        self.reserved = {}
+        self.resume_grace = resume_grace
+        # players whose inputs were handled since the last ACK
+        self.acks_due = set()
+        # connections that asked for a keyframe since the last tick
+        self.sync_requests = set()
+        self.max_inputs_per_tick = max_inputs_per_tick
+        self.max_queued_inputs = max_queued_inputs
+        self.board_sampler = metrics.Sampler(BOARD_LOG_EVERY)
+        self.spectators = set()
+        self.spectator_interval = spectator_interval
+        self.max_spectators = max_spectators
+        # changes since the last spectator frame, (x, y) -> symbol
+        self.spectator_cells = {}
+        self.spectator_message = None
+        # the version the next spectator frame applies to
+        self.spectator_base = g.version
+        self.spectator_view = viewport.Viewport(g.width, g.height)
+        self.spectator_view.centerOn(g.players[1].pos)
+        self.ticks = 0
+        # the last deltas, so a client holding any recent version can be
+        # brought up to date with one frame, and those frames by
+        # (base version, viewport)
+        self.history = deque(maxlen=HISTORY)
+        self.since_cache = {}
+        # player number -> ai.Bot, and the fields the bots share
+        self.bots = {}
+        self.navigator = None
+        self.bot_interval = bot_interval
+        # time.monotonic() of the last time a client took a player slot
+        self.joined = time.monotonic()
+        # set once the WIN went out, the room does not tick after that
+        self.finished = False
+
+    def hasFreeSlot(self):
+        return any(c is None and player not in self.reserved
+                   for player, c in enumerate(self.connections, 1))
+
+    def isEmpty(self):
+        """ No client plays in the room or may come back to it, bots
+            do not count
+        """
+        return not self.reserved and not self.humans()
+
+    def humans(self):
+        """ The number of players connected that are not bots
+        """
+        return sum(1 for player, c in enumerate(self.connections, 1)
+                   if c is not None and player not in self.bots)
+
+    def addPlayer(self, conn, view_size=None):
+        """ Put the connection in the first free player slot and send it
+            the current state
+
+        Args:
+            conn : The connection of the new client, anything with a
+                   send(frame, full_state) method
+            view_size : (width, height) of the client's viewport,
+                        None for the default size
+
+        Returns:
+            The player number which is just the slot index + 1
+            or -1 if all the slots are taken
+        """
+        for i, c in enumerate(self.connections):
+            if c is None and i + 1 not in self.reserved:
+                self.connections[i] = conn
+                self.tokens[i] = secrets.token_bytes(protocol.TOKEN_SIZE)
+                g = self.game
+                view = viewport.Viewport(g.width, g.height, *(view_size or ()))
+                view.centerOn(g.players[i + 1].pos)
+                self.views[conn] = view
+                self.joined = time.monotonic()
+                conn.send(self.keyframe(conn), full_state=True)
+                conn.send(protocol.encodeWelcome(i + 1, self.code, self.tokens[i]))
+                return i + 1
+        return -1
+
+    def addBot(self, seed=None):
+        """ Put a bot in the first free player slot
+
+        Args:
+            seed : Seed for the bot's random moves
+
+        Returns:
+            The player number or -1 if all the slots are taken
+        """
+        for i, c in enumerate(self.connections):
+            if c is None and i + 1 not in self.reserved:
+                if self.navigator is None:
+                    self.navigator = ai.Navigator(self.game)
+                bot = ai.Bot(i + 1, self.navigator, self.bot_interval, seed)
+                self.connections[i] = bot
+                self.bots[i + 1] = bot
+                bots_added.inc()
+                return i + 1
+        return -1
+
+    def resumePlayer(self, conn, token, have, origin, view_size=None):
+        """ Give a player back to a client that sends its session token.
+            The client gets the changes since the version it still has,
+            or a keyframe if that is too old, then the WELCOME and an ACK
+            of the inputs that were handled.
+
+        Args:
+            conn : The new connection of the client
+            token : The token from its WELCOME
+            have : The version the client holds, None if it has none
+            origin : (x, y) of the viewport the client holds it for
+            view_size : (width, height) of the client's viewport
+
+        Returns:
+            The player number, or -1 if no player has that token
+        """
+        player = next((n for n, t in enumerate(self.tokens, 1)
+                       if t is not None and hmac.compare_digest(t, token)), None)
+        if player is None:
+            return -1
+        i = player - 1
+        old = self.connections[i]
+        if old is not None:
+            # the old connection has not noticed it is gone yet
+            self.views.pop(old, None)
+            self.sync_requests.discard(old)
+            old.close()
+        self.reserved.pop(player, None)
+        self.inputs[i].clear()
+        self.connections[i] = conn
+        g = self.game
+        view = viewport.Viewport(g.width, g.height, *(view_size or ()))
+        view.moveTo(origin)
+        view.follow(g.players[player].pos)
+        self.views[conn] = view
+        # a delta only fits the viewport the client has
+        base = have if (view.x, view.y) == tuple(origin) else None
+        frame = self.deltaSince(base, view)
+        if frame is not None:
+            conn.send(frame, full_state=frame[0] == protocol.KEYFRAME)
+        conn.send(protocol.encodeWelcome(player, self.code, token))
+        self.sendAck(player)
+        if self.finished:
+            conn.send(protocol.encodeWin())
+        sessions_resumed.inc()
+        return player
+
+    def addSpectator(self, conn):
+        """ Let a connection watch the room
+
+        Returns:
+            Boolean: False if the room has no room for more spectators
+        """
+        if len(self.spectators) >= self.max_spectators:
+            return False
+        if not self.spectators:
+            # nothing was merged while nobody watched
+            self.spectator_cells.clear()
+            self.spectator_message = None
+            self.spectator_base = self.game.version
+        self.spectators.add(conn)
+        conn.send(self.keyframe(conn), full_state=True)
+        conn.send(protocol.encodeWelcome(0, self.code))
+        if self.finished:
+            conn.send(protocol.encodeWin())
+        return True
+
+    def removeSpectator(self, conn):
+        self.spectators.discard(conn)
+        self.sync_requests.discard(conn)
+
+    def closeSpectators(self, reason):
+        """ Send every spectator what is left to see, then an ERROR,
+            and disconnect it
+        """
+        self.flushSpectators()
+        error = protocol.encodeError(reason)
+        for c in self.spectators:
+            c.send(error)
+            c.close()
+        self.spectators.clear()
+
+    def removePlayer(self, player, reserve=False):
+        """
+        Args:
+            player : The player number
+            reserve : Keep the slot for resume_grace seconds, for a
+                      connection that dropped and may come back
+        """
+        conn = self.connections[player - 1]
+        self.connections[player - 1] = None
+        self.bots.pop(player, None)
+        self.views.pop(conn, None)
+        self.inputs[player - 1].clear()
+        self.acks_due.discard(player)
+        self.sync_requests.discard(conn)
+        if reserve and self.resume_grace > 0:
+            # the seqs stay, so inputs the client sends again after
+            # resuming are not applied twice
+            self.reserved[player] = time.monotonic() + self.resume_grace
+        else:
+            self.freeSlot(player)
+
+    def freeSlot(self, player):
+        self.tokens[player - 1] = None
+        self.applied_seq[player - 1] = 0
+        self.dropped_seq[player - 1] = 0
+        self.reserved.pop(player, None)
+
+    def expireReservations(self, now):
+        """ Free the reserved slots whose grace period is over
+
+        Returns:
+            Boolean: True if any slot was freed
+        """
+        expired = [player for player, deadline in self.reserved.items() if deadline <= now]
+        for player in expired:
+            self.freeSlot(player)
+            sessions_expired.inc()
+            log.info("Player %d of room %s did not come back", player, self.code)
+        return bool(expired)
+
+    def viewOf(self, conn):
+        """ The Viewport of a player or spectator connection
+        """
+        view = self.views.get(conn)
+        if view is None and conn in self.spectators:
+            return self.spectator_view
+        return view
+
+    def keyframe(self, conn=None):
+        """ Keyframe of what conn sees, of the whole board if conn is None
+        """
+        view = self.viewOf(conn) if conn is not None else None
+        return protocol.encodeKeyframe(self.game.snapshot, view.rect() if view else None)
+
+    def broadcast(self, byte_message, full_state=False):
+        """ Queue a message for every client in the room. Nothing is written
+            here, each client's writer sends it when the socket is ready.
+
+        Args:
+            byte_message : The bytes to send
+            full_state : True if the message replaces the whole state
+        """
+        for c in self.connections:
+            if c is not None:
+                c.send(byte_message, full_state)
+
+    def broadcastSpectators(self, byte_message, full_state=False):
+        for c in self.spectators:
+            c.send(byte_message, full_state)
+
+    def queueDepths(self):
+        """ Frames waiting to be sent, per player number, and the
+            longest queue of any spectator
+        """
+        depths = {player: len(c.queue)
+                  for player, c in enumerate(self.connections, 1)
+                  if c is not None and player not in self.bots}
+        if self.spectators:
+            depths["spectators"] = max(len(c.queue) for c in list(self.spectators))
+        return depths
+
+    def queueInput(self, player, direction, seq=0):
+        """ Queue a move for the next tick. When the queue is full the
+            input is dropped, so a client spamming keys only loses its own
+            moves and never makes a tick more expensive for everyone else.
+
+        Args:
+            player : The player number
+            direction : up/down/left/right
+            seq : The client's sequence number of the input
+        """
+        queue = self.inputs[player - 1]
+        if seq and seq <= self.applied_seq[player - 1]:
+            return      # sent again after a resume, it was applied already
+        if len(queue) < self.max_queued_inputs:
+            queue.append((seq, direction))
+        else:
+            inputs_dropped.inc()
+            self.dropInput(player, seq)
+
+    def dropInput(self, player, seq):
+        """ Skip an input, the player's next ACK tells the client it
+            was handled, so its prediction drops it too
+        """
+        self.dropped_seq[player - 1] = seq
+        self.acks_due.add(player)
+
+    def sendAck(self, player):
+        """ Tell a player which of its inputs are handled and where that
+            left it, so its prediction can start over from there
+        """
+        i = player - 1
+        conn = self.connections[i]
+        if conn is None or player in self.bots:
+            return
+        seq = self.applied_seq[i]
+        if not self.inputs[i]:
+            # nothing queued, the dropped inputs are handled too
+            seq = max(seq, self.dropped_seq[i])
+        p = self.game.players[player]
+        conn.send(protocol.encodeAck(seq, p.pos, p.key, p.has_used_key))
+
+    def requestSync(self, conn):
+        self.sync_requests.add(conn)
+
+    def tick(self):
+        """ Apply the queued inputs and broadcast the result once.
+            Players take turns, each round applies at most one input
+            per player, for at most max_inputs_per_tick rounds.
+            The tick a player wins in sends the WIN, after that the
+            room is finished and ticking does nothing.
+        """
+        if self.finished:
+            return
+        g = self.game
+        # expired messages are cleared even when nobody moves
+        g.advance()
+        if self.bots:
+            for player, bot in self.bots.items():
+                direction = bot.decide(g, self.ticks)
+                if direction is not None:
+                    self.queueInput(player, direction)
+        for i in range(self.max_inputs_per_tick):
+            moved = False
+            for player, queue in enumerate(self.inputs, 1):
+                if queue:
+                    (seq, direction) = queue.popleft()
+                    with move_time.time():
+                        g.makeMove(direction, player)
+                    moves.inc()
+                    self.applied_seq[player - 1] = seq
+                    self.acks_due.add(player)
+                    moved = True
+            if not moved:
+                break
+
+        if g.winner:
+            self.finished = True
+            log.info("Room %s was won", self.code)
+            win = protocol.encodeWin()
+            self.broadcast(win, full_state=True)
+            self.broadcastSpectators(win, full_state=True)
+        else:
+            delta = g.takeDelta()
+            if delta is not None:
+                self.history.append(delta)
+                self.since_cache.clear()
+                if self.navigator is not None:
+                    self.navigator.update(delta[1])
+                if self.spectators:
+                    self.mergeForSpectators(delta)
+                if self.board_sampler():
+                    g.printBoard()
+            self.sendState(delta)
+            self.ticks += 1
+            # players are served first, spectators only get the
+            # frames that are left over in this tick
+            if self.ticks % self.spectator_interval == 0:
+                self.flushSpectators()
+        for player in self.acks_due:
+            self.sendAck(player)
+        self.acks_due.clear()
+        if self.sync_requests:
+            for c in self.sync_requests:
+                # the queued ACKs stay and follow the keyframe
+                c.send(self.keyframe(c), full_state=True)
+            self.sync_requests.clear()
+
+    def sendState(self, delta):
+        """ Send every player the changes inside its viewport. A viewport
+            that had to follow its player is sent as a keyframe instead,
+            players whose viewports cover the same area share one frame.
+
+        Args:
+            delta : This tick's delta from Game.takeDelta, None if
+                    nothing changed
+        """
+        players = self.game.players
+        frames = {}
+        for player, c in enumerate(self.connections, 1):
+            view = self.views.get(c)
+            if view is None:
+                continue    # an empty slot or a bot
+            if view.follow(players[player].pos):
+                c.send(self.keyframe(c), full_state=True)
+            elif delta is not None:
+                rect = view.rect()
+                frame = frames.get(rect)
+                if frame is None:
+                    frame = frames[rect] = protocol.encodeDelta(delta, rect=rect)
+                c.send(frame)
+
+    def deltaSince(self, base, view):
+        """ One frame that brings a client holding version base up to
+            date: the merged deltas since base, or a keyframe if base is
+            unknown or older than the history. Frames are cached until
+            the next tick, clients holding the same version of the same
+            viewport share one.
+
+        Args:
+            base : The version the client has, None if it has none
+            view : The client's Viewport
+
+        Returns:
+            bytes: The frame or None if the client is up to date
+        """
+        g = self.game
+        if base == g.version:
+            return None
+        rect = view.rect()
+        frame = self.since_cache.get((base, rect))
+        if frame is not None:
+            return frame
+        history = self.history
+        if base is None or base > g.version or not history or base < history[0][0] - 1:
+            frame = protocol.encodeKeyframe(g.snapshot, rect)
+        else:
+            merged = {}
+            message = None
+            for (version, cells, msg) in history:
+                if version > base:
+                    for (x, y, sym) in cells:
+                        merged[(x, y)] = sym
+                    if msg is not None:
+                        message = msg
+            cells = [(x, y, sym) for (x, y), sym in merged.items()]
+            frame = protocol.encodeDelta((g.version, cells, message), base, rect)
+        self.since_cache[(base, rect)] = frame
+        return frame
+
+    def mergeForSpectators(self, delta):
+        (version, cells, message) = delta
+        merged = self.spectator_cells
+        for (x, y, sym) in cells:
+            merged[(x, y)] = sym
+        if message is not None:
+            self.spectator_message = message
+
+    def flushSpectators(self):
+        """ Encode the changes merged since the last spectator frame
+            once and queue the same frame for every spectator
+        """
+        g = self.game
+        if not self.spectators:
+            self.spectator_base = g.version
+            return
+        view = self.spectator_view
+        followed = next((player for player, c in enumerate(self.connections, 1)
+                         if c is not None), None)
+        if followed is not None and view.follow(g.players[followed].pos):
+            frame = protocol.encodeKeyframe(g.snapshot, view.rect())
+            self.broadcastSpectators(frame, full_state=True)
+        elif not self.spectator_cells and self.spectator_message is None:
+            return
+        else:
+            cells = [(x, y, sym) for (x, y), sym in self.spectator_cells.items()]
+            frame = protocol.encodeDelta((g.version, cells, self.spectator_message),
+                                         self.spectator_base, view.rect())
+            self.broadcastSpectators(frame)
+        spectator_frames.inc()
+        self.spectator_cells.clear()
+        self.spectator_message = None
+        self.spectator_base = g.version
+
+class RoomManager():
+    """ Creates, finds and tears down the rooms of one server process.
+        A client either names a room code, which creates the room if it
+        does not exist yet, or is matched into any public room with a
+        free slot.
+
+        Public rooms where a client has waited fill_bots seconds for
+        company get bots in their free slots, and bot_rooms rooms are
+        played by bots only, to load the server without clients.
+    """
+    def __init__(self, width=80, height=30, max_players=MAX_PLAYERS,
+                 max_inputs_per_tick=MAX_INPUTS_PER_TICK,
+                 max_queued_inputs=MAX_QUEUED_INPUTS, record_dir=None,
+                 spectator_interval=SPECTATOR_INTERVAL,
+                 max_spectators=MAX_SPECTATORS, resume_grace=RESUME_GRACE,
+                 bot_interval=BOT_INTERVAL, fill_bots=None, bot_rooms=0,
+                 input_rate=ratelimit.INPUT_RATE, input_burst=ratelimit.INPUT_BURST):
+        """
+        Args:
+            width, height : The board size of new rooms
+            max_players : Players per room
+            record_dir : Directory to record every room's moves in,
+                         see replay.py, None to not record
+            spectator_interval : Ticks between two spectator frames
+            max_spectators : Spectators per room
+            resume_grace : Seconds a dropped player can resume its session
+            bot_interval : Ticks between two moves of a bot
+            fill_bots : Seconds a client waits in a public room before
+                        bots take the free slots, None to never add bots
+            bot_rooms : Rooms to keep running with bots only
+            input_rate, input_burst : The input limits of every client,
+                                      see ratelimit.py
+        """
+        self.width = width
+        self.height = height
+        self.max_players = max_players
+        self.max_inputs_per_tick = max_inputs_per_tick
+        self.max_queued_inputs = max_queued_inputs
+        self.record_dir = record_dir
+        self.spectator_interval = spectator_interval
+        self.max_spectators = max_spectators
+        self.resume_grace = resume_grace
+        self.bot_interval = bot_interval
+        self.fill_bots = fill_bots
+        self.bot_rooms = bot_rooms
+        self.input_rate = input_rate
+        self.input_burst = input_burst
+        # codes of the rooms played by bots only
+        self.bot_codes = set()
+        if record_dir is not None:
+            os.makedirs(record_dir, exist_ok=True)
+        # room code -> Room
+        self.rooms = {}
+        # called after a room is created or closed, see workers.py
+        self.on_change = None
+        # public rooms that have a free slot, in creation order
+        self.open_rooms = {}
+        # maps are generated ahead of time, a new room only loads one
+        self.maps = mapgen.MapPool(width, height, max_players)
+        metrics.gauge("rooms", lambda: len(self.rooms))
+        metrics.gauge("send_queue_depth", self.queueDepths)
+        metrics.gauge("spectators", lambda: sum(len(r.spectators)
+                                                for r in list(self.rooms.values())))
+        metrics.gauge("bots", lambda: sum(len(r.bots) for r in list(self.rooms.values())))
+
+    def newCode(self):
+        while True:
+            code = "".join(random.choices(string.ascii_uppercase, k=CODE_LENGTH))
+            if code not in self.rooms:
+                return code
+
+    def createRoom(self, code=None, private=False):
+        """ Start a new game in a new room
+
+        Args:
+            code : The room code, a random one if None
+            private : Whether matchmaking should skip the room
+
+        Returns:
+            Room: The new room
+        """
+        if code is None:
+            code = self.newCode()
+        g = game.Game(self.width, self.height, self.max_players)
+        board_map = self.maps.take()
+        g.initBoard(board_map)
+        if self.record_dir is not None:
+            # worker processes share the directory and may reuse codes
+            name = f"{code}-{int(time.time())}-{os.getpid()}{replay.EXTENSION}"
+            g.recorder = replay.Recorder(os.path.join(self.record_dir, name),
+                                         g, board_map)
+        room = Room(code, g, private, self.max_players,
+                    self.max_inputs_per_tick, self.max_queued_inputs,
+                    self.spectator_interval, self.max_spectators,
+                    self.resume_grace, self.bot_interval)
+        self.rooms[code] = room
+        if not private:
+            self.open_rooms[code] = room
+        rooms_created.inc()
+        log.info("Created room %s (map seed %d)", code, g.seed)
+        if self.on_change is not None:
+            self.on_change()
+        return room
+
+    def createBotRoom(self):
+        """ Start a room with a bot in every slot. It is private, so
+            no client is matched into it, but it can be watched.
+        """
+        room = self.createRoom(private=True)
+        while room.addBot() != -1:
+            pass
+        self.bot_codes.add(room.code)
+        log.info("Room %s is played by %d bots", room.code, len(room.bots))
+        return room
+
+    def fillWithBots(self, room):
+        """ Give the free slots of a room to bots
+        """
+        added = 0
+        while room.addBot() != -1:
+            added += 1
+        self.open_rooms.pop(room.code, None)
+        log.info("Added %d bots to room %s", added, room.code)
+
+    def stopBots(self):
+        """ Close the rooms played by bots only and start no new ones
+        """
+        self.bot_rooms = 0
+        for code in list(self.bot_codes):
+            self.closeRoom(self.rooms[code])
+
+    def join(self, conn, code="", view_size=None):
+        """ Put a connection in a room
+
+        Args:
+            conn : The connection of the client
+            code : The room code, "" for matchmaking
+            view_size : (width, height) of the client's viewport, see Room.addPlayer
+
+        Returns:
+            tuple: (room, player number) or (None, reason) if the room is full
+        """
+        if code:
+            room = self.rooms.get(code)
+            if room is None:
+                room = self.createRoom(code, private=True)
+            elif room.finished:
+                return (None, f"Room {code} has ended")
+        else:
+            # oldest open room first, so rooms fill up before new ones start
+            room = next(iter(self.open_rooms.values()), None)
+            if room is None:
+                room = self.createRoom()
+        player = room.addPlayer(conn, view_size)
+        if player == -1:
+            return (None, f"Room {code} is full")
+        if not room.hasFreeSlot():
+            self.open_rooms.pop(room.code, None)
+        return (room, player)
+
+    def resume(self, conn, code, token, have, origin, view_size=None):
+        """ Give a client back its player, see Room.resumePlayer
+
+        Args:
+            code : The room code from the client's WELCOME
+            token, have, origin : From the client's JOIN, see protocol.decodeJoin
+
+        Returns:
+            tuple: (room, player number) or (None, reason) if the session
+                   is not there any more
+        """
+        room = self.rooms.get(code)
+        if room is None:
+            return (None, f"Room {code} has ended")
+        player = room.resumePlayer(conn, token, have, origin, view_size)
+        if player == -1:
+            return (None, "The session has expired")
+        return (room, player)
+
+    def spectate(self, conn, code):
+        """ Attach a spectator to a running room
+
+        Args:
+            conn : The connection of the spectator
+            code : The room code
+
+        Returns:
+            tuple: (room, 0) or (None, reason) if it cannot watch the room
+        """
+        room = self.rooms.get(code)
+        if room is None:
+            return (None, f"There is no room {code}" if code
+                          else "Spectators have to name a room")
+        if not room.addSpectator(conn):
+            return (None, f"Room {code} has too many spectators")
+        return (room, 0)
+
+    def newLimiter(self):
+        """ The InputLimiter for a new client connection
+        """
+        return ratelimit.InputLimiter(self.input_rate, self.input_burst)
+
+    def stopSpectating(self, room, conn):
+        room.removeSpectator(conn)
+
+    def leave(self, room, player, conn=None, reserve=False):
+        """ Take a player out of its room, the room is closed when
+            the last player leaves and its spectators are disconnected
+
+        Args:
+            conn : The connection that left, nothing happens if another
+                   connection has resumed the player since
+            reserve : Keep the slot for the player to resume, see Room.removePlayer
+        """
+        if conn is not None and room.connections[player - 1] is not conn:
+            return
+        room.removePlayer(player, reserve)
+        self.update(room)
+
+    def update(self, room):
+        """ Close a room nobody is in any more, or offer its free slots
+            to matchmaking
+        """
+        if room.isEmpty() and room.code not in self.bot_codes:
+            self.closeRoom(room)
+        elif not room.private and not room.finished and room.hasFreeSlot():
+            self.open_rooms[room.code] = room
+
+    def closeRoom(self, room):
+        room.closeSpectators("The match is over")
+        self.rooms.pop(room.code, None)
+        self.open_rooms.pop(room.code, None)
+        self.bot_codes.discard(room.code)
+        if room.game.recorder is not None:
+            room.game.recorder.close(room.game)
+        rooms_closed.inc()
+        log.info("Closed room %s", room.code)
+        if self.on_change is not None:
+            self.on_change()
+
+    def tick(self):
+        now = time.monotonic()
+        for room in list(self.rooms.values()):
+            room.tick()
+            if room.reserved and room.expireReservations(now):
+                self.update(room)
+            if room.finished:
+                if room.code in self.bot_codes:
+                    # the bots start over in a new room
+                    self.closeRoom(room)
+                else:
+                    # nobody new gets into a match that is over
+                    self.open_rooms.pop(room.code, None)
+        if self.fill_bots is not None:
+            for room in list(self.open_rooms.values()):
+                if now - room.joined >= self.fill_bots and room.humans():
+                    self.fillWithBots(room)
+        while len(self.bot_codes) < self.bot_rooms:
+            self.createBotRoom()
+
+    def queueDepths(self):
+        return {code: room.queueDepths() for code, room in list(self.rooms.items())}
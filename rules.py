@@ -0,0 +1,69 @@
+""" Movement rules shared by the server's Game and the client's prediction.
+
+Only what decides where a move ends up lives here, so the client can run
+the same code on its copy of the board. Everything else, like messages
+and winning, stays in game.py.
+"""
+
+# board cells are stored as single bytes
+EMPTY = ord(' ')
+WALL = ord('#')
+KEY = ord('K')
+GATE = ord('=')
+CHEST = ord('*')
+
+# symbol of player n is PLAYER_SYMBOLS[n - 1], none of them is a map symbol
+PLAYER_SYMBOLS = "123456789abcdefghijklmnopqrstuvwxyz"
+PLAYER_BYTES = frozenset(PLAYER_SYMBOLS.encode())
+
+# x and y delta for each direction key
+DIRECTION_STEPS = {
+    'up': (0, -1),
+    'down': (0, 1),
+    'left': (-1, 0),
+    'right': (1, 0)
+}
+
+def step(pos, direction):
+    """ The position one step from pos in direction
+    """
+    (dx, dy) = DIRECTION_STEPS[direction]
+    return (pos[0] + dx, pos[1] + dy)
+
+def canEnter(sym, has_key, has_used_key, occupied):
+    """ Whether a player can move onto a cell
+
+    Args:
+        sym : The byte value of the cell
+        has_key : The player carries a key
+        has_used_key : The player has opened a gate already
+        occupied : Another player stands on the cell
+
+    Returns:
+        Boolean: True if the move is possible
+    """
+    #we can't go to the next position if it is:
+    #1, a '#' symbol (wall)
+    #2, a 'K' (key) and the player already picked up a key
+    #3, a 'K' (key) and the player has already used a key
+    #4, another player
+    #5, a gate and the player has no key
+    if sym == WALL or occupied:
+        return False
+    if sym == KEY:
+        return not (has_key or has_used_key)
+    if sym == GATE:
+        return bool(has_key)
+    return True
+
+def inventoryAfter(sym, has_key, has_used_key):
+    """ The key flags of a player after it entered a cell
+
+    Returns:
+        tuple: (has_key, has_used_key)
+    """
+    if sym == KEY:
+        return (True, has_used_key)
+    if sym == GATE:
+        return (False, True)
+    return (has_key, has_used_key)
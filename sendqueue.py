@@ -0,0 +1,125 @@
+from collections import deque
+
+import protocol
+
+MAX_FRAMES = 64     # frames a client can have waiting before it is collapsed
+MAX_OVERFLOWS = 3   # collapses in a row before the client is dropped
+# frames carrying the board, only these are ever dropped
+STATE_FRAMES = (protocol.KEYFRAME, protocol.DELTA)
+
+class SlowConsumerError(Exception):
+    """ Raised when a client keeps falling behind and should be disconnected
+    """
+
+class SendQueue():
+    """ Bounded queue of the frames waiting to be sent to one client.
+        The engines push to it from the game side and a separate writer
+        drains it, so a client that reads slowly only delays itself.
+
+        Deltas only make sense in order, so when the queue is full they
+        are all dropped and the client gets one keyframe of the latest
+        state instead. A client that needs that too often is cut off.
+        Only the state frames are dropped: the other frames, like the
+        WELCOME, the ACKs and an ERROR, stay in order and are sent after
+        the keyframe that replaces the state.
+    """
+    def __init__(self, keyframe, max_frames=MAX_FRAMES, max_overflows=MAX_OVERFLOWS):
+        """
+        Args:
+            keyframe : Callable returning a keyframe of the current state
+            max_frames : How many frames can wait before the queue collapses
+            max_overflows : Collapses without a full drain before we give up
+        """
+        self.frames = deque()
+        self.keyframe = keyframe
+        self.max_frames = max_frames
+        self.max_overflows = max_overflows
+        # the queued deltas were dropped, send a keyframe next
+        self.needs_keyframe = False
+        self.overflows = 0
+        # total frames dropped, for stats
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames) + self.needs_keyframe
+
+    def push(self, frame, full_state=False):
+        """ Queue a frame for the client
+
+        Args:
+            frame : The bytes to send
+            full_state : True for frames that replace the whole state
+                         (keyframes, the win message), the state frames
+                         queued before them are stale and get dropped
+
+        Raises:
+            SlowConsumerError: if the client has fallen behind too many times
+        """
+        state = frame[0] in STATE_FRAMES
+        if full_state:
+            self.dropState()
+            self.needs_keyframe = False
+            if state:
+                # the keyframe goes first, the frames that are left
+                # follow it
+                self.frames.appendleft(frame)
+                return
+        elif state and self.needs_keyframe:
+            # the keyframe sent at drain time will include this change
+            self.dropped += 1
+            return
+        elif len(self.frames) >= self.max_frames:
+            # a keyframe at drain time replaces the queued state, of the
+            # ACKs only the latest one matters
+            self.dropState()
+            self.dropOldAcks()
+            self.needs_keyframe = True
+            self.overflows += 1
+            if self.overflows > self.max_overflows:
+                raise SlowConsumerError("Client is not keeping up")
+            if state:
+                self.dropped += 1
+                return
+        self.frames.append(frame)
+
+    def dropState(self):
+        """ Drop the queued state frames, keeping the others in order
+        """
+        kept = deque(f for f in self.frames if f[0] not in STATE_FRAMES)
+        self.dropped += len(self.frames) - len(kept)
+        self.frames = kept
+
+    def dropOldAcks(self):
+        """ Drop every queued ACK but the last one, which covers the
+            inputs of the older ones
+        """
+        acks = sum(1 for f in self.frames if f[0] == protocol.ACK)
+        if acks > 1:
+            kept = deque()
+            for f in self.frames:
+                if f[0] == protocol.ACK and acks > 1:
+                    acks -= 1
+                    continue
+                kept.append(f)
+            self.dropped += len(self.frames) - len(kept)
+            self.frames = kept
+
+    def take(self):
+        """ Take everything that is waiting to be sent
+
+        Returns:
+            list: The frames in the order they should be written
+        """
+        frames = list(self.frames)
+        if self.needs_keyframe:
+            self.needs_keyframe = False
+            frames.insert(0, self.keyframe())
+        self.frames.clear()
+        return frames
+
+    def drained(self):
+        """ Called by the writer once everything it took has been sent,
+            a client that catches up is forgiven its earlier overflows.
+        """
+        if not self.frames and not self.needs_keyframe:
+            self.overflows = 0
@@ -1,22 +1,132 @@
+import argparse
+import hmac
+import logging
+import secrets
 import socket
 import sys
 import time
 
+import ai
+import aioserver
 import game
+import metrics
+import protocol
+import ratelimit
+import rooms
+import workers
 import threading
 from _thread import *
+from sendqueue import SendQueue, SlowConsumerError
 
 HOST = "127.0.0.1"
 PORT = 65000
+# log the full board on one in this many moves at debug level
+BOARD_LOG_EVERY = 100
+# seconds between two runs of the game's timers, for when nobody moves
+TIMER_INTERVAL = 0.1
 turn_lock = threading.Lock()
-#list of the client connection objects
+log = logging.getLogger("server")
+
+lock_wait_time = metrics.histogram("turn_lock.wait")
+move_time = metrics.histogram("move")
+moves = metrics.counter("moves")
+invalid_inputs = metrics.counter("inputs.invalid")
+frames_sent = metrics.counter("frames.sent")
+bytes_sent = metrics.counter("bytes.sent")
+slow_consumers = metrics.counter("clients.slow_dropped")
+board_sampler = metrics.Sampler(BOARD_LOG_EVERY)
+#list of the ClientSender objects of the connected clients
 connections = []
+#session tokens and last applied input seqs, by player number - 1
+tokens = []
+applied_seq = []
+#player number -> time.monotonic() the slot of a dropped player is kept until
+reserved = {}
+resume_grace = rooms.RESUME_GRACE
+# (rate, burst) of every client's InputLimiter
+input_limits = (ratelimit.INPUT_RATE, ratelimit.INPUT_BURST)
+#set under turn_lock once the WIN went out, later moves are dropped
+win_sent = False
+
+class ClientSender():
+    """ Sends the frames queued for one client from its own thread,
+        so a client that reads slowly never blocks the player who moved.
+    """
+    def __init__(self, conn, g):
+        self.conn = conn
+        self.game = g
+        self.cond = threading.Condition()
+        self.queue = SendQueue(self.keyframe)
+        self.closed = False
+        # replaced by a per-player histogram once we know the player
+        self.send_time = metrics.histogram("send")
+
+    def keyframe(self):
+        # called with self.cond held, the published snapshot needs no
+        # turn_lock, so a move in progress does not hold this up
+        return protocol.encodeKeyframe(self.game.snapshot)
+
+    def send(self, frame, full_state=False):
+        """ Queue a frame and wake up the sender thread.
+            A client that keeps falling behind is disconnected.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            try:
+                self.queue.push(frame, full_state)
+            except SlowConsumerError as e:
+                log.warning("%s", e)
+                slow_consumers.inc()
+                self.close()
+                return
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            # wakes up the receiving thread as well
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        """ Sender thread main loop
+        """
+        try:
+            while True:
+                with self.cond:
+                    while not len(self.queue) and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    frames = self.queue.take()
+                data = b"".join(frames)
+                with self.send_time.time():
+                    self.conn.sendall(data)
+                frames_sent.inc(len(frames))
+                bytes_sent.inc(len(data))
+                with self.cond:
+                    self.queue.drained()
+        except Exception as e:
+            log.info("Sender stopped: %s", e)
+            self.close()
+
+def queueDepths():
+    """ Frames waiting to be sent, per player number
+    """
+    return {player: len(c.queue)
+            for player, c in enumerate(connections, 1)
+            if c is not None}
 
 def appendConnection(conn):
-    """ Append connection to correct index if the connections list
+    """ Append connection to correct index if the connections list.
+        Call with turn_lock held.
 
     Args:
-        conn : the connection to client (fd) returned upon socket.accept()
+        conn : the ClientSender of the new client
 
     Returns:
         The "player" number which is just connections index + 1
@@ -25,19 +135,95 @@ def appendConnection(conn):
     # to begin with we just append the connections
     if(len(connections) < 2):
         connections.append(conn)
+        tokens.append(secrets.token_bytes(protocol.TOKEN_SIZE))
+        applied_seq.append(0)
         return len(connections)
     # if we get here, it means that a client has disconnected
-    # and is trying to connect again
-    # so we need to add the connection object to the correct index
+    # and someone is trying to connect again
+    # so we need to add the connection object to the correct index,
+    # unless the slot is kept for the player who dropped
     else:
+        now = time.monotonic()
         for i, c in enumerate(connections):
-            if c == None: # client has disconnected here
-                print("Replacing connection: " + str(i))
+            if c == None and reserved.get(i + 1, 0) <= now:
+                log.info("Replacing connection: %d", i)
+                reserved.pop(i + 1, None)
                 connections[i] = conn
+                tokens[i] = secrets.token_bytes(protocol.TOKEN_SIZE)
+                applied_seq[i] = 0
                 return i + 1
-        # no connections were "None" so we already have two players connected
+        # no free slots so we already have two players connected
         return -1
-        
+
+def resumeConnection(conn, token):
+    """ Give a player back to the client with its session token.
+        Call with turn_lock held.
+
+    Returns:
+        The player number or -1 if no player has that token
+    """
+    now = time.monotonic()
+    for i, t in enumerate(tokens):
+        if hmac.compare_digest(t, token):
+            old = connections[i]
+            if old is None and reserved.get(i + 1, 0) <= now:
+                return -1   # too late, the slot is free for anyone
+            if old is not None:
+                # the old connection has not noticed it is gone yet
+                old.close()
+            reserved.pop(i + 1, None)
+            connections[i] = conn
+            return i + 1
+    return -1
+
+def readJoin(conn):
+    """ Wait for the JOIN a client sends first
+
+    Returns:
+        tuple: (resume or None, the FrameReader, frames after the JOIN),
+               see protocol.decodeJoin
+    """
+    # nothing a client sends is bigger than a JOIN
+    reader = protocol.FrameReader(ratelimit.MAX_CLIENT_FRAME)
+    frames = []
+    conn.settimeout(aioserver.JOIN_TIMEOUT)
+    try:
+        while not frames:
+            data = conn.recv(4096)
+            if not data:
+                raise ConnectionError("Client disconnected")
+            frames = reader.feed(data)
+    except socket.timeout:
+        return (None, reader, [])
+    if frames[0][0] == protocol.JOIN:
+        (role, code, view, method, resume) = protocol.decodeJoin(frames[0][1])
+        return (resume, reader, frames[1:])
+    return (None, reader, frames)
+
+def broadcast(byte_message, full_state=False):
+    """ Queue a frame for every connected client, their sender
+        threads write it out
+    """
+    for c in connections:
+        if c is not None:
+            c.send(byte_message, full_state)
+
+def runTimers(g):
+    """ Fire the game's timers that are due, like the reset of an old
+        message, and broadcast what they changed. Moves run the timers
+        too, this thread makes them fire on time when nobody moves.
+    """
+    while True:
+        time.sleep(TIMER_INTERVAL)
+        with turn_lock:
+            if win_sent:
+                return
+            g.advance()
+            # nothing is left over from a move, that read took its delta
+            delta = g.takeDelta()
+        if delta is not None:
+            broadcast(protocol.encodeDelta(delta))
+
 def listen(sock, g):
     """ Function for listening to socket and then handling new client connections
 
@@ -49,72 +235,306 @@ def listen(sock, g):
     while True:
         # accept  new connection
         conn, addr = sock.accept()
-        # append connection object and get player nr
-        player = appendConnection(conn)
-        if player == -1:
-            print("Can't handle more than two clients")
-            continue
-        conn.settimeout(300) # 5min
-        print(f"Connected by {addr}")
-        # start a new thread that handles communication with the 
-        # newly added client
-        start_new_thread(clientCommunicator, (conn, g, player))
-
-def clientCommunicator(conn, g, player):
+        # the JOIN is read on the client's own thread
+        start_new_thread(handshake, (conn, addr, g))
+
+def handshake(conn, addr, g):
+    """ Give a new client a player slot, or its old one back if it
+        sends a session token, then serve it
+
+    Args:
+        conn : The client's socket
+        addr : The client's address
+        g : the game object
+    """
+    try:
+        (resume, reader, frames) = readJoin(conn)
+    except (OSError, protocol.ProtocolError) as e:
+        if isinstance(e, protocol.ProtocolError):
+            ratelimit.protocol_errors.inc()
+        log.info("Client %s left before joining: %r", addr, e)
+        conn.close()
+        return
+    # append connection object and get player nr
+    sender = ClientSender(conn, g)
+    with turn_lock:
+        if resume is not None:
+            player = resumeConnection(sender, resume[0])
+            reason = "The session has expired"
+        else:
+            player = appendConnection(sender)
+            reason = "Server is full"
+    if player == -1:
+        log.warning("Refused %s: %s", addr, reason)
+        try:
+            conn.sendall(protocol.encodeError(reason))
+        except OSError:
+            pass
+        conn.close()
+        return
+    conn.settimeout(300) # 5min
+    sender.send_time = metrics.histogram(f"send.player{player}")
+    log.info("Connected by %s as player %d%s", addr, player,
+             " (resumed)" if resume is not None else "")
+    # start a thread that sends to the newly added client,
+    # this one handles the communication with it
+    start_new_thread(sender.run, ())
+    clientCommunicator(sender, g, player, reader, frames, resume is not None)
+
+def clientCommunicator(sender, g, player, reader=None, frames=(), resumed=False):
     """ The main function for communication with client.
         Should always be run from a separate thread.
         Receives messages, updates game state and responds with new state.
 
     Args:
-        conn : the connection to client (fd) returned upon socket.accept()
+        sender : the ClientSender of the client
         g : the game object
         player : the player who is making the move (1 or 2)
+        reader : The client's FrameReader, a new one if None
+        frames : Frames that arrived with the JOIN
+        resumed : The client took its player back with its token. There is
+                  no history of the state here, so unlike a room it gets a
+                  keyframe whatever version it still has, then the WELCOME
+                  and the ACK like in Room.resumePlayer.
 
     Raises:
         error: when a disconnection happens, we update the connections array
     """
+    global win_sent
+    conn = sender.conn
     try:
-        byte_message = bytes(g.boardToString(), 'utf-8')
-        conn.sendall(byte_message)
+        # a new client starts from a full keyframe of the published state,
+        # the following deltas build on its version
+        snapshot = g.snapshot
+        sender.send(protocol.encodeKeyframe(snapshot), full_state=True)
+        # this engine runs a single game, there is no room code
+        sender.send(protocol.encodeWelcome(player, "", tokens[player - 1]))
+        if resumed:
+            # where the inputs handled before the drop left the player
+            (pos, has_key, has_used_key) = snapshot.players[player - 1]
+            sender.send(protocol.encodeAck(applied_seq[player - 1], pos,
+                                           has_key, has_used_key))
+        if win_sent:
+            sender.send(protocol.encodeWin())
+        if reader is None:
+            reader = protocol.FrameReader(ratelimit.MAX_CLIENT_FRAME)
+        limiter = ratelimit.InputLimiter(*input_limits)
+        # reused for every recv, the frame reader copies what it keeps
+        recv_buffer = bytearray(4096)
         while True:
-            data = conn.recv(1024).decode("utf-8")
-            if not data:    # connection is closed
-                raise error("Client disconnected")
-            print("Received: " + str(data))
+            if frames:
+                # the frames that came with the JOIN, handled once
+                (received, frames) = (frames, ())
+            else:
+                nbytes = conn.recv_into(recv_buffer)
+                if not nbytes:    # connection is closed
+                    raise error("Client disconnected")
+                received = reader.feed(memoryview(recv_buffer)[:nbytes])
+            log.debug("Received %d frames from player %d", len(received), player)
 
-            if not data in ["up", "down", "left", "right"]:
-                g.message = "Invalid move sent to server"
+            # the limits are checked before taking the lock, a client
+            # that floods the server is dropped without holding it
+            checked = []
+            for (kind, payload) in received:
+                if kind == protocol.SYNC:
+                    checked.append((kind, None, limiter.allow(ratelimit.SYNC_COST)))
+                    continue
+                # every other frame takes an input, also the ones ignored
+                allowed = limiter.allow()
+                if kind == protocol.JOIN:
+                    continue    # everyone plays the same game
+                move = protocol.decodeInput(payload) if kind == protocol.INPUT else None
+                if move is None:
+                    limiter.strike()
+                checked.append((kind, move, allowed))
+            if not checked:
+                continue
+
+            # wait for lock to be released before making a 
+            # move to prevent race conditions in the game object
+            wait_start = time.perf_counter()
+            turn_lock.acquire()
+            lock_wait_time.observe(time.perf_counter() - wait_start)
+            sync_requested = False
+            last_seq = None
+            for (kind, move, allowed) in checked:
+                if kind == protocol.SYNC:
+                    sync_requested = sync_requested or allowed
+                elif move is None:
+                    invalid_inputs.inc()
+                else:
+                    (last_seq, direction) = move
+                    if last_seq and last_seq <= applied_seq[player - 1]:
+                        continue    # sent again after a resume
+                    if allowed and not win_sent:
+                        with move_time.time():
+                            g.makeMove(direction, player)
+                        moves.inc()
+                    # a dropped input is acknowledged like an applied one
+                    applied_seq[player - 1] = last_seq
+            # every input of this read goes out in one message,
+            # taking it publishes a new snapshot if anything changed,
+            # and the read that made a winner sends the WIN once
+            full_state = False
+            delta = None
+            if not win_sent:
+                delta = g.takeDelta()
+                full_state = win_sent = g.winner
+            snapshot = g.snapshot
+            turn_lock.release()
+
+            # everything is encoded from this read's snapshot, outside
+            # the lock, so the other player's moves are not held up
+            if full_state:
+                byte_message = protocol.encodeWin()
             else:
-                # wait for lock to be released before making a 
-                # move to prevent race conditions in the game object
-                turn_lock.acquire()
-                g.makeMove(data, player)
-                turn_lock.release()
-
-            byte_message = bytes(g.boardToString(), 'utf-8')
-            g.printBoard()
-            # send updated board to all clients
-            for c in connections: 
-                try:
-                    c.sendall(byte_message)
-                except Exception as e:
-                    print(e)
+                byte_message = protocol.encodeDelta(delta) if delta else None
+            keyframe = protocol.encodeKeyframe(snapshot) if sync_requested else None
+            ack = None
+            if last_seq is not None:
+                (pos, has_key, has_used_key) = snapshot.players[player - 1]
+                ack = protocol.encodeAck(last_seq, pos, has_key, has_used_key)
+
+            if byte_message is not None:
+                if board_sampler():
+                    g.printBoard()
+                broadcast(byte_message, full_state)
+            if keyframe:
+                sender.send(keyframe, full_state=True)
+            if ack:
+                sender.send(ack)
 
     except Exception as e:
-        connections[player - 1] = None
-        print(e)
+        # a client dropped for what it sent does not get its slot kept
+        flooded = isinstance(e, (ratelimit.FloodError, protocol.ProtocolError))
+        if isinstance(e, protocol.ProtocolError):
+            ratelimit.protocol_errors.inc()
+        with turn_lock:
+            # unless a resumed connection has taken the player over,
+            # keep the slot for the player to come back to
+            if connections[player - 1] is sender:
+                connections[player - 1] = None
+                if not flooded:
+                    reserved[player] = time.monotonic() + resume_grace
+        if flooded:
+            log.warning("Disconnecting player %d: %s", player, e)
+        else:
+            log.info("Player %d disconnected: %s", player, e)
+        sender.close()
         conn.close()
 
-def main():
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Game server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    # "asyncio" runs every room and client on a single event loop,
+    # "threads" is the original thread-per-client engine with a single game
+    parser.add_argument("--engine", choices=["asyncio", "threads"],
+                        default="asyncio")
+    # asyncio engine only, the threaded engine moves on every input
+    parser.add_argument("--tick-rate", type=float, default=aioserver.TICK_RATE,
+                        help="simulation steps per second")
+    parser.add_argument("--max-inputs-per-tick", type=int,
+                        default=rooms.MAX_INPUTS_PER_TICK,
+                        help="moves applied per player and tick")
+    parser.add_argument("--width", type=int, default=80,
+                        help="asyncio engine only: board width of new rooms")
+    parser.add_argument("--height", type=int, default=30,
+                        help="asyncio engine only: board height of new rooms")
+    parser.add_argument("--max-players", type=int, default=rooms.MAX_PLAYERS,
+                        help="asyncio engine only: players per room, "
+                             f"at most {len(game.PLAYER_SYMBOLS)}")
+    parser.add_argument("--spectator-rate", type=float, default=aioserver.SPECTATOR_RATE,
+                        help="asyncio engine only: frames per second sent to spectators")
+    parser.add_argument("--max-spectators", type=int, default=rooms.MAX_SPECTATORS,
+                        help="asyncio engine only: spectators per room")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="asyncio engine only: spread the rooms over this "
+                             "many worker processes, 0 runs everything in one process")
+    parser.add_argument("--udp", action="store_true",
+                        help="asyncio engine only: also serve clients over UDP "
+                             "on the same port, see udp.py")
+    parser.add_argument("--udp-loss", type=float, default=0,
+                        help="drop this fraction of the UDP datagrams we send, for testing")
+    parser.add_argument("--udp-reorder", type=float, default=0,
+                        help="delay this fraction of the UDP datagrams we send, for testing")
+    parser.add_argument("--resume-grace", type=float, default=rooms.RESUME_GRACE,
+                        help="seconds the slot of a dropped player is kept for "
+                             "it to resume with its session token")
+    parser.add_argument("--bot-rate", type=float, default=ai.BOT_RATE,
+                        help="asyncio engine only: moves per second of a bot")
+    parser.add_argument("--fill-bots", type=float, default=None, metavar="SECONDS",
+                        help="asyncio engine only: give the free slots of a matchmaking "
+                             "room to bots once a player has waited this long")
+    parser.add_argument("--bot-rooms", type=int, default=0,
+                        help="asyncio engine only: keep this many rooms played by "
+                             "bots only running, per worker with --workers")
+    parser.add_argument("--input-rate", type=float, default=ratelimit.INPUT_RATE,
+                        help="inputs per second a client may send, more are dropped "
+                             "and a client that keeps it up is disconnected, 0 to not limit")
+    parser.add_argument("--input-burst", type=int, default=ratelimit.INPUT_BURST,
+                        help="inputs a client may send at once")
+    parser.add_argument("--record-dir", default=None,
+                        help="asyncio engine only: record the moves of every room "
+                             "in this directory, see replay.py")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--stats-port", type=int, default=0,
+                        help="serve a JSON stats snapshot on this port, 0 to disable")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="log a stats snapshot every this many seconds, 0 to disable")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    logging.basicConfig(level=args.log_level,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.stats_port:
+        metrics.startStatsServer(args.host, args.stats_port)
+    if args.stats_interval:
+        metrics.startPeriodicDump(args.stats_interval)
+    room_options = {
+        "width": args.width,
+        "height": args.height,
+        "max_players": args.max_players,
+        "max_inputs_per_tick": args.max_inputs_per_tick,
+        "record_dir": args.record_dir,
+        "spectator_interval": aioserver.ticksPer(args.tick_rate, args.spectator_rate),
+        "max_spectators": args.max_spectators,
+        "resume_grace": args.resume_grace,
+        "bot_interval": aioserver.ticksPer(args.tick_rate, args.bot_rate),
+        "fill_bots": args.fill_bots,
+        "bot_rooms": args.bot_rooms,
+        "input_rate": args.input_rate,
+        "input_burst": args.input_burst,
+    }
+    udp_options = None
+    if args.udp:
+        if args.engine != "asyncio" or args.workers:
+            sys.exit("--udp needs the asyncio engine without --workers")
+        udp_options = {"loss": args.udp_loss, "reorder": args.udp_reorder}
+    if args.engine == "asyncio" and args.workers:
+        workers.main(args.host, args.port, args.workers, args.tick_rate, room_options)
+        return
+    if args.engine == "asyncio":
+        aioserver.main(args.host, args.port, args.tick_rate, room_options,
+                       udp_options)
+        return
+
+    global resume_grace, input_limits
+    resume_grace = args.resume_grace
+    input_limits = (args.input_rate, args.input_burst)
     # init a new game object
     g = game.Game(80, 30)
     g.initBoard()
+    metrics.gauge("send_queue_depth", queueDepths)
+    start_new_thread(runTimers, (g,))
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         try:
             # enable using an already existing socket
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((HOST, PORT))
+            s.bind((args.host, args.port))
 
             # listen for new connections
             listen(s, g)
@@ -123,8 +543,7 @@ def main():
             s.close()
             sys.exit()
         except Exception as e:
-            print(e)
-            print(e.__class__)
+            log.exception(e)
             s.close()
 
 if __name__ == "__main__":
@@ -0,0 +1,43 @@
+""" Stand-ins for the network side of the servers
+"""
+import protocol
+
+class FakeConnection():
+    """ Keeps what a room sends instead of writing it anywhere
+    """
+    def __init__(self, limiter=None):
+        self.frames = []
+        self.limiter = limiter
+        self.closed = False
+
+    def send(self, frame, full_state=False):
+        self.frames.append(frame)
+
+    def close(self):
+        self.closed = True
+
+    def kinds(self):
+        """ The frame types sent, in order
+        """
+        return [frame[0] for frame in self.frames]
+
+def joinPlayers(manager, count, code=""):
+    """ Join count players with fake connections, all to the same room
+
+    Args:
+        manager : The rooms.RoomManager
+        count : Number of players
+        code : The room code, "" for matchmaking
+
+    Returns:
+        tuple: (room, [FakeConnection of player 1, of player 2, ...])
+    """
+    conns = [FakeConnection(manager.newLimiter()) for i in range(count)]
+    for c in conns:
+        (room, n) = manager.join(c, code)
+    return (room, conns)
+
+def payload(frame):
+    """ The payload of an encoded frame
+    """
+    return protocol.FrameReader().feed(frame)[0][1]
@@ -0,0 +1,71 @@
+import unittest
+
+import ai
+import game
+import mapgen
+import protocol
+import rooms
+from tests.fakes import FakeConnection
+
+def newGame(seed, players=2):
+    g = game.Game(80, 30, players)
+    g.initBoard(mapgen.generateMap(80, 30, seed, players=players))
+    return g
+
+def freshFields(nav, g):
+    """ The fields of nav built from scratch on the current board
+    """
+    fresh = ai.Navigator(g)
+    return {target: fresh.field(target) for target in nav.fields}
+
+class BotTest(unittest.TestCase):
+
+    def play(self, g, bots, nav, ticks=5000, check=False):
+        for tick in range(ticks):
+            for b in bots:
+                direction = b.decide(g, tick)
+                if direction is not None:
+                    g.makeMove(direction, b.player)
+            delta = g.takeDelta()
+            if delta is not None:
+                nav.update(delta[1])
+                if check and delta[1]:
+                    self.assertEqual(nav.fields, freshFields(nav, g))
+            if g.winner:
+                return tick
+        return None
+
+    def testBotsWin(self):
+        for seed in range(3):
+            g = newGame(seed)
+            nav = ai.Navigator(g)
+            bots = [ai.Bot(n, nav, seed=seed * 10 + n) for n in g.players]
+            self.assertIsNotNone(self.play(g, bots, nav), f"no winner with seed {seed}")
+
+    def testUpdatedFieldsMatchRebuilt(self):
+        g = newGame(5, players=3)
+        nav = ai.Navigator(g)
+        bots = [ai.Bot(n, nav, seed=n) for n in g.players]
+        for target in (ai.KEY, ai.GATE, ai.CHEST):
+            nav.field(target)
+        self.play(g, bots, nav, check=True)
+        self.assertTrue(g.winner)
+
+    def testBotRoomIsReplacedOnceWon(self):
+        manager = rooms.RoomManager(80, 30, bot_rooms=1, bot_interval=1)
+        manager.tick()
+        (code,) = manager.bot_codes
+        room = manager.rooms[code]
+        spectator = FakeConnection()
+        manager.spectate(spectator, code)
+        for i in range(5000):
+            manager.tick()
+            if code not in manager.rooms:
+                break
+        self.assertTrue(room.game.winner)
+        self.assertNotIn(code, manager.rooms)
+        self.assertEqual(len(manager.bot_codes), 1)
+        self.assertIn(protocol.WIN, spectator.kinds())
+
+if __name__ == "__main__":
+    unittest.main()
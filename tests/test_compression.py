@@ -0,0 +1,69 @@
+import random
+import unittest
+
+import compression
+import game
+import mapgen
+import protocol
+
+class RleTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        rng = random.Random(1)
+        samples = [b"", b"a", b"aa", b"aaa", b"ab" * 200, bytes(range(256)) * 2]
+        samples += [b"x" * n for n in (127, 128, 129, 130, 131, 132, 133, 400)]
+        samples += [bytes(rng.choice(b"  #K") for i in range(rng.randrange(1000)))
+                    for i in range(50)]
+        for data in samples:
+            self.assertEqual(compression.rleDecode(compression.rleEncode(data)), data)
+
+    def testRunsShrink(self):
+        self.assertEqual(len(compression.rleEncode(b" " * 1000)), 16)
+
+    def testTruncated(self):
+        encoded = compression.rleEncode(b"abc" + b" " * 10)
+        for end in (1, len(encoded) - 1):
+            with self.assertRaises(protocol.ProtocolError):
+                compression.rleDecode(encoded[:end])
+
+class CompressorTest(unittest.TestCase):
+
+    def frames(self):
+        """ A keyframe, deltas and small control frames like a client gets
+        """
+        g = game.Game(80, 30)
+        g.initBoard(mapgen.generateMap(80, 30, 7))
+        frames = [protocol.encodeWelcome(1, "ABCDE"), protocol.encodeKeyframe(g.snapshot)]
+        rng = random.Random(3)
+        for i in range(100):
+            g.makeMove(rng.choice(protocol.DIRECTIONS), rng.choice((1, 2)))
+            delta = g.takeDelta()
+            if delta is not None:
+                frames.append(protocol.encodeDelta(delta))
+            frames.append(protocol.encodeAck(i, (1, 1), False, False))
+        frames.append(protocol.encodeKeyframe(g.snapshot))
+        return frames
+
+    def testRoundTrip(self):
+        frames = self.frames()
+        expected = [(f[0], f[protocol.FRAME_HEADER.size:]) for f in frames]
+        for method in compression.METHODS.values():
+            compressor = compression.Compressor(method)
+            decompressor = compression.Decompressor()
+            reader = protocol.FrameReader()
+            sent = b"".join(compressor.encode(f) for f in frames)
+            self.assertEqual(decompressor.expand(reader.feed(sent)), expected)
+            if method != protocol.COMPRESS_NONE:
+                self.assertLess(len(sent), sum(map(len, frames)))
+
+    def testRleFramesAreShared(self):
+        frame = self.frames()[1]
+        self.assertIs(compression.rleFrame(frame), compression.rleFrame(bytes(frame)))
+
+    def testUdpGetsNoZlib(self):
+        self.assertEqual(compression.choose(protocol.COMPRESS_ZLIB, stateless=True),
+                         protocol.COMPRESS_RLE)
+        self.assertEqual(compression.choose(99), protocol.COMPRESS_NONE)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+import game
+import mapgen
+import rules
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.game = game.Game(40, 20)
+        self.game.initBoard(mapgen.generateMap(40, 20, 1))
+
+    def moveTo(self, player, pos):
+        """ Move a player to an empty cell and publish the change
+        """
+        g = self.game
+        self.assertEqual(g.board[pos[1] * g.width + pos[0]], rules.EMPTY)
+        g.set_player_position(player, pos)
+        return g.takeDelta()
+
+    def emptyCell(self, y):
+        g = self.game
+        return next((x, y) for x in range(1, g.width - 1)
+                    if g.board[y * g.width + x] == rules.EMPTY)
+
+    def testRowsAreShared(self):
+        g = self.game
+        old = g.snapshot
+        (x, y) = g.players[1].pos
+        new_pos = self.emptyCell(y)
+        self.moveTo(1, new_pos)
+        new = g.snapshot
+        self.assertEqual(new.version, old.version + 1)
+        # only the row of the move is copied, the others are the same objects
+        for row in range(g.height):
+            if row == y:
+                self.assertIsNot(new.rows[row], old.rows[row])
+            else:
+                self.assertIs(new.rows[row], old.rows[row])
+
+    def testOldSnapshotDoesNotChange(self):
+        g = self.game
+        old = g.snapshot
+        board = old.boardBytes()
+        (message, players) = (old.message, old.players)
+        self.moveTo(1, self.emptyCell(g.height - 2))
+        g.setMessage("changed")
+        g.takeDelta()
+        self.assertEqual(b"".join(old.rows), board)
+        self.assertEqual((old.message, old.players), (message, players))
+        self.assertNotEqual(g.snapshot.boardBytes(), board)
+
+    def testSnapshotMatchesTheBoard(self):
+        g = self.game
+        for y in (3, 8, 12):
+            self.moveTo(2, self.emptyCell(y))
+            self.assertEqual(g.snapshot.boardBytes(), bytes(g.board))
+            self.assertEqual(g.snapshot.players[1][0], g.players[2].pos)
+        snapshot = g.snapshot
+        self.assertEqual(snapshot.region(2, 3, 5, 4),
+                         b"".join(bytes(g.board[y * g.width + 2:y * g.width + 7])
+                                  for y in range(3, 7)))
+
+    def testNothingChanged(self):
+        g = self.game
+        old = g.snapshot
+        self.assertIsNone(g.takeDelta())
+        self.assertIs(g.snapshot, old)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import mapgen
+import rules
+
+class MapgenTest(unittest.TestCase):
+
+    def testSameSeedSameMap(self):
+        for (width, height, seed) in ((80, 30, 1), (40, 20, 2), (300, 120, 3)):
+            a = mapgen.generateMap(width, height, seed, players=4)
+            b = mapgen.generateMap(width, height, seed, players=4)
+            self.assertEqual((a.board, a.chest, a.spawns, a.keys),
+                             (b.board, b.chest, b.spawns, b.keys))
+        self.assertNotEqual(mapgen.generateMap(80, 30, 1).board,
+                            mapgen.generateMap(80, 30, 2).board)
+
+    def testChestCanBeReached(self):
+        for seed in range(20):
+            m = mapgen.generateMap(80, 30, seed)
+            (cx, cy) = m.chest
+            (x, y) = (cx + mapgen.CHEST_CELL[0], cy + mapgen.CHEST_CELL[1])
+            self.assertEqual(m.board[y * m.width + x], rules.CHEST)
+            self.assertEqual(m.board.count(rules.CHEST), 1)
+            # with every gate open the chest is reachable from the spawn points
+            seen = mapgen.reachable(m.board, m.width, m.height, m.spawns[:1],
+                                    lambda c: c != rules.WALL)
+            for (px, py) in list(m.spawns) + list(m.keys) + [(x, y)]:
+                self.assertTrue(seen[py * m.width + px], f"seed {seed}")
+
+    def testShutChestIsNotPlayable(self):
+        m = mapgen.generateMap(80, 30, 4)
+        board = bytearray(m.board)
+        (cx, cy) = m.chest
+        (x, y) = (cx + mapgen.CHEST_CELL[0], cy + mapgen.CHEST_CELL[1])
+        outer = (cx, cy + 4)
+        inner = (cx + mapgen.CHEST_WIDTH - 4, cy + 4)
+        args = (m.width, m.height, m.spawns, m.keys, (outer, inner), (x, y))
+        self.assertTrue(mapgen.isPlayable(board, *args))
+        # a wall around the chest
+        for (dx, dy) in rules.DIRECTION_STEPS.values():
+            board[(y + dy) * m.width + x + dx] = rules.WALL
+        self.assertFalse(mapgen.isPlayable(board, *args))
+
+    def testSpawnsAreFree(self):
+        m = mapgen.generateMap(80, 30, 5, players=8)
+        self.assertEqual(len(set(m.spawns)), 8)
+        for (x, y) in m.spawns:
+            self.assertEqual(m.board[y * m.width + x], rules.EMPTY)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import random
+import unittest
+
+import client
+import game
+import mapgen
+import protocol
+from tests.fakes import payload
+
+class FrameReaderTest(unittest.TestCase):
+
+    def testFramesSplitAnywhere(self):
+        frames = [protocol.encodeInput("up", 1), protocol.encodeSync(),
+                  protocol.encodeError("bye" * 50)]
+        data = b"".join(frames)
+        for size in (1, 3, 7, len(data)):
+            reader = protocol.FrameReader()
+            got = []
+            for i in range(0, len(data), size):
+                got += reader.feed(data[i:i + size])
+            self.assertEqual(got, [(f[0], payload(f)) for f in frames])
+            self.assertEqual(reader.buffer, b"")
+
+    def testOversizedFrame(self):
+        reader = protocol.FrameReader(64)
+        with self.assertRaises(protocol.ProtocolError):
+            reader.feed(protocol.FRAME_HEADER.pack(protocol.INPUT, 65))
+
+class MessageTest(unittest.TestCase):
+
+    def testInput(self):
+        for (seq, direction) in enumerate(protocol.DIRECTIONS):
+            frame = protocol.encodeInput(direction, seq)
+            self.assertEqual(protocol.decodeInput(payload(frame)), (seq, direction))
+        self.assertIsNone(protocol.decodeInput(protocol.INPUT_BODY.pack(1, 9)))
+        self.assertIsNone(protocol.decodeInput(b"up"))
+
+    def testAck(self):
+        for flags in ((False, False), (True, False), (False, True)):
+            frame = protocol.encodeAck(70000, (300, 2), *flags)
+            self.assertEqual(protocol.decodeAck(payload(frame)), (70000, (300, 2)) + flags)
+
+    def testWelcome(self):
+        token = bytes(range(protocol.TOKEN_SIZE))
+        self.assertEqual(protocol.decodeWelcome(payload(protocol.encodeWelcome(3, "ABCDE", token))),
+                         (3, "ABCDE", token))
+        self.assertEqual(protocol.decodeWelcome(payload(protocol.encodeWelcome(0, "ABCDE"))),
+                         (0, "ABCDE", None))
+
+class JoinTest(unittest.TestCase):
+
+    def testRoundTrip(self):
+        frame = protocol.encodeJoin("ABCDE", protocol.ROLE_SPECTATOR, (40, 20),
+                                    protocol.COMPRESS_NONE)
+        (role, code, view, method, resume) = protocol.decodeJoin(payload(frame))
+        self.assertEqual((role, code, view, resume),
+                         (protocol.ROLE_SPECTATOR, "ABCDE", (40, 20), None))
+
+    def testResume(self):
+        token = bytes(range(protocol.TOKEN_SIZE))
+        for (version, have) in ((-1, None), (0, 0), (41, 41)):
+            frame = protocol.encodeJoin("ABCDE", resume=(token, version, (10, 5)))
+            resume = protocol.decodeJoin(payload(frame))[4]
+            self.assertEqual(resume, (token, have, (10, 5)))
+
+    def testLongestCode(self):
+        code = "X" * protocol.MAX_ROOM_CODE
+        self.assertEqual(protocol.decodeJoin(payload(protocol.encodeJoin(code)))[1], code)
+
+    def testBadCodeIsRejected(self):
+        # neither is cut to fit, that could split a character
+        for code in ("X" * (protocol.MAX_ROOM_CODE + 1), "RÄUM"):
+            with self.assertRaises(ValueError):
+                protocol.encodeJoin(code)
+
+class StateFrameTest(unittest.TestCase):
+    """ Keyframes and deltas decoded by the client give the server's board
+    """
+    def setUp(self):
+        self.game = game.Game(40, 20)
+        self.game.initBoard(mapgen.generateMap(40, 20, 1))
+        self.state = client.BoardState()
+
+    def apply(self, frame):
+        self.assertTrue(self.state.applyFrame(frame[0], payload(frame)))
+
+    def play(self, moves, rect=None):
+        rng = random.Random(2)
+        for i in range(moves):
+            self.game.makeMove(rng.choice(protocol.DIRECTIONS), rng.choice((1, 2)))
+            delta = self.game.takeDelta()
+            if delta is not None:
+                self.apply(protocol.encodeDelta(delta, rect=rect))
+
+    def testWholeBoard(self):
+        self.apply(protocol.encodeKeyframe(self.game.snapshot))
+        self.play(200)
+        g = self.game
+        self.assertEqual(self.state.board, g.board)
+        self.assertEqual((self.state.version, self.state.message), (g.version, g.message))
+
+    def testViewport(self):
+        rect = (5, 3, 20, 10)
+        self.apply(protocol.encodeKeyframe(self.game.snapshot, rect))
+        self.play(200, rect)
+        self.assertEqual(self.state.origin, (5, 3))
+        self.assertEqual(bytes(self.state.board), self.game.snapshot.region(*rect))
+
+    def testDeltaAfterAGap(self):
+        self.apply(protocol.encodeKeyframe(self.game.snapshot))
+        self.game.setMessage("hello")
+        self.game.takeDelta()
+        self.game.setMessage("again")
+        frame = protocol.encodeDelta(self.game.takeDelta())
+        # the client missed a version and needs a keyframe
+        self.assertFalse(self.state.applyFrame(frame[0], payload(frame)))
+
+if __name__ == "__main__":
+    unittest.main()
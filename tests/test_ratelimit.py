@@ -0,0 +1,62 @@
+import unittest
+
+import aioserver
+import protocol
+import ratelimit
+import rooms
+from tests.fakes import FakeConnection, joinPlayers, payload
+
+class Clock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class InputLimiterTest(unittest.TestCase):
+
+    def testBurstThenRate(self):
+        clock = Clock()
+        limiter = ratelimit.InputLimiter(10, 5, clock)
+        self.assertEqual([limiter.allow() for i in range(7)], [True] * 5 + [False] * 2)
+        clock.now += 0.2
+        self.assertEqual([limiter.allow() for i in range(3)], [True, True, False])
+
+    def testUnlimited(self):
+        limiter = ratelimit.InputLimiter(0, clock=Clock())
+        self.assertTrue(all(limiter.allow() for i in range(10000)))
+
+    def testStrikesRunOut(self):
+        limiter = ratelimit.InputLimiter(clock=Clock())
+        for i in range(ratelimit.MAX_STRIKES):
+            limiter.strike()
+        self.assertRaises(ratelimit.FloodError, limiter.strike)
+
+class HandleFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = rooms.RoomManager(30, 12)
+        self.server = aioserver.AsyncServer(self.manager)
+        (self.room, (self.player,)) = joinPlayers(self.manager, 1, "LIMITS")
+
+    def testSpectatorFramesAreCharged(self):
+        spectator = FakeConnection(self.manager.newLimiter())
+        (room, n) = self.manager.spectate(spectator, "LIMITS")
+        frames = [(protocol.INPUT, payload(protocol.encodeInput("up", 1))),
+                  (protocol.JOIN, payload(protocol.encodeJoin("LIMITS")))] * 100
+        with self.assertRaises(ratelimit.FloodError):
+            for i in range(10):
+                self.server.handleFrames(spectator, room, 0, frames)
+
+    def testThrottledInputsAreDropped(self):
+        throttled = ratelimit.inputs_throttled.value
+        last = ratelimit.INPUT_BURST + 10
+        frames = [(protocol.INPUT, payload(protocol.encodeInput("right", seq)))
+                  for seq in range(1, last + 1)]
+        self.server.handleFrames(self.player, self.room, 1, frames)
+        self.assertEqual(ratelimit.inputs_throttled.value - throttled, 10)
+        # the client is told the dropped inputs were handled
+        self.assertEqual(self.room.dropped_seq[0], last)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import random
+import tempfile
+import unittest
+
+import aioserver
+import protocol
+import replay
+import rooms
+from tests.fakes import joinPlayers, payload
+
+def randomInput(rng, n):
+    return (protocol.INPUT, payload(protocol.encodeInput(rng.choice(protocol.DIRECTIONS), n + 1)))
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def play(self, frames_of):
+        """ Play a recorded room with two clients, frames_of(n) gives the
+            frames both send on tick n. Returns the recording.
+        """
+        manager = rooms.RoomManager(30, 12, record_dir=self.dir.name, input_rate=0)
+        server = aioserver.AsyncServer(manager)
+        (room, conns) = joinPlayers(manager, 2, "REPLAY")
+        for n in range(200):
+            for (player, c) in enumerate(conns, 1):
+                server.handleFrames(c, room, player, frames_of(n))
+            manager.tick()
+        for (player, c) in enumerate(conns, 1):
+            manager.leave(room, player, c)
+        (path,) = os.listdir(self.dir.name)
+        return replay.readRecording(os.path.join(self.dir.name, path))
+
+    def testReplayMatches(self):
+        rng = random.Random(3)
+        recording = self.play(lambda n: [randomInput(rng, n)])
+        self.assertTrue(recording.moves)
+        self.assertIsNotNone(recording.checksum)
+        replay.replay(recording)
+
+    def testJunkInputReplays(self):
+        # malformed inputs are only counted, they leave the game as it is
+        rng = random.Random(4)
+        recording = self.play(lambda n: [(protocol.INPUT, b"junk")] * (n % 5 == 0)
+                              + [randomInput(rng, n)])
+        self.assertTrue(recording.moves)
+        replay.replay(recording)
+
+    def testUnknownVersion(self):
+        path = os.path.join(self.dir.name, "future.rpl")
+        with open(path, "wb") as f:
+            f.write(replay.HEADER.pack(replay.MAGIC, 99, 30, 12, 2, 1, 0, 0))
+        with self.assertRaisesRegex(replay.ReplayError, "version 1, 2 or 3"):
+            replay.readRecording(path)
+
+if __name__ == "__main__":
+    unittest.main()
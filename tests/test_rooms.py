@@ -0,0 +1,44 @@
+import unittest
+
+import protocol
+import rooms
+import rules
+from tests.fakes import FakeConnection, joinPlayers
+
+class WinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = rooms.RoomManager(30, 12)
+        (self.room, self.conns) = joinPlayers(self.manager, 2)
+        g = self.room.game
+        # a chest right next to player 1
+        (x, y) = g.players[1].pos
+        self.direction = next(d for d, (dx, dy) in rules.DIRECTION_STEPS.items()
+                              if g.board[(y + dy) * g.width + x + dx] != rules.WALL)
+        (dx, dy) = rules.DIRECTION_STEPS[self.direction]
+        g.board[(y + dy) * g.width + x + dx] = rules.CHEST
+
+    def testWinIsSentOnce(self):
+        self.manager.tick()
+        self.room.queueInput(1, self.direction, 1)
+        for i in range(20):
+            self.manager.tick()
+            # moves after the end change nothing
+            self.room.queueInput(2, "up")
+        self.assertTrue(self.room.finished)
+        for c in self.conns:
+            self.assertEqual(c.kinds().count(protocol.WIN), 1)
+
+    def testFinishedRoomTakesNobodyNew(self):
+        self.room.queueInput(1, self.direction, 1)
+        self.manager.tick()
+        self.manager.leave(self.room, 2, self.conns[1])
+        self.assertNotIn(self.room.code, self.manager.open_rooms)
+        (room, n) = self.manager.join(FakeConnection())
+        self.assertIsNot(room, self.room)
+        spectator = FakeConnection()
+        self.manager.spectate(spectator, self.room.code)
+        self.assertEqual(spectator.kinds()[-1], protocol.WIN)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+import protocol
+import sendqueue
+
+KEYFRAME = protocol.encodeFrame(protocol.KEYFRAME, b"latest")
+
+def delta(n):
+    return protocol.encodeFrame(protocol.DELTA, bytes([n]))
+
+def ack(seq):
+    return protocol.encodeAck(seq, (1, 1), False, False)
+
+class SendQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = sendqueue.SendQueue(lambda: KEYFRAME, max_frames=4, max_overflows=2)
+
+    def testInOrder(self):
+        frames = [delta(1), ack(1), delta(2)]
+        for f in frames:
+            self.queue.push(f)
+        self.assertEqual(self.queue.take(), frames)
+        self.assertEqual(self.queue.take(), [])
+
+    def testKeyframeDropsOnlyState(self):
+        welcome = protocol.encodeWelcome(1, "ROOM", bytes(protocol.TOKEN_SIZE))
+        for f in (delta(1), welcome, delta(2), ack(3)):
+            self.queue.push(f)
+        keyframe = protocol.encodeFrame(protocol.KEYFRAME, b"new")
+        self.queue.push(keyframe, full_state=True)
+        self.queue.push(delta(4))
+        self.assertEqual(self.queue.take(), [keyframe, welcome, ack(3), delta(4)])
+        self.assertEqual(self.queue.dropped, 2)
+
+    def testWinKeepsControlFrames(self):
+        win = protocol.encodeWin()
+        for f in (delta(1), ack(1)):
+            self.queue.push(f)
+        self.queue.push(win, full_state=True)
+        self.assertEqual(self.queue.take(), [ack(1), win])
+
+    def testCollapse(self):
+        for n in range(4):
+            self.queue.push(delta(n))
+        self.queue.push(delta(4))
+        # deltas after the collapse are part of the keyframe
+        self.queue.push(delta(5))
+        error = protocol.encodeError("bye")
+        self.queue.push(ack(1))
+        self.queue.push(error)
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(self.queue.take(), [KEYFRAME, ack(1), error])
+        self.assertFalse(self.queue.needs_keyframe)
+
+    def testCollapseKeepsLatestAck(self):
+        for f in (ack(1), delta(1), ack(2), delta(2)):
+            self.queue.push(f)
+        self.queue.push(ack(3))
+        self.assertEqual(self.queue.take(), [KEYFRAME, ack(2), ack(3)])
+
+    def testSlowConsumer(self):
+        # the writer takes frames but never finishes sending them
+        with self.assertRaises(sendqueue.SlowConsumerError):
+            for round in range(3):
+                for n in range(5):
+                    self.queue.push(delta(n))
+                self.queue.take()
+
+    def testDrainForgivesOverflows(self):
+        for round in range(5):
+            for n in range(6):
+                self.queue.push(delta(n))
+            self.queue.take()
+            self.queue.drained()
+        self.assertEqual(self.queue.overflows, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import random
+import unittest
+
+import timers
+from timers import RESOLUTION, SLOTS
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = timers.TimerWheel()
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append(name)
+
+    def schedule(self, now, delay, name):
+        return self.wheel.schedule(now, delay, self.fire, name)
+
+    def testStartsFromNow(self):
+        # a late timer scheduled first must not hold back an earlier one
+        self.schedule(0, 100, "late")
+        self.schedule(0, 10, "early")
+        self.wheel.advance(11)
+        self.assertEqual(self.fired, ["early"])
+        self.wheel.advance(100.1)
+        self.assertEqual(self.fired, ["early", "late"])
+
+    def testOrder(self):
+        now = 1000.0
+        delays = [i * RESOLUTION * 7 for i in range(200)]
+        random.Random(1).shuffle(delays)
+        for d in delays:
+            self.schedule(now, d + RESOLUTION / 2, d)
+        t = now
+        while len(self.fired) < len(delays):
+            t += RESOLUTION * 3
+            self.wheel.advance(t)
+        self.assertEqual(self.fired, sorted(delays))
+        self.assertEqual(len(self.wheel), 0)
+
+    def testNotBeforeDue(self):
+        self.schedule(50, 1, "a")
+        self.wheel.advance(50.9)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(51.01)
+        self.assertEqual(self.fired, ["a"])
+
+    def testAlreadyDueFiresOnNextTick(self):
+        self.wheel.advance(10)
+        self.schedule(10, -5, "past")
+        self.wheel.advance(10)
+        self.assertEqual(self.fired, [])
+        self.wheel.advance(10 + RESOLUTION)
+        self.assertEqual(self.fired, ["past"])
+
+    def testCancel(self):
+        a = self.schedule(0, 1, "a")
+        self.schedule(0, 2, "b")
+        c = self.schedule(0, SLOTS ** 2 * RESOLUTION, "c")
+        a.cancel()
+        c.cancel()
+        self.wheel.advance(SLOTS ** 3 * RESOLUTION)
+        self.assertEqual(self.fired, ["b"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def testCascade(self):
+        # timers in every level move down and fire in their own tick,
+        # whether the wheel is advanced in small steps or in one jump
+        due = [1, SLOTS - 1, SLOTS, SLOTS + 1, SLOTS ** 2 - 1, SLOTS ** 2 + 5,
+                 SLOTS ** 3 + SLOTS + 3, SLOTS ** 4 + 7]
+        for step in (1, 97, 4099, SLOTS ** 4 * 2):
+            wheel = timers.TimerWheel(resolution=1)
+            fired = []
+            # the later ones take too many small steps
+            ticks = [t for t in due if t // step < 100000]
+            for t in reversed(ticks):
+                wheel.schedule(3, t, lambda t=t: fired.append((t, wheel.current)))
+            now = 3
+            while len(wheel):
+                now += step
+                wheel.advance(now)
+            self.assertEqual(fired, [(t, t + 3) for t in ticks])
+
+    def testRandom(self):
+        # every timer fires in the tick it is due in, however the wheel
+        # is advanced
+        rng = random.Random(7)
+        wheel = timers.TimerWheel(resolution=1)
+        now = 0
+        expected = {}
+        fired = {}
+        scheduled = []
+        for n in range(3000):
+            now += rng.choice((0, 0, 1, 3, 50, 700))
+            wheel.advance(now)
+            delay = rng.choice((0, 1, 5, 63, 64, 65, 4000, 300000, 20000000))
+            timer = wheel.schedule(now, delay, lambda n=n: fired.__setitem__(n, wheel.current))
+            expected[n] = max(now + delay, wheel.current + 1)
+            scheduled.append((n, timer))
+            if rng.random() < 0.2:
+                (victim, t) = rng.choice(scheduled)
+                if victim in expected and victim not in fired:
+                    t.cancel()
+                    del expected[victim]
+        wheel.advance(now + 30000000)
+        self.assertEqual(fired, expected)
+        self.assertEqual(len(wheel), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+import protocol
+import ratelimit
+import rooms
+import udp
+
+class UdpServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = rooms.RoomManager(30, 12)
+        self.server = udp.UdpServer(self.manager)
+        self.sent = []
+        self.server.sendto = lambda data, addr: self.sent.append((data, addr))
+
+    def connect(self, addr, session):
+        """ Send HELLOs like a client until the server answers with a session
+        """
+        for i in range(3):
+            self.sent.clear()
+            self.server.datagram_received(session.hello(), addr)
+            for (data, to) in self.sent:
+                session.receive(data)
+            if session.session is not None:
+                return
+        self.fail("no session")
+
+    def testForgedHelloOnlyGetsAChallenge(self):
+        hello = udp.encodeHello(7, room_code="SPOOF")
+        self.server.datagram_received(hello, ("10.0.0.1", 4000))
+        ((data, addr),) = self.sent
+        self.assertEqual(addr, ("10.0.0.1", 4000))
+        self.assertLessEqual(len(data), len(hello))
+        self.assertEqual(self.server.sessions, {})
+        self.assertEqual(self.manager.rooms, {})
+
+    def testCookieIsBoundToTheAddress(self):
+        session = udp.UdpSession("ROOM")
+        self.server.datagram_received(session.hello(), ("10.0.0.1", 4000))
+        session.receive(self.sent[0][0])
+        self.assertNotEqual(session.cookie, udp.NO_COOKIE)
+        self.sent.clear()
+        self.server.datagram_received(session.hello(), ("10.0.0.2", 4000))
+        self.assertEqual(self.server.sessions, {})
+        self.assertEqual(len(self.sent[0][0]), udp.CHALLENGE.size)
+
+    def testClientJoinsAfterTheChallenge(self):
+        session = udp.UdpSession("ROOM")
+        self.connect(("10.0.0.1", 4000), session)
+        frames = [kind for (data, addr) in self.sent for (kind, payload) in session.receive(data)]
+        self.assertIn(protocol.WELCOME, frames)
+        self.assertIn(protocol.KEYFRAME, frames)
+        self.assertEqual(len(self.server.sessions), 1)
+
+    def testHellosAreRateLimited(self):
+        hello = udp.encodeHello(7)
+        for i in range(50):
+            self.server.datagram_received(hello, ("10.0.0.1", 4000))
+        self.assertEqual(len(self.sent), udp.HELLO_BURST)
+
+    def testJunkCostsHellos(self):
+        for i in range(udp.HELLO_BURST):
+            self.server.datagram_received(b"x", ("10.0.0.1", 4000))
+        self.server.datagram_received(udp.encodeHello(7), ("10.0.0.1", 4000))
+        self.assertEqual(self.sent, [])
+
+    def testJunkOfASessionStrikes(self):
+        addr = ("10.0.0.1", 4000)
+        self.connect(addr, udp.UdpSession("ROOM"))
+        for i in range(ratelimit.MAX_STRIKES + 1):
+            self.server.datagram_received(b"i", addr)
+        self.assertEqual(self.server.sessions, {})
+
+if __name__ == "__main__":
+    unittest.main()
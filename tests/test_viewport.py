@@ -0,0 +1,61 @@
+import unittest
+
+import protocol
+import rooms
+import rules
+import viewport
+from tests.fakes import FakeConnection, payload
+
+class ViewportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.view = viewport.Viewport(200, 100, 40, 20)
+        self.view.centerOn((100, 50))
+
+    def testStaysInsideTheMargin(self):
+        for pos in ((80 + viewport.MARGIN, 40 + viewport.MARGIN),
+                    (119 - viewport.MARGIN, 59 - viewport.MARGIN)):
+            self.assertFalse(self.view.follow(pos))
+        self.assertEqual(self.view.rect(), (80, 40, 40, 20))
+
+    def testJumpsAtTheMargin(self):
+        self.assertTrue(self.view.follow((120 - viewport.MARGIN, 50)))
+        self.assertEqual(self.view.rect(), (95, 40, 40, 20))
+        self.assertTrue(self.view.contains((120 - viewport.MARGIN, 50)))
+
+    def testStopsAtTheBoardEdge(self):
+        self.assertTrue(self.view.follow((198, 98)))
+        self.assertEqual(self.view.rect(), (160, 80, 40, 20))
+        # at the edge there is nowhere to jump to
+        self.assertFalse(self.view.follow((199, 99)))
+
+    def testSizeIsLimited(self):
+        view = viewport.Viewport(30, 12, 1000, 1000)
+        self.assertEqual((view.width, view.height), (30, 12))
+        view = viewport.Viewport(1000, 1000, 1000, 1000)
+        self.assertEqual((view.width, view.height), (viewport.MAX_WIDTH, viewport.MAX_HEIGHT))
+
+class RoomViewportTest(unittest.TestCase):
+
+    def testJumpSendsAKeyframe(self):
+        manager = rooms.RoomManager(200, 100)
+        conn = FakeConnection(manager.newLimiter())
+        (room, player) = manager.join(conn, "VIEW", (40, 20))
+        g = room.game
+        # an empty cell far from the player's view
+        pos = next((x, y) for y in range(60, 90) for x in range(100, 180)
+                   if g.board[y * g.width + x] == rules.EMPTY)
+        g.set_player_position(player, pos)
+        conn.frames.clear()
+        room.tick()
+        (frame,) = [f for f in conn.frames if f[0] == protocol.KEYFRAME]
+        (version, width, height, x, y) = protocol.KEYFRAME_HEADER.unpack_from(payload(frame))
+        self.assertEqual((width, height), (40, 20))
+        self.assertTrue(x <= pos[0] < x + width and y <= pos[1] < y + height)
+        # the keyframe holds the player's cell
+        board = payload(frame)[protocol.KEYFRAME_HEADER.size:]
+        cell = (pos[1] - y) * width + pos[0] - x
+        self.assertEqual(board[cell], ord(g.players[player].symbol))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import asyncio
+import socket
+import unittest
+
+import protocol
+import ratelimit
+import workers
+
+class SupervisorJoinTest(unittest.TestCase):
+
+    def testOversizedJoinIsRejected(self):
+        supervisor = workers.Supervisor("127.0.0.1", 0, 1)
+        self.addCleanup(supervisor.listener.close)
+        (ours, theirs) = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        ours.setblocking(False)
+        # only the header, the supervisor must not wait for the body
+        theirs.send(protocol.FRAME_HEADER.pack(protocol.JOIN, ratelimit.MAX_CLIENT_FRAME + 1))
+        with self.assertRaises(protocol.ProtocolError):
+            asyncio.run(supervisor.readJoin(ours))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+""" Timers of a game, like the expiry of the message line.
+
+A TimerWheel is a hierarchical timing wheel. Time is cut into ticks of
+RESOLUTION seconds and every level is a ring of SLOTS lists:
+
+    level 0: one slot per tick, for timers due in the next SLOTS ticks
+    level 1: one slot per SLOTS ticks, for the next SLOTS ** 2 ticks
+    ...
+
+Scheduling puts a timer in a slot and cancelling only marks it, both
+O(1). Advancing by one tick fires one slot of level 0, and every SLOTS
+ticks the next slot of level 1 is moved down into level 0 (and so on up
+the levels), so a timer is moved at most LEVELS times before it fires and
+a tick with nothing due costs next to nothing, however many timers are
+pending. Idle time is skipped up to the next tick that moves timers
+down, or at once when nothing is pending.
+
+The tick a timer fires in only depends on its due time and not on how
+often advance() was called, so a replay that only advances to the time
+of each move fires the same timers before every move as the live game
+did. Timers due in the same tick fire in no particular order.
+"""
+import metrics
+
+RESOLUTION = 0.05   # seconds per tick of the wheel
+SLOTS = 64          # slots per level, a power of two
+LEVELS = 4          # 64 ** 4 ticks of 0.05 s, about 9 days, later timers wait in the top level
+BITS = SLOTS.bit_length() - 1
+
+timers_fired = metrics.counter("timers.fired")
+
+class Timer():
+    """ A scheduled call, returned by TimerWheel.schedule
+    """
+    __slots__ = ("tick", "callback", "args", "cancelled")
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """ Do not fire the timer. It stays in its slot until the wheel gets
+            there, which is cheaper than finding it.
+        """
+        self.cancelled = True
+
+class TimerWheel():
+    """ Hierarchical timing wheel, see the module docstring
+    """
+    def __init__(self, resolution=RESOLUTION):
+        """
+        Args:
+            resolution : Seconds per tick
+        """
+        self.resolution = resolution
+        # the last tick that was fired, None until the wheel is first used
+        self.current = None
+        self.levels = [[[] for i in range(SLOTS)] for level in range(LEVELS)]
+        # timers in the slots, the cancelled ones included, and per level
+        self.pending = 0
+        self.counts = [0] * LEVELS
+
+    def __len__(self):
+        return self.pending
+
+    def tickOf(self, when):
+        return int(when // self.resolution)
+
+    def schedule(self, now, delay, callback, *args):
+        """ Call callback(*args) once the wheel is advanced delay seconds
+            past now
+
+        Args:
+            now : The current time, in the clock of advance(). A wheel
+                  that was not advanced yet starts from it.
+            delay : Seconds from now to fire at
+            callback : The function to call
+
+        Returns:
+            Timer: The timer, to cancel it
+        """
+        if self.current is None:
+            self.current = self.tickOf(now)
+        tick = self.tickOf(now + delay)
+        timer = Timer(tick, callback, args)
+        # a timer that is already due fires on the next tick
+        self.insert(timer, max(tick, self.current + 1))
+        self.pending += 1
+        return timer
+
+    def insert(self, timer, tick):
+        """ Put a timer in the slot of tick, which is not before the
+            current tick
+        """
+        delta = tick - self.current
+        level = 0
+        while delta >= SLOTS ** (level + 1) and level < LEVELS - 1:
+            level += 1
+        self.levels[level][(tick >> (BITS * level)) & (SLOTS - 1)].append(timer)
+        self.counts[level] += 1
+
+    def advance(self, now):
+        """ Fire the timers that are due at time now
+
+        Returns:
+            int: The number of timers fired
+        """
+        target = self.tickOf(now)
+        if self.current is None or not self.pending:
+            self.current = target
+            return 0
+        fired = 0
+        levels = self.levels
+        counts = self.counts
+        while self.current < target and self.pending:
+            # with the lower levels empty, only the ticks where the
+            # lowest level with timers moves them down matter
+            lowest = 0
+            while not counts[lowest]:
+                lowest += 1
+            if lowest:
+                span = 1 << (BITS * lowest)
+                self.current = min(target, (self.current | (span - 1)) + 1)
+                if self.current & (span - 1):
+                    break
+            else:
+                self.current += 1
+            tick = self.current
+            # move the timers of the next slot of each level down, once
+            # the levels below it have gone round, top level first so
+            # nothing lands in a slot that was emptied already
+            top = 0
+            while top + 1 < LEVELS and not tick & ((1 << (BITS * (top + 1))) - 1):
+                top += 1
+            for level in range(top, 0, -1):
+                slots = levels[level]
+                index = (tick >> (BITS * level)) & (SLOTS - 1)
+                timers = slots[index]
+                slots[index] = []
+                counts[level] -= len(timers)
+                for timer in timers:
+                    if timer.cancelled:
+                        self.pending -= 1
+                    else:
+                        self.insert(timer, timer.tick)
+            slots = levels[0]
+            index = tick & (SLOTS - 1)
+            due = slots[index]
+            if not due:
+                continue
+            slots[index] = []
+            counts[0] -= len(due)
+            for timer in due:
+                self.pending -= 1
+                if timer.cancelled:
+                    continue
+                timer.callback(*timer.args)
+                fired += 1
+        if self.current < target:
+            # nothing left to fire on the way
+            self.current = target
+        timers_fired.inc(fired)
+        return fired
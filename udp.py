@@ -0,0 +1,532 @@
+""" UDP transport for the asyncio engine.
+
+Over TCP one lost packet holds back every state update behind it until
+it is retransmitted. Over UDP nothing waits: the client keeps applying
+whatever state arrives and the server keeps sending it the changes since
+the newest state the client has confirmed, so a lost datagram is covered
+by the next one.
+
+Client -> server datagrams, all numbers big-endian:
+
+    HELLO  'h' nonce:u32 cookie[8] role:u8 code_len:u8 room_code[code_len]
+               [view_width:u16 view_height:u16 [compression:u8
+               [token[16] have:u32 x:u16 y:u16]]]
+    INPUTS 'i' session:u32 have:u32 x:u16 y:u16 count:u8
+               count*(seq:u32 opcode:u8)
+    BYE    'b' session:u32
+
+The client sends HELLO every HELLO_INTERVAL seconds until the WELCOME
+comes back, the nonce tells a repeated HELLO from a new client on the
+same address. The source address of a datagram is easily forged, so the
+first HELLO, with a cookie of zeros, only gets a challenge back:
+
+    CHALLENGE  0:u32 cookie[8]
+
+a keyed hash of the client's address that is valid for COOKIE_PERIOD to
+twice as many seconds. Only a HELLO repeating it joins a room and gets
+the state. The challenge is never bigger than the HELLO it answers and
+no state is kept for it, so forged HELLOs neither take slots nor make
+the server send a victim more than they cost. Every address may also
+send only HELLO_RATE HELLOs or broken datagrams per second, and a
+broken datagram of a session counts as a strike against its limiter,
+see ratelimit.py.
+
+Like a JOIN, a HELLO with the session token of a player resumes it on
+the server, also from another address. The clients in this repository
+do not send one over UDP: encodeHello has no token, and a client whose
+session timed out has to join again as a new player.
+
+INPUTS carries every input the server has not acknowledged yet, oldest
+first, so a lost datagram costs no moves, and the server skips the seqs
+it has seen. have is the version of the client's state plus one, 0
+while it has none, and (x, y) the origin of its viewport. Clients send
+INPUTS for every move, as an acknowledgement of every datagram they
+receive and at least every KEEPALIVE_INTERVAL seconds, a session silent
+for SESSION_TIMEOUT seconds is dropped.
+
+Other server -> client datagrams are the session:u32, never 0, followed
+by ordinary frames, see protocol.py. Every datagram holds whole frames:
+a DELTA from the client's confirmed version to the current one (a
+KEYFRAME if the client has nothing or fell further behind than the
+room's history), the latest ACK of the client's inputs and anything else
+the room sent, like WELCOME, WIN or ERROR. A delta that arrives late or
+twice is older than what the client has and applyDelta ignores it. A
+client that asks for zlib compression gets RLE, since a zlib stream
+breaks when a datagram is lost, see compression.py.
+
+LossyLink drops and reorders datagrams on purpose, to try all of this on
+loopback, see --udp-loss and --udp-reorder in server.py and bot.py.
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import random
+import secrets
+import struct
+import time
+
+import compression
+import metrics
+import protocol
+import ratelimit
+
+HELLO = ord('h')
+INPUTS = ord('i')
+BYE = ord('b')
+
+COOKIE_SIZE = 8
+
+SESSION = struct.Struct('!I')
+HELLO_HEADER = struct.Struct(f'!BI{COOKIE_SIZE}s')
+CHALLENGE = struct.Struct(f'!I{COOKIE_SIZE}s')
+INPUTS_HEADER = struct.Struct('!BIIHHB')
+BYE_BODY = struct.Struct('!BI')
+
+HELLO_INTERVAL = 0.25       # seconds between two HELLOs of a client
+HELLO_RATE = 4              # HELLOs or broken datagrams per second of an address
+HELLO_BURST = 8             # of those an address can send at once
+COOKIE_PERIOD = 30          # seconds before the cookie of an address changes
+NO_COOKIE = bytes(COOKIE_SIZE)  # the cookie of a first HELLO
+KEEPALIVE_INTERVAL = 1      # seconds between INPUTS of an idle client
+MAX_INPUTS = 16             # inputs repeated in one INPUTS datagram
+SESSION_TIMEOUT = 10        # seconds of silence before a session is dropped
+REORDER_DELAY = 0.05        # longest delay LossyLink holds a datagram back
+
+log = logging.getLogger("udp")
+
+datagrams_sent = metrics.counter("udp.sent")
+datagrams_received = metrics.counter("udp.received")
+malformed = metrics.counter("udp.malformed")
+challenges_sent = metrics.counter("udp.challenges")
+hellos_throttled = metrics.counter("udp.hellos_throttled")
+sessions_expired = metrics.counter("udp.expired")
+simulated_drops = metrics.counter("udp.simulated_drop")
+
+def encodeHello(nonce, cookie=NO_COOKIE, room_code="", role=protocol.ROLE_PLAYER,
+                view=None, compression=protocol.COMPRESS_NONE):
+    join = protocol.encodeJoin(room_code, role, view, compression)
+    return HELLO_HEADER.pack(HELLO, nonce, cookie) + join[protocol.FRAME_HEADER.size:]
+
+def encodeInputs(session, version, origin, pending):
+    """ Build an INPUTS datagram
+
+    Args:
+        session : The session id from the server
+        version : The version of the client's state, -1 if none
+        origin : (x, y) of the client's viewport
+        pending : The unacknowledged inputs, [seq, direction, ...] entries
+
+    Returns:
+        bytes: The datagram
+    """
+    inputs = [protocol.INPUT_BODY.pack(entry[0], protocol.DIRECTIONS.index(entry[1]))
+              for entry in list(pending)[:MAX_INPUTS]]
+    return b"".join([INPUTS_HEADER.pack(INPUTS, session, version + 1, *origin,
+                                        len(inputs)),
+                     *inputs])
+
+def encodeBye(session):
+    return BYE_BODY.pack(BYE, session)
+
+class LossyLink():
+    """ Wraps a datagram send function and drops or delays some of the
+        datagrams that go through it. A delayed datagram arrives after
+        the ones sent behind it, which reorders them.
+    """
+    def __init__(self, send, later, loss=0.0, reorder=0.0, seed=None):
+        """
+        Args:
+            send : The function sending one datagram
+            later : Function (delay, callback, *args) that calls back later,
+                    like loop.call_later
+            loss : Fraction of datagrams to drop
+            reorder : Fraction of datagrams to delay
+            seed : Seed for the choices
+        """
+        self.send = send
+        self.later = later
+        self.loss = loss
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+    def __call__(self, *args):
+        r = self.random.random()
+        if r < self.loss:
+            simulated_drops.inc()
+        elif r < self.loss + self.reorder:
+            self.later(self.random.uniform(0, REORDER_DELAY), self.send, *args)
+        else:
+            self.send(*args)
+
+class UdpSession():
+    """ The client end of a session, without any socket: it builds the
+        datagrams to send and unpacks the received ones, so the threaded
+        curses client and the asyncio bot share it.
+    """
+    def __init__(self, room_code="", role=protocol.ROLE_PLAYER, view=None,
+                 method=protocol.COMPRESS_NONE):
+        """
+        Args:
+            room_code, role, view : What to send in the JOIN, see protocol.encodeJoin
+            method : The compression to ask for
+        """
+        self.room_code = room_code
+        self.role = role
+        self.view = view
+        self.method = method
+        self.decompressor = compression.Decompressor()
+        self.nonce = random.getrandbits(32)
+        # from the server's CHALLENGE, sent back in every HELLO
+        self.cookie = NO_COOKIE
+        # set by the first datagram from the server
+        self.session = None
+        # set when the server refused or ended the session
+        self.closed = False
+
+    def hello(self):
+        return encodeHello(self.nonce, self.cookie, self.room_code, self.role,
+                           self.view, self.method)
+
+    def inputs(self, state):
+        """ INPUTS datagram confirming the state and repeating its pending inputs
+        """
+        return encodeInputs(self.session or 0, state.version, state.origin,
+                            state.pending)
+
+    def bye(self):
+        return encodeBye(self.session or 0)
+
+    def receive(self, data):
+        """ Unpack a datagram from the server. After a CHALLENGE the
+            session is still None, answer it with another hello().
+
+        Returns:
+            list: The (type, payload) frames, empty for a stray datagram
+        """
+        if len(data) < SESSION.size:
+            return []
+        (session,) = SESSION.unpack_from(data)
+        if session == 0:
+            if self.session is None and len(data) == CHALLENGE.size:
+                (_, self.cookie) = CHALLENGE.unpack(data)
+            return []
+        if self.session is None:
+            self.session = session
+        elif session != self.session:
+            return []
+        try:
+            frames = self.decompressor.expand(
+                protocol.FrameReader().feed(data[SESSION.size:]))
+        except protocol.ProtocolError:
+            return []
+        if any(kind == protocol.ERROR for (kind, payload) in frames):
+            self.closed = True
+        return frames
+
+class UdpConnection():
+    """ A client of the UDP transport, as the Room sees it. Nothing is
+        sent right away: state frames are left out, UdpServer.flush
+        builds the client's own delta after every tick, and the other
+        frames wait to go out in the same datagram.
+    """
+    def __init__(self, addr, session, nonce):
+        self.addr = addr
+        self.session = session
+        self.nonce = nonce
+        self.room = None
+        self.player = None
+        # frames for the next datagram besides the state and the ACK
+        self.queue = []
+        # our WELCOME, sent again when the client repeats its HELLO
+        self.welcome = None
+        # the latest ACK, repeated in every datagram since it may get lost
+        self.ack = None
+        self.ack_sent = False
+        # the version the client has confirmed and the viewport origin
+        # it has it for, None if it has no state
+        self.have = None
+        self.origin = None
+        self.last_seq = 0
+        self.last_seen = time.monotonic()
+        self.closing = False
+        # RLE or nothing, set from the HELLO
+        self.compressor = compression.Compressor()
+        # new inputs only, repeated ones cost nothing, see ratelimit.py
+        self.limiter = ratelimit.InputLimiter(0)
+
+    def send(self, frame, full_state=False):
+        kind = frame[0]
+        if kind == protocol.KEYFRAME or kind == protocol.DELTA:
+            return
+        if kind == protocol.ACK:
+            self.ack = frame
+            self.ack_sent = False
+            return
+        if kind == protocol.WELCOME:
+            self.welcome = frame
+        self.queue.append(frame)
+
+    def close(self):
+        """ Drop the session after the next flush
+        """
+        self.closing = True
+
+class UdpServer(asyncio.DatagramProtocol):
+    """ Serves the rooms of a RoomManager over UDP, next to the TCP
+        clients of the same AsyncServer. flush() runs after every tick.
+    """
+    def __init__(self, manager, loss=0.0, reorder=0.0):
+        """
+        Args:
+            manager : The RoomManager shared with the TCP clients
+            loss, reorder : Fractions of our datagrams to drop or
+                            delay, to simulate a bad network
+        """
+        self.manager = manager
+        self.loss = loss
+        self.reorder = reorder
+        self.transport = None
+        self.sendto = None
+        self.sessions = {}      # session id -> UdpConnection
+        self.addresses = {}     # (host, port) -> UdpConnection
+        # (host, port) -> TokenBucket of the HELLOs and broken datagrams
+        # the address may send, dropped once full again
+        self.peers = {}
+        # key of the cookies, see cookie()
+        self.secret = secrets.token_bytes(16)
+        self.last_expiry = time.monotonic()
+        metrics.gauge("udp.sessions", lambda: len(self.sessions))
+
+    async def start(self, host, port):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        log.info("Serving UDP on %s:%d", host, port)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sendto = transport.sendto
+        if self.loss or self.reorder:
+            loop = asyncio.get_running_loop()
+            self.sendto = LossyLink(transport.sendto, loop.call_later,
+                                    self.loss, self.reorder)
+
+    def datagram_received(self, data, addr):
+        datagrams_received.inc()
+        try:
+            kind = data[0]
+            if kind == HELLO:
+                (_, nonce, cookie) = HELLO_HEADER.unpack_from(data)
+                if not self.allowPeer(addr):
+                    return
+                if not self.checkCookie(addr, cookie):
+                    self.challenge(addr, len(data))
+                    return
+                (role, code, view, method, resume) = protocol.decodeJoin(
+                    data[HELLO_HEADER.size:])
+                self.hello(addr, nonce, role, code, view, method, resume)
+            elif kind == INPUTS:
+                (_, session, have, x, y, count) = INPUTS_HEADER.unpack_from(data)
+                inputs = [(seq, protocol.DIRECTIONS[opcode])
+                          for (seq, opcode) in protocol.INPUT_BODY.iter_unpack(
+                              data[INPUTS_HEADER.size:INPUTS_HEADER.size
+                                   + count * protocol.INPUT_BODY.size])]
+                self.inputs(addr, session, have, (x, y), inputs)
+            elif kind == BYE:
+                (_, session) = BYE_BODY.unpack_from(data)
+                conn = self.sessions.get(session)
+                if conn is not None and conn.addr == addr:
+                    self.drop(conn)
+            else:
+                self.broken(addr)
+        except (IndexError, struct.error, protocol.ProtocolError):
+            self.broken(addr)
+
+    def cookie(self, addr, period):
+        """ The cookie of an address in a COOKIE_PERIOD
+        """
+        message = f"{addr[0]}:{addr[1]}:{period}".encode()
+        return hmac.new(self.secret, message, hashlib.sha256).digest()[:COOKIE_SIZE]
+
+    def checkCookie(self, addr, cookie):
+        """ Whether a HELLO's cookie is the one we gave the address,
+            in this period or the one before
+        """
+        period = int(time.monotonic() // COOKIE_PERIOD)
+        return any(hmac.compare_digest(cookie, self.cookie(addr, p))
+                   for p in (period, period - 1))
+
+    def challenge(self, addr, size):
+        """ Answer a HELLO without a valid cookie with the cookie of its
+            address, unless that would be bigger than the HELLO was
+        """
+        period = int(time.monotonic() // COOKIE_PERIOD)
+        datagram = CHALLENGE.pack(0, self.cookie(addr, period))
+        if len(datagram) <= size:
+            self.sendto(datagram, addr)
+            challenges_sent.inc()
+
+    def allowPeer(self, addr):
+        """ Take a token for a HELLO or a broken datagram of an address
+
+        Returns:
+            Boolean: False if the address sent too many of them
+        """
+        now = time.monotonic()
+        bucket = self.peers.get(addr)
+        if bucket is None:
+            bucket = self.peers[addr] = ratelimit.TokenBucket(HELLO_RATE, HELLO_BURST, now)
+        if bucket.take(now):
+            return True
+        hellos_throttled.inc()
+        return False
+
+    def broken(self, addr):
+        """ Count a datagram we could not use against its sender: a
+            strike for a client with a session, one of its HELLOs for
+            any other address
+        """
+        malformed.inc()
+        conn = self.addresses.get(addr)
+        if conn is None:
+            self.allowPeer(addr)
+            return
+        try:
+            conn.limiter.strike()
+        except ratelimit.FloodError as e:
+            log.warning("Dropping %s: %s", addr, e)
+            self.drop(conn)
+
+    def hello(self, addr, nonce, role, code, view, method=protocol.COMPRESS_NONE,
+              resume=None):
+        conn = self.addresses.get(addr)
+        if conn is not None:
+            if conn.nonce == nonce:
+                # our WELCOME got lost, send it and a keyframe again
+                if conn.welcome is not None:
+                    conn.queue.append(conn.welcome)
+                conn.have = None
+                return
+            # a new client on the address of an old one
+            self.drop(conn, reserve=True)
+        session = random.getrandbits(32)
+        # 0 marks a CHALLENGE
+        while session in self.sessions or session == 0:
+            session = random.getrandbits(32)
+        conn = UdpConnection(addr, session, nonce)
+        conn.compressor = compression.Compressor(
+            compression.choose(method, stateless=True))
+        conn.limiter = self.manager.newLimiter()
+        if role == protocol.ROLE_SPECTATOR:
+            (room, player) = self.manager.spectate(conn, code)
+        elif resume is not None:
+            # flushConnection sends the changes since what the client has
+            (_, conn.have, conn.origin) = resume
+            (room, player) = self.manager.resume(conn, code, *resume, view)
+        else:
+            (room, player) = self.manager.join(conn, code, view)
+        if room is None:
+            log.warning("Refused %s: %s", addr, player)
+            self.sendto(SESSION.pack(session) + protocol.encodeError(player), addr)
+            return
+        conn.room = room
+        conn.player = player
+        self.sessions[session] = conn
+        self.addresses[addr] = conn
+        if player:
+            log.info("Connected by %s over UDP as player %d in room %s",
+                     addr, player, room.code)
+        else:
+            log.debug("Spectator %s watching room %s over UDP", addr, room.code)
+        # the keyframe and the WELCOME go out right away
+        self.flushConnection(conn)
+
+    def inputs(self, addr, session, have, origin, inputs):
+        conn = self.sessions.get(session)
+        if conn is None or conn.addr != addr:
+            self.broken(addr)
+            return
+        conn.last_seen = time.monotonic()
+        if have and (conn.have is None or have - 1 > conn.have or origin != conn.origin):
+            conn.have = have - 1
+            conn.origin = origin
+        if not conn.player:
+            return
+        for (seq, direction) in inputs:
+            # older seqs are repeats of inputs we already queued
+            if seq > conn.last_seq:
+                conn.last_seq = seq
+                try:
+                    allowed = conn.limiter.allow()
+                except ratelimit.FloodError as e:
+                    log.warning("Dropping %s: %s", addr, e)
+                    self.drop(conn)
+                    return
+                if allowed:
+                    conn.room.queueInput(conn.player, direction, seq)
+                else:
+                    conn.room.dropInput(conn.player, seq)
+
+    def drop(self, conn, reserve=False):
+        """ End a session and take the client out of its room
+
+        Args:
+            reserve : Keep the player's slot for it to resume
+        """
+        if self.sessions.pop(conn.session, None) is None:
+            return
+        self.addresses.pop(conn.addr, None)
+        room = conn.room
+        if conn.player:
+            # nothing happens if the room ended the session or another
+            # connection resumed the player
+            self.manager.leave(room, conn.player, conn, reserve)
+            log.info("Player %d left room %s over UDP", conn.player, room.code)
+        else:
+            self.manager.stopSpectating(room, conn)
+
+    def flushConnection(self, conn):
+        """ Send a client one datagram with what it is missing
+        """
+        room = conn.room
+        frames = []
+        # spectators only get the state at the spectator frame rate
+        if conn.player or room.ticks % room.spectator_interval == 0:
+            view = room.viewOf(conn)
+            # a viewport that moved needs a keyframe of the new area
+            base = conn.have if conn.origin == (view.x, view.y) else None
+            state = room.deltaSince(base, view)
+            if state is not None:
+                frames.append(conn.compressor.encode(state))
+        frames.extend(conn.queue)
+        conn.queue.clear()
+        if conn.ack is not None and (frames or not conn.ack_sent):
+            frames.append(conn.ack)
+            conn.ack_sent = True
+        if not frames:
+            return
+        datagram = SESSION.pack(conn.session) + b"".join(frames)
+        self.sendto(datagram, conn.addr)
+        datagrams_sent.inc()
+
+    def flush(self):
+        """ Called after every tick: send every session its datagram and
+            expire the sessions that went silent
+        """
+        for conn in list(self.sessions.values()):
+            self.flushConnection(conn)
+            if conn.closing:
+                self.drop(conn)
+        now = time.monotonic()
+        if now - self.last_expiry >= 1:
+            self.last_expiry = now
+            # a bucket that has filled up again is the same as a new one
+            full = HELLO_BURST / HELLO_RATE
+            for addr in [addr for addr, bucket in self.peers.items()
+                         if now - bucket.stamp >= full]:
+                del self.peers[addr]
+            for conn in list(self.sessions.values()):
+                if now - conn.last_seen > SESSION_TIMEOUT:
+                    sessions_expired.inc()
+                    log.info("UDP session of %s timed out", conn.addr)
+                    self.drop(conn, reserve=True)
@@ -0,0 +1,76 @@
+""" Viewports, the part of a large board a client is sent.
+
+A client says in its JOIN how many cells it can show. The server keeps a
+Viewport of that size for it, centred on its player. When the player
+gets within MARGIN cells of an edge the viewport jumps to centre it
+again and the client gets a keyframe of the new area. Deltas only carry
+the cells inside the viewport, so what a client costs depends on its
+screen and not on the size of the board.
+"""
+
+DEFAULT_WIDTH = 80      # the view of a client that does not send a size
+DEFAULT_HEIGHT = 30
+MAX_WIDTH = 250         # bigger views are cut down to this
+MAX_HEIGHT = 100
+MARGIN = 5              # cells from the edge that move the view
+
+class Viewport():
+    """ A width x height window on the board with its top left cell at (x, y)
+    """
+    __slots__ = ("x", "y", "width", "height", "board_width", "board_height")
+
+    def __init__(self, board_width, board_height, width=DEFAULT_WIDTH,
+                 height=DEFAULT_HEIGHT):
+        """
+        Args:
+            board_width, board_height : The board dimensions
+            width, height : The size the client asked for, it is
+                            limited to the board and to MAX_WIDTH x MAX_HEIGHT
+        """
+        self.board_width = board_width
+        self.board_height = board_height
+        self.width = max(1, min(width, MAX_WIDTH, board_width))
+        self.height = max(1, min(height, MAX_HEIGHT, board_height))
+        self.x = 0
+        self.y = 0
+
+    def __repr__(self):
+        return f"Viewport({self.width}x{self.height} at {self.x},{self.y})"
+
+    def rect(self):
+        """ (x, y, width, height), what protocol.encodeKeyframe and
+            encodeDelta take
+        """
+        return (self.x, self.y, self.width, self.height)
+
+    def contains(self, pos):
+        return (self.x <= pos[0] < self.x + self.width and
+                self.y <= pos[1] < self.y + self.height)
+
+    def centerOn(self, pos):
+        """ Put pos in the middle of the view, as far as the board allows
+        """
+        self.x = max(0, min(pos[0] - self.width // 2, self.board_width - self.width))
+        self.y = max(0, min(pos[1] - self.height // 2, self.board_height - self.height))
+
+    def moveTo(self, origin):
+        """ Put the top left cell of the view at origin, as far as the
+            board allows
+        """
+        self.x = max(0, min(origin[0], self.board_width - self.width))
+        self.y = max(0, min(origin[1], self.board_height - self.height))
+
+    def follow(self, pos):
+        """ Centre the view on pos again if pos is near an edge
+
+        Returns:
+            Boolean: True if the view moved and the client needs a keyframe
+        """
+        mx = min(MARGIN, (self.width - 1) // 2)
+        my = min(MARGIN, (self.height - 1) // 2)
+        if (self.x + mx <= pos[0] < self.x + self.width - mx and
+                self.y + my <= pos[1] < self.y + self.height - my):
+            return False
+        old = (self.x, self.y)
+        self.centerOn(pos)
+        return (self.x, self.y) != old
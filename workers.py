@@ -0,0 +1,415 @@
+""" Multi-process deployment of the asyncio engine.
+
+A supervisor process accepts every connection, reads the client's JOIN
+and hands the socket over to the worker process that owns the room, so
+the players of a room always end up in the same process. Each worker is
+a normal asyncio engine with its own RoomManager and its own GIL.
+
+SO_REUSEPORT would let the kernel spread connections over the workers,
+but it knows nothing about room codes, so two players asking for the
+same room could land in different processes.
+
+Supervisor and workers talk over a SOCK_SEQPACKET socket pair, one
+message per packet: a type byte followed by the payload. Client sockets
+are passed along with the CLIENT message as SCM_RIGHTS file descriptors.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+
+import aioserver
+import metrics
+import protocol
+import ratelimit
+import rooms
+
+HEALTH_INTERVAL = 2     # seconds between pings to each worker
+HEALTH_TIMEOUT = 6      # a worker that has not answered for this long is restarted
+DRAIN_TIMEOUT = 30      # seconds a draining worker waits for its rooms to finish
+PLACEMENT_GRACE = 10    # seconds a new room stays placed before the worker reports it
+MAX_CONTROL_MESSAGE = 65536
+
+# supervisor -> worker
+CLIENT = ord('C')   # payload is what was already read from the client, fd attached
+PING = ord('P')
+DRAIN = ord('D')
+# worker -> supervisor
+STATUS = ord('S')   # JSON payload
+
+log = logging.getLogger("workers")
+
+clients_placed = metrics.counter("workers.clients_placed")
+worker_restarts = metrics.counter("workers.restarts")
+
+class Worker():
+    """ The worker side, runs in the child process. Serves the clients
+        the supervisor sends it with the regular asyncio engine.
+    """
+    def __init__(self, index, ctrl, tick_rate, room_options):
+        self.index = index
+        self.ctrl = ctrl
+        self.manager = rooms.RoomManager(**room_options)
+        # the supervisor learns about new rooms right away, so players
+        # resuming in a matchmade room are sent to this worker
+        self.manager.on_change = self.sendStatus
+        self.server = aioserver.AsyncServer(self.manager, tick_rate)
+        self.draining = False
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.done = loop.create_future()
+        self.ctrl.setblocking(False)
+        loop.add_reader(self.ctrl.fileno(), self.onControl)
+        ticker = asyncio.create_task(self.server.tickLoop())
+        try:
+            await self.done
+        finally:
+            ticker.cancel()
+            loop.remove_reader(self.ctrl.fileno())
+
+    def onControl(self):
+        """ Called by the event loop when the supervisor sent something
+        """
+        try:
+            (msg, fds, flags, addr) = socket.recv_fds(self.ctrl, MAX_CONTROL_MESSAGE, 1)
+        except BlockingIOError:
+            return
+        except OSError:
+            msg = b""
+        if not msg:
+            # the supervisor is gone, nobody can reach us any more
+            log.warning("Worker %d lost its supervisor", self.index)
+            if not self.done.done():
+                self.done.set_result(None)
+            return
+        kind = msg[0]
+        if kind == CLIENT and fds:
+            sock = socket.socket(fileno=fds[0])
+            asyncio.create_task(self.handleSocket(sock, msg[1:]))
+        elif kind == PING:
+            self.sendStatus()
+        elif kind == DRAIN and not self.draining:
+            self.draining = True
+            asyncio.create_task(self.drain())
+
+    async def handleSocket(self, sock, initial):
+        sock.setblocking(False)
+        (reader, writer) = await asyncio.open_connection(sock=sock)
+        await self.server.handleClient(reader, writer, initial)
+
+    def sendStatus(self):
+        rooms_by_code = self.manager.rooms
+        status = {
+            "rooms": list(rooms_by_code),
+            "players": sum(len(r.connections) - r.connections.count(None)
+                           for r in rooms_by_code.values()),
+            "spectators": sum(len(r.spectators) for r in rooms_by_code.values()),
+            "draining": self.draining,
+            "counters": {name: c.value for name, c in metrics.counters.items()},
+        }
+        try:
+            self.ctrl.send(bytes([STATUS]) + bytes(json.dumps(status), 'utf-8'))
+        except OSError as e:
+            log.warning("Worker %d could not report status: %s", self.index, e)
+
+    async def drain(self):
+        """ Let the running games finish, then close whoever is left
+        """
+        log.info("Worker %d draining %d rooms", self.index, len(self.manager.rooms))
+        # rooms of bots only are never over
+        self.manager.stopBots()
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.manager.rooms and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+        error = protocol.encodeError("Server is shutting down")
+        for room in list(self.manager.rooms.values()):
+            for c in room.connections + list(room.spectators):
+                if c is not None and c not in room.bots.values():
+                    c.writer.write(error)
+                    c.writer.close()
+        # give the transports a moment to flush the error frames
+        await asyncio.sleep(0.1)
+        if not self.done.done():
+            self.done.set_result(None)
+
+def workerMain(index, ctrl, close_socks, tick_rate, room_options):
+    """ Entry point of a worker process, forked from the supervisor
+
+    Args:
+        index : The worker number
+        ctrl : The worker end of the control socket pair
+        close_socks : Supervisor sockets the fork inherited
+        tick_rate, room_options : Passed on to the engine
+    """
+    # the supervisor handles the signals and tells us when to stop
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # sockets inherited from the supervisor that are not ours
+    for sock in close_socks:
+        sock.close()
+    worker = Worker(index, ctrl, tick_rate, room_options)
+    asyncio.run(worker.run())
+    log.info("Worker %d stopped", index)
+
+class WorkerHandle():
+    """ The supervisor's view of one worker process
+    """
+    def __init__(self, index, process, ctrl):
+        self.index = index
+        self.process = process
+        self.ctrl = ctrl
+        self.last_seen = time.monotonic()
+        self.status = {}
+        # clients sent since the last status, so placement sees them
+        self.assigned = 0
+
+    def load(self):
+        return (self.status.get("players", 0) + self.status.get("spectators", 0)
+                + self.assigned)
+
+    def alive(self):
+        return self.process.is_alive()
+
+class Supervisor():
+    """ Accepts clients, places them on workers by room and keeps the
+        workers running.
+    """
+    def __init__(self, host, port, count, tick_rate=aioserver.TICK_RATE,
+                 room_options=None):
+        """
+        Args:
+            host, port : The address to accept clients on
+            count : Number of worker processes
+            tick_rate : Passed on to the workers' engines
+            room_options : Keyword arguments for the workers' RoomManager
+        """
+        self.host = host
+        self.port = port
+        self.tick_rate = tick_rate
+        self.room_options = room_options or {}
+        self.max_players = self.room_options.get("max_players", rooms.MAX_PLAYERS)
+        self.context = multiprocessing.get_context("fork")
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+        self.workers = [None] * count
+        # room code -> (worker index, time placed)
+        self.placements = {}
+        # matchmaking sends max_players clients in a row to the same worker
+        self.match_worker = None
+        self.match_count = 0
+        metrics.gauge("workers", lambda: {w.index: w.status for w in self.workers if w})
+
+    def startWorker(self, index):
+        (parent_end, child_end) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        close_socks = [self.listener, parent_end]
+        close_socks += [w.ctrl for w in self.workers if w is not None]
+        process = self.context.Process(
+            target=workerMain, name=f"worker-{index}", daemon=True,
+            args=(index, child_end, close_socks, self.tick_rate, self.room_options))
+        process.start()
+        child_end.close()
+        parent_end.setblocking(False)
+        handle = WorkerHandle(index, process, parent_end)
+        self.workers[index] = handle
+        asyncio.get_running_loop().add_reader(parent_end.fileno(), self.onStatus, handle)
+        log.info("Started worker %d (pid %d)", index, process.pid)
+
+    def stopWorker(self, handle):
+        asyncio.get_running_loop().remove_reader(handle.ctrl.fileno())
+        handle.ctrl.close()
+        if handle.alive():
+            handle.process.kill()
+        handle.process.join(1)
+        for code, (index, placed) in list(self.placements.items()):
+            if index == handle.index:
+                del self.placements[code]
+
+    def onStatus(self, handle):
+        try:
+            msg = handle.ctrl.recv(MAX_CONTROL_MESSAGE)
+        except BlockingIOError:
+            return
+        except OSError:
+            msg = b""
+        if not msg:
+            # the worker died, the health check restarts it
+            asyncio.get_running_loop().remove_reader(handle.ctrl.fileno())
+            return
+        if msg[0] != STATUS:
+            return
+        handle.status = json.loads(msg[1:])
+        handle.last_seen = time.monotonic()
+        handle.assigned = 0
+        # forget rooms the worker has closed, unless we placed them so
+        # recently that the worker may not have created them yet
+        reported = set(handle.status["rooms"])
+        now = time.monotonic()
+        for code, (index, placed) in list(self.placements.items()):
+            if (index == handle.index and code not in reported
+                    and now - placed > PLACEMENT_GRACE):
+                del self.placements[code]
+        # rooms made by matchmaking, so a player resuming its session
+        # by room code goes back to the same worker
+        for code in reported:
+            self.placements.setdefault(code, (handle.index, now))
+
+    def leastLoaded(self):
+        candidates = [w for w in self.workers
+                      if w is not None and w.alive() and not w.status.get("draining")]
+        return min(candidates, key=WorkerHandle.load) if candidates else None
+
+    def place(self, code, role=protocol.ROLE_PLAYER):
+        """ Pick the worker for a client
+
+        Args:
+            code : The room code from the JOIN, "" for matchmaking
+            role : The role from the JOIN
+
+        Returns:
+            WorkerHandle: The worker or None if none is running
+        """
+        if role == protocol.ROLE_SPECTATOR and not code:
+            # the worker refuses it, matchmaking must not count it
+            return self.leastLoaded()
+        if code:
+            placement = self.placements.get(code)
+            if placement is not None:
+                handle = self.workers[placement[0]]
+                if handle is not None and handle.alive():
+                    return handle
+            handle = self.leastLoaded()
+            if handle is not None:
+                self.placements[code] = (handle.index, time.monotonic())
+            return handle
+        handle = self.match_worker
+        if (handle is None or not handle.alive()
+                or self.match_count >= self.max_players):
+            handle = self.match_worker = self.leastLoaded()
+            self.match_count = 0
+        self.match_count += 1
+        return handle
+
+    async def readJoin(self, sock):
+        """ Read from a new client until its first frame is complete
+
+        Returns:
+            tuple: (role, room code, every byte read so far)
+
+        Raises:
+            ProtocolError: if the first frame is bigger than any a client sends
+        """
+        loop = asyncio.get_running_loop()
+        data = bytearray()
+        header_size = protocol.FRAME_HEADER.size
+        deadline = loop.time() + aioserver.JOIN_TIMEOUT
+        while True:
+            if len(data) >= header_size:
+                (kind, length) = protocol.FRAME_HEADER.unpack_from(data)
+                # checked before waiting for the body, which could be huge
+                if length > ratelimit.MAX_CLIENT_FRAME:
+                    raise protocol.ProtocolError(f"Frame of {length} bytes is too big")
+                if kind != protocol.JOIN:
+                    return (protocol.ROLE_PLAYER, "", bytes(data))
+                if len(data) >= header_size + length:
+                    (role, code, *_) = protocol.decodeJoin(data[header_size:header_size + length])
+                    return (role, code, bytes(data))
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return (protocol.ROLE_PLAYER, "", bytes(data))
+            try:
+                chunk = await asyncio.wait_for(loop.sock_recv(sock, 4096), timeout)
+            except asyncio.TimeoutError:
+                return (protocol.ROLE_PLAYER, "", bytes(data))
+            if not chunk:
+                raise ConnectionError("Client disconnected")
+            data += chunk
+
+    async def handOver(self, sock, addr):
+        try:
+            (role, code, initial) = await self.readJoin(sock)
+            handle = self.place(code, role)
+            if handle is None:
+                raise RuntimeError("No worker is running")
+            socket.send_fds(handle.ctrl, [bytes([CLIENT]) + initial], [sock.fileno()])
+            handle.assigned += 1
+            clients_placed.inc()
+            log.debug("Sent %s to worker %d", addr, handle.index)
+        except protocol.ProtocolError as e:
+            ratelimit.protocol_errors.inc()
+            log.info("Client %s left before joining: %r", addr, e)
+        except Exception as e:
+            log.warning("Could not place %s: %r", addr, e)
+        finally:
+            # the worker has its own copy of the descriptor now
+            sock.close()
+
+    async def acceptLoop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            (sock, addr) = await loop.sock_accept(self.listener)
+            sock.setblocking(False)
+            asyncio.create_task(self.handOver(sock, addr))
+
+    async def healthLoop(self):
+        """ Ping the workers and replace the ones that died or hang
+        """
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            now = time.monotonic()
+            for handle in list(self.workers):
+                if not handle.alive() or now - handle.last_seen > HEALTH_TIMEOUT:
+                    log.warning("Worker %d is not responding, restarting it", handle.index)
+                    worker_restarts.inc()
+                    self.stopWorker(handle)
+                    self.startWorker(handle.index)
+                    continue
+                try:
+                    handle.ctrl.send(bytes([PING]))
+                except OSError as e:
+                    log.warning("Could not ping worker %d: %s", handle.index, e)
+
+    async def drain(self):
+        """ Stop accepting, let the workers finish their games and wait
+            for them to exit
+        """
+        log.info("Draining %d workers", len(self.workers))
+        loop = asyncio.get_running_loop()
+        self.listener.close()
+        for handle in self.workers:
+            try:
+                handle.ctrl.send(bytes([DRAIN]))
+            except OSError:
+                pass
+        deadline = time.monotonic() + DRAIN_TIMEOUT + 5
+        while any(w.alive() for w in self.workers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        for handle in self.workers:
+            if handle.alive():
+                log.warning("Worker %d did not drain in time", handle.index)
+            self.stopWorker(handle)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for i in range(len(self.workers)):
+            self.startWorker(i)
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        tasks = [asyncio.create_task(self.acceptLoop()),
+                 asyncio.create_task(self.healthLoop())]
+        await stop.wait()
+        for task in tasks:
+            task.cancel()
+        await self.drain()
+
+def main(host, port, count, tick_rate=aioserver.TICK_RATE, room_options=None):
+    supervisor = Supervisor(host, port, count, tick_rate, room_options)
+    asyncio.run(supervisor.run())